@@ -5,50 +5,43 @@ from itertools import groupby
 from operator import itemgetter
 import sys
 import time
-from pybwa import logger, query_bps_count_index
-
-
-# Reads the mapper output and returns one line at a time
-def read_mapper_output(data_input, main_separator='\t'):
-    # Go through each line
-    for line in data_input:
-        # Strip out the separator character
-        yield line.rstrip().split(main_separator, 1)
+from pybwa import ENV_PREFIX, logger
+from mrcommon.records import RecordWriter, bin_size, parse_genome_key, parse_value, read_records, record_format, \
+    sum_bins
 
 
 def main(main_separator='\t', tuple_separator=';', list_separator=','):
     start_time = time.time()
     logger.info('Combiner Start Time: {0}'.format(start_time))
 
-    # Read the data using read_mapper_output
-    data = read_mapper_output(sys.stdin, main_separator)
+    # Read the data using read_records
+    records_format = record_format(ENV_PREFIX)
+    data = read_records(sys.stdin, records_format, main_separator)
+    writer = RecordWriter(sys.stdout, records_format, main_separator=main_separator, tuple_separator=tuple_separator,
+                          list_separator=list_separator)
+    binned = bin_size(ENV_PREFIX) > 0
 
     for ref_index, group in groupby(data, itemgetter(0)):
-        # group is a list of [ref_index, ref_char;ref_chromosone_name;csv_list of combined counts of ACGTDN]
+        # group is a list of [genome key, ref_char;ref_chromosone_name;csv_list of combined counts of ACGTDN]
         try:
-            total_count_A = total_count_C = total_count_G = total_count_T = total_count_D = total_count_N = 0
-            ref_char = None
+            # insertions are not binned
+            if binned and not parse_genome_key(ref_index, records_format)[2]:
+                # group is a list of [bin key, ref_chars and counts of the bin positions]
+                ref_chars, total_counts, ref_chromosone_name = sum_bins(
+                    (bin_value for ref_index, bin_value in group), records_format)
+                writer.write_bin(ref_index, ref_chars, total_counts, ref_chromosone_name)
+                continue
+
+            # combined counts of ACGTDN
+            total_counts = [0] * 6
+            ref_char = ref_chromosone_name = None
 
             for ref_index, ref_char_and_read_counts in group:
-                # this represents ref_char;ref_chromosone_name;csv_list of combined counts of ACGTDN
-                ref_char_name_and_read_counts_tuple = str(ref_char_and_read_counts).split(tuple_separator)
-
-                ref_char = ref_char_name_and_read_counts_tuple[0]
-                ref_chromosone_name = ref_char_name_and_read_counts_tuple[1]
-                combined_counts = ref_char_name_and_read_counts_tuple[2].split(list_separator)
-
-                total_count_A += int(combined_counts[query_bps_count_index('A')])
-                total_count_C += int(combined_counts[query_bps_count_index('C')])
-                total_count_G += int(combined_counts[query_bps_count_index('G')])
-                total_count_T += int(combined_counts[query_bps_count_index('T')])
-                total_count_D += int(combined_counts[query_bps_count_index('D')])
-                total_count_N += int(combined_counts[query_bps_count_index('N')])
-
-            print '%s%s%s%s%s%s%s' % (
-                ref_index, main_separator, ref_char, tuple_separator, ref_chromosone_name, tuple_separator,
-                ','.join(
-                    [str(total_count_A), str(total_count_C), str(total_count_G), str(total_count_T), str(total_count_D),
-                     str(total_count_N)]))
+                ref_char, combined_counts, ref_chromosone_name = parse_value(
+                    ref_char_and_read_counts, records_format, tuple_separator, list_separator)
+                total_counts = [total + count for total, count in zip(total_counts, combined_counts)]
+
+            writer.write(ref_index, ref_char, total_counts, ref_chromosone_name)
 
         except ValueError as err:
             logger.error('Error: {0}'.format(err))
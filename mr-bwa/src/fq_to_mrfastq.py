@@ -1,44 +1,65 @@
 #!/usr/bin/env python
 
-import sys
+import argparse
+from functools import partial
 import os
-from os.path import isfile
-from pybwa import MR_FASTQ_LINE_SEPARATOR
+from mrcommon import fastq
+from pybwa import MR_FASTQ_BATCH_SEPARATOR, MR_FASTQ_LINE_SEPARATOR
+
+
+# Joins each read of a batch of fastq lines in a single line with its fields separated by <sep>.
+# fastq files have 4 lines per read and we want to join these 4 lines separated by <sep>
+# and write them in 1 line. This is crucial since MapReduce streams one line at a time, however in our case,
+# every 4 lines mark a read.
+# Eventually these are split again in mapper and re-assemble the original fastq file
+#
+# With more than 1 read per line, all the lines of a batch of reads are joined by MR_FASTQ_BATCH_SEPARATOR instead,
+# hence the mapper hands bwa many reads per input line
+#
+# @param list of fastq lines, 4 per read
+# @param number of reads per output line
+# @returns text of the joined reads, one per line or one batch per line
+def convert_batch(lines, reads_per_line=1):
+    lines = [line.rstrip('\n') for line in lines]
+    if reads_per_line > 1:
+        return ''.join(MR_FASTQ_BATCH_SEPARATOR.join(lines[i:i + 4 * reads_per_line]) + '\n'
+                       for i in xrange(0, len(lines), 4 * reads_per_line))
+    return ''.join(MR_FASTQ_LINE_SEPARATOR.join(lines[i:i + 4]) + '\n' for i in xrange(0, len(lines), 4))
 
 
 # This program takes a fastq file and puts each read in a single line with its fields separated by <sep>.
 def main():
-    if len(sys.argv) < 2:
-        print 'Usage: fq_to_mrfastq.py <input_file.fastq>'
-        os.abort()
+    parser = argparse.ArgumentParser(description='Joins each read of a plain or gzip compressed fastq file in a single '
+                                                 'line')
+    parser.add_argument('input_file', help="fastq file, '-' standing for stdin")
+    parser.add_argument('-o', '--output', default='output.mr.fastq',
+                        help="output file, '-' standing for stdout e.g. to pipe it to 'hdfs dfs -put - <file>' "
+                             "(default: %(default)s)")
+    parser.add_argument('--chunks', type=int, default=1,
+                        help='number of output files of about the same size, suffixed by their number (default: '
+                             '%(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes joining reads, 0 for one per core (default: %(default)s)')
+    parser.add_argument('--reads-per-line', type=int, default=1,
+                        help='number of reads per output line, e.g. 10000 so that mappers hand bwa large batches of '
+                             'reads (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='number of reads processed at a time (default: %(default)s)')
+    args = parser.parse_args()
 
-    input_fastq_filename = str(sys.argv[1])
-    if not isfile(input_fastq_filename):
-        print '{0} is not a valid input file'.format(input_fastq_filename)
+    if not fastq.is_valid_input(args.input_file):
+        print '{0} is not a valid input file'.format(args.input_file)
         os.abort()
 
-    input_fastq_file = open(input_fastq_filename, 'r')
-    output_fastq_file = open('output.mr.fastq', 'w')
-
-    i = 1
-    joined_line = ''
-
-    for line in input_fastq_file:
-        # fastq files have 4 lines per read and we want to join these 4 lines separated by <sep>
-        # and write them in 1 line. This is crucial since MapReduce streams one line at a time, however in our case,
-        # every 4 lines mark a read.
-        # Eventually these are split again in mapper and re-assemble the original fastq file
-        if i % 4 == 0:
-            joined_line += line.replace('\n', '')
-            output_fastq_file.write(joined_line + '\n')
-            joined_line = ''
-        else:
-            joined_line += line.replace('\n', MR_FASTQ_LINE_SEPARATOR)
-
-        i += 1
+    if args.output == '-' and args.chunks > 1:
+        print 'Output cannot be split in chunks when written to stdout'
+        os.abort()
 
-    input_fastq_file.close()
-    output_fastq_file.close()
+    # batches hold whole output lines
+    reads_per_line = max(args.reads_per_line, 1)
+    batch_size = max(args.batch_size // reads_per_line, 1) * reads_per_line
+    fastq.convert(args.input_file, args.output, partial(convert_batch, reads_per_line=reads_per_line),
+                  chunks=args.chunks, workers=fastq.worker_count(args.workers), batch_size=batch_size)
 
 
 if __name__ == '__main__':
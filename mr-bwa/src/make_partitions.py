@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+from mrcommon import partitions
+from pybwa import ENV_PREFIX
+
+# Writes the partition file of the hadoop TotalOrderPartitioner for the MR-BWA job, see mrcommon.partitions. Split keys
+# spread over the reference genome coordinates follow the contig lengths of its samtools faidx index.
+
+
+# Reads the length of each reference sequence from a fasta index, as written by samtools faidx
+#
+# @param fasta index filename, e.g. hg38.fa.fai
+# @returns list of lengths, in the reference sequences order
+def read_contig_lengths(filename):
+    with open(filename) as fai:
+        return [int(line.split('\t')[1]) for line in fai if line.strip()]
+
+
+if __name__ == '__main__':
+    partitions.main(ENV_PREFIX, read_contig_lengths, '--reference-index', '/data/index/hg38.fa.fai',
+                    'samtools faidx index of the reference genome, used for the reference sequences lengths')
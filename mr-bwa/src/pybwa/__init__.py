@@ -1,4 +1,5 @@
 import logging
+import os
 
 # setup console logging
 
@@ -31,3 +32,26 @@ def query_bps_count_index(query_bp):
 
 # chars used to join or split fastq files since these have 4 lines per read
 MR_FASTQ_LINE_SEPARATOR = '<sep>'
+# char separating all the lines of an input line holding a batch of reads, as written by fq_to_mrfastq.py
+# --reads-per-line, hence a batch is decoded into fastq by a single replace. The ASCII record separator control char
+# cannot occur in fastq files, unlike tabs which separate the comments of read names, e.g. as kept by bwa mem -C
+MR_FASTQ_BATCH_SEPARATOR = '\x1e'
+
+# prefix of the environment variables configuring the job, e.g. set via hadoop streaming -cmdenv
+ENV_PREFIX = 'MRBWA_'
+
+
+# returns the integer value of an environment variable, e.g. set via hadoop streaming -cmdenv, or default if not set
+def env_int(name, default):
+    value = os.environ.get(name)
+    if value is None or value.strip() == '':
+        return default
+    return int(value)
+
+
+# returns True if an environment variable is set to a true value such as 1, true or yes
+def env_flag(name, default=False):
+    value = os.environ.get(name)
+    if value is None or value.strip() == '':
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
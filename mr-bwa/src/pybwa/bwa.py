@@ -1,14 +1,16 @@
 # This script is an adaptation from a library used to interact with BWA mapper using Python
 # https://github.com/VDBWRAIR/pyBWA
 
+import fcntl
 import re
 from subprocess import Popen, PIPE
 import os
 import os.path
 import glob
+import multiprocessing
 import tempfile
 import sh
-from pybwa import logger
+from pybwa import logger, env_int
 import seqio
 
 
@@ -65,6 +67,163 @@ def which_bwa():
     return str(sh.which('bwa')).strip()
 
 
+# Returns the names of the indexes staged in shared memory by 'bwa shm', which are the base names of the indexed
+# references. 'bwa mem' attaches to an index staged in shared memory instead of loading it from disk, whenever the
+# base name of the reference it is given matches
+#
+# @returns set of reference base names
+def shm_indexes():
+    p = Popen([which_bwa(), 'shm', '-l'], shell=False, stdout=PIPE, stderr=PIPE)
+    process_stdout, _ = p.communicate()
+    # 'bwa shm -l' lists each index as its name and size separated by a tab, and nothing if no index is staged
+    return set(line.split('\t')[0] for line in process_stdout.splitlines() if line.strip())
+
+
+# Checks to see if a given reference index is staged in shared memory
+#
+# @param - Reference file name
+# @return True if ref index is in shared memory, False if not
+def is_in_shm(ref):
+    return os.path.basename(ref) in shm_indexes()
+
+
+# Stages a given reference index in shared memory unless it is already there, so that it is loaded once per node and
+# shared by all the 'bwa mem' processes of the node. Concurrent callers on the same node are serialized by a lock file,
+# hence the first one loads the index while the others wait for it and attach
+#
+# @param ref - Reference file path whose index to stage
+# @return True if ref index is in shared memory, False if it could not be staged
+def stage_shm_index(ref):
+    if is_in_shm(ref):
+        logger.debug('{0} is already in shared memory'.format(ref))
+        return True
+
+    lock_filename = os.path.join(tempfile.gettempdir(), 'pybwa_shm_{0}.lock'.format(os.path.basename(ref)))
+    with open(lock_filename, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            # another task on this node may have staged the index while we were waiting for the lock
+            if not is_in_shm(ref):
+                logger.info('Staging {0} in shared memory'.format(ref))
+                BWAShm(ref).run()
+        except ValueError as e:
+            logger.error(e)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    if not is_in_shm(ref):
+        logger.error('Error running bwa shm on {0}'.format(ref))
+        return False
+    logger.info('{0} is in shared memory'.format(ref))
+    return True
+
+
+# Returns the cgroup directories this process belongs to that may hold its cpu quota, as (cgroup version, directory,
+# mount point) tuples. /proc/self/cgroup gives the cgroup path relative to the root of each hierarchy, and
+# /proc/self/mountinfo where that hierarchy is mounted and which part of it the mount exposes, e.g. only the container's
+# own cgroup when the container runtime mounts it at /sys/fs/cgroup
+def cgroup_cpu_dirs():
+    paths = {}
+    try:
+        with open('/proc/self/cgroup') as cgroup:
+            for line in cgroup:
+                hierarchy, controllers, path = line.rstrip('\n').split(':', 2)
+                if hierarchy == '0' and controllers == '':
+                    paths[2] = path
+                elif 'cpu' in controllers.split(','):
+                    paths[1] = path
+    except (IOError, ValueError):
+        return []
+
+    dirs = []
+    try:
+        with open('/proc/self/mountinfo') as mountinfo:
+            for line in mountinfo:
+                fields = line.split()
+                separator = fields.index('-')
+                root, mount_point = fields[3], fields[4]
+                fs_type, options = fields[separator + 1], fields[separator + 3]
+                if fs_type == 'cgroup2':
+                    version = 2
+                elif fs_type == 'cgroup' and 'cpu' in options.split(','):
+                    version = 1
+                else:
+                    continue
+                if version not in paths:
+                    continue
+                path = paths[version]
+                if root != '/':
+                    # the mount only exposes the subtree below root, which is the process' own cgroup or an ancestor
+                    path = path[len(root):] if path == root or path.startswith(root + '/') else ''
+                dirs.append((version, os.path.join(mount_point, path.lstrip('/')).rstrip('/'), mount_point))
+    except (IOError, ValueError, IndexError):
+        pass
+    return dirs
+
+
+# Returns the cpu quota of the cgroup this process runs in as a number of cpus, None if not limited. A quota set on an
+# ancestor cgroup also applies, so the lowest quota from the process' cgroup up to the mount point is used
+def cgroup_cpu_quota():
+    quota = None
+    for version, directory, mount_point in cgroup_cpu_dirs():
+        while True:
+            # cgroup v2 cpu.max holds '<quota> <period>', cgroup v1 holds them in two files, quota being 'max' or -1
+            # if unset
+            if version == 2:
+                filenames = (os.path.join(directory, 'cpu.max'),)
+            else:
+                filenames = (os.path.join(directory, 'cpu.cfs_quota_us'), os.path.join(directory, 'cpu.cfs_period_us'))
+            try:
+                values = ' '.join(open(filename).read().strip() for filename in filenames).split()
+                if values[0] not in ('max', '-1'):
+                    cpus = max(1, int(values[0]) // int(values[1]))
+                    quota = cpus if quota is None else min(quota, cpus)
+            except (IOError, ValueError, IndexError):
+                pass
+            if len(directory) <= len(mount_point):
+                break
+            directory = os.path.dirname(directory)
+    return quota
+
+
+# Returns the number of cpus this process may run on, i.e. its cpu affinity as restricted by the container it runs in,
+# further bounded by the cgroup cpu quota of the container if any
+def available_cpus():
+    cpus = multiprocessing.cpu_count()
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('Cpus_allowed_list:'):
+                    cpus = 0
+                    for cpu_range in line.split(':', 1)[1].strip().split(','):
+                        bounds = cpu_range.split('-')
+                        cpus += int(bounds[-1]) - int(bounds[0]) + 1
+    except (IOError, ValueError):
+        pass
+
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, quota)
+    return max(1, cpus)
+
+
+# Returns the number of 'bwa mem' threads set by the MRBWA_BWA_THREADS environment variable, None if not set in which
+# case bwa runs a single thread. 'auto' uses the vcores allocated to map tasks, i.e. mapreduce.map.cpu.vcores exported
+# by hadoop streaming as mapreduce_map_cpu_vcores, when above 1. Hadoop streaming exports the default of 1 even when
+# the job leaves it unset, hence threads are then derived from the cpus available to the container
+def mem_threads():
+    value = os.environ.get('MRBWA_BWA_THREADS', '').strip().lower()
+    if value == '':
+        return None
+    if value != 'auto':
+        return int(value)
+
+    vcores = env_int('mapreduce_map_cpu_vcores', 1)
+    if vcores > 1:
+        return vcores
+    return available_cpus()
+
+
 # Parent class exposing common functions for BWA commands
 
 class BWA(object):
@@ -186,10 +345,54 @@ class BWA(object):
         # Parse the status
         return self.bwa_return_code(process_stderr)
 
+    # Wrapper function to start bwa as a long-lived process reading its input from stdin, i.e. '-' given as input
+    # file, and writing its output to stdout
+    #
+    # @returns output of self.start_bwa
+    def start(self):
+        return self.start_bwa(self.required_options_values, self.options, self.args)
+
+    # Starts bwa based on the passed options, with stdin and stdout being pipes so that input can be streamed to bwa
+    # while its output is consumed as it appears. Stderr is spooled to an unlinked temp file, since bwa writes progress
+    # to stderr which would otherwise fill a pipe nobody reads until bwa exits
+    #
+    # @param required_options - Should correspond to self.REQUIRED_OPTIONS
+    # @param options_list - Full options for bwa as a list (ex. ['-t', '2'])
+    # @param args_list - Required arguments that come after options
+    #
+    # @returns the running bwa process, to be passed to self.wait_bwa once its stdin is closed
+    def start_bwa(self, required_options, options_list, args_list):
+        # check that bwa path is valid
+        if not os.path.exists(required_options[0]):
+            raise ValueError('{0} is not a valid bwa path'.format(required_options[0]))
+
+        cmd = required_options + options_list + args_list
+        logger.debug('Starting {0}'.format(cmd))
+        self.stderr_file = tempfile.TemporaryFile()
+        return Popen(cmd, shell=False, stdin=PIPE, stdout=PIPE, stderr=self.stderr_file)
+
+    # Waits for a bwa process started by self.start_bwa to exit
+    #
+    # @param the running bwa process
+    # @returns 0 for success, 2 if incorrect options, 1 for any other failures
+    def wait_bwa(self, process):
+        process.wait()
+        self.stderr_file.seek(0)
+        process_stderr = self.stderr_file.read()
+        self.stderr_file.close()
+
+        logger.debug('BWA Output: {0}'.format(process_stderr))
+
+        # Parse the status
+        return self.bwa_return_code(process_stderr)
+
     # Make sure fastapath is a valid path and already has an index
     #
     # @param fastapath - Path to fasta file
     def validate_indexed_fasta(self, fastapath):
+        # an index staged in shared memory is used by bwa instead of the index files
+        if is_in_shm(fastapath):
+            return
         if not is_indexed(fastapath):
             raise ValueError('{0} does not have an index'.format(fastapath))
         if not os.path.exists(fastapath):
@@ -245,8 +448,12 @@ class BWAMem(BWA):
     def __init__(self, *args, **kwargs):
         # Injects mem command and runs super
         kwargs['command'] = 'mem'
-        # use 4 threads
-        # kwargs['t'] = '4'
+        # threads and the number of input bases processed per batch, i.e. -t and -K, default to the job configuration
+        # since bwa mem runs in containers of various sizes. A fixed batch size keeps the output independent of threads
+        if kwargs.get('t') is None:
+            kwargs['t'] = mem_threads()
+        if kwargs.get('K') is None:
+            kwargs['K'] = env_int('MRBWA_BWA_BATCH_SIZE', None)
         super(BWAMem, self).__init__(*args, **kwargs)
 
     # 'mem' command requires the indexed reference genome and the input fastq file
@@ -254,13 +461,15 @@ class BWAMem(BWA):
         # First argument has to be a valid indexed fasta
         self.validate_args(self.args)
 
-    # Validates both the indexed reference genome and the input fastq file
+    # Validates both the indexed reference genome and the input fastq file, '-' standing for stdin when bwa is started
+    # by self.start
     def validate_args(self, args):
         if len(args) != 2:
             raise ValueError('BWAMem needs 2 paramters: 1. index 2. input fastq file')
         else:
             self.validate_indexed_fasta(self.args[0])
-            self.validate_input(self.args[1])
+            if self.args[1] != '-':
+                self.validate_input(self.args[1])
 
     # 'bwa mem' return code.
     # Output is validated by using regex. 'bwa mem' output has the format:
@@ -288,3 +497,39 @@ class BWAMem(BWA):
             logger.error('BWA Failed as no reads and basepairs have been processed')
             return 1
         return super(BWAMem, self).bwa_return_code(output)
+
+
+# Subclass exposing the 'bwa shm' command, which stages the index of a reference in shared memory, or drops all the
+# staged indexes when given no reference
+class BWAShm(BWA):
+    def __init__(self, *args, **kwargs):
+        # Injects shm command and runs super
+        kwargs['command'] = 'shm'
+        super(BWAShm, self).__init__(*args, **kwargs)
+
+    # 'shm' command requires the indexed reference genome, or the 'd' option to drop staged indexes
+    def required_args(self):
+        if len(self.args) == 0:
+            self.options.append('-d')
+        elif len(self.args) == 1:
+            self.validate_indexed_fasta(self.args[0])
+        else:
+            raise ValueError('BWAShm needs at most 1 parameter: the indexed reference')
+
+    # 'bwa shm' return code
+    #
+    # @param bwa shm command output
+    # @returns 0 for success, 1 if shared memory could not be opened or the index loaded
+    def bwa_return_code(self, output):
+        if '[E::' in output or 'fail' in output.lower():
+            logger.error('Error running bwa shm')
+            return 1
+        return super(BWAShm, self).bwa_return_code(output)
+
+    # Calls super and then removes output file
+    def run(self):
+        fd, tmpf = tempfile.mkstemp()
+        ret = super(BWAShm, self).run(tmpf)
+        os.close(fd)
+        os.unlink(tmpf)
+        return ret
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+import argparse
+import os
+from os.path import isfile
+import pybwa.bwa
+
+
+# This program stages the BWA index of the reference genome in shared memory of the node it runs on, where it stays
+# until dropped or the node reboots. mapper_pybwa.py tasks on the node then attach to it instead of each loading the
+# index files from disk.
+def main():
+    parser = argparse.ArgumentParser(description='Stages the BWA index of a reference in shared memory')
+    parser.add_argument('--reference', default='/data/index/hg38.fa',
+                        help='indexed reference genome (default: %(default)s)')
+    parser.add_argument('--list', action='store_true', help='list the indexes staged in shared memory')
+    parser.add_argument('--drop', action='store_true', help='drop all the indexes staged in shared memory')
+    args = parser.parse_args()
+
+    if args.list:
+        for name in sorted(pybwa.bwa.shm_indexes()):
+            print name
+        return
+
+    if args.drop:
+        pybwa.bwa.BWAShm().run()
+        print 'Dropped indexes from shared memory'
+        return
+
+    if not isfile(args.reference):
+        print '{0} is not a valid reference file'.format(args.reference)
+        os.abort()
+
+    if not pybwa.bwa.stage_shm_index(args.reference):
+        print 'Error staging {0} in shared memory'.format(args.reference)
+        os.abort()
+    print '{0} is staged in shared memory'.format(args.reference)
+
+
+if __name__ == '__main__':
+    main()
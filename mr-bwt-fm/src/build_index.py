@@ -1,49 +1,97 @@
 #!/usr/bin/python
+import argparse
+import multiprocessing
 import os
 from os.path import isfile
-import cPickle as pickle
 import sys
 import time
+import bwt_blockwise
 import bwt_fmindex
+import index_file
+import locate
+import reference
 
 
-# Serializes the input index to binary using cPickle and saves
+# Writes the input index to file using the memory-mapped index file format
 #
 # @param filename to wirte to
 # @param index data
 def save(filename, idx):
-    f = open(filename, 'w')
-    # files created with protocols >= 1 are in binary mode (https://docs.python.org/2/library/pickle.html)
-    pickle.dump(idx, f, pickle.HIGHEST_PROTOCOL)
-    f.close()
+    index_file.save_index(filename, idx)
+
+
+# Prints a progress message of the index construction
+def report_progress(message):
+    print message
+    sys.stdout.flush()
 
 
 def main():
-    if not len(sys.argv) in [3]:
-        print 'Usage: %s input_file output_index_file' % sys.argv[0]
+    parser = argparse.ArgumentParser(description='Creates the custom FM-Index for a reference genome')
+    parser.add_argument('input_file', help='reference genome fasta file, or packed reference file')
+    parser.add_argument('output_index_file')
+    parser.add_argument('--sa-algorithm', default='sais', choices=sorted(bwt_fmindex.SA_ALGORITHMS.keys()),
+                        help='suffix array construction algorithm (default: %(default)s)')
+    parser.add_argument('--ssa-interval', type=int, default=32,
+                        help='suffix array sampling interval (default: %(default)s)')
+    parser.add_argument('--ssa-sampling', default='text', choices=locate.SSA_SAMPLINGS,
+                        help='sample suffix array by text position, bounding locate time, or by row, '
+                             'taking less space (default: %(default)s)')
+    parser.add_argument('--kmer-length', type=int, default=0,
+                        help='length of the k-mers whose intervals are stored in a lookup table, '
+                             'e.g. 12. 0 for no k-mer table (default: %(default)s)')
+    parser.add_argument('--both-strands', action='store_true',
+                        help='index the reference followed by its reverse complement, so mappers align reads to '
+                             'both strands in a single search')
+    parser.add_argument('--blockwise', action='store_true',
+                        help='sort the suffixes in buckets written to temporary files, in parallel and without '
+                             'holding the whole suffix array in memory, instead of using --sa-algorithm')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes sorting buckets with --blockwise, 0 for one per core '
+                             '(default: %(default)s)')
+    parser.add_argument('--bucket-size', type=int, default=bwt_blockwise.BUCKET_SIZE,
+                        help='maximum number of suffixes per bucket with --blockwise (default: %(default)s)')
+    parser.add_argument('--tmp-dir',
+                        help='directory of the temporary bucket files with --blockwise, which take about 5 bytes per '
+                             'reference base (default: system temporary directory)')
+    parser.add_argument('--reference-output',
+                        help='packed reference file to write, holding the contig sequences and names the index is '
+                             'built over, which mappers read reference chars and chromosomes from')
+    args = parser.parse_args()
+
+    if not isfile(args.input_file):
+        print 'Input file does not exist'
         os.abort()
     else:
-        if not isfile(sys.argv[1]):
-            print 'Input file does not exist'
-            os.abort()
-
-        inp = open(sys.argv[1])
-        # read input
-        reference_data = inp.read()
-        inp.close()
+        # read input, i.e. the contig sequences without fasta headers and line breaks. These are indexed in upper
+        # case, fasta files marking repeats in lower case
+        ref_gen = reference.open_reference(args.input_file)
+        reference_data = ref_gen[0:len(ref_gen)].upper()
+        if args.reference_output:
+            reference.save_reference(args.reference_output, ref_gen)
+        if args.both_strands:
+            reference_data = bwt_fmindex.both_strands_text(reference_data)
 
         start_time = time.time()
         print 'Started indexing at {0}'.format(start_time)
 
         # create index
-        fm_idx = bwt_fmindex.make_index(reference_data)
+        if args.blockwise:
+            workers = args.workers if args.workers > 0 else multiprocessing.cpu_count()
+            fm_idx = bwt_blockwise.make_index(reference_data, ssaIval=args.ssa_interval,
+                                              ssa_sampling=args.ssa_sampling, kmer_k=args.kmer_length,
+                                              workers=workers, bucket_size=args.bucket_size, tmp_dir=args.tmp_dir,
+                                              progress=report_progress)
+        else:
+            fm_idx = bwt_fmindex.make_index(reference_data, ssaIval=args.ssa_interval, sa_algorithm=args.sa_algorithm,
+                                            ssa_sampling=args.ssa_sampling, kmer_k=args.kmer_length)
 
         end_time = time.time()
         print 'Finished indexing at {0}'.format(end_time)
         print 'Total Indexing Time: {0} seconds'.format(round(end_time - start_time, 2))
 
         # save index to file
-        save(sys.argv[2], fm_idx)
+        save(args.output_index_file, fm_idx)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,443 @@
+from array import array
+from itertools import count
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import time
+from bwt_fmindex import dollar_initial_char, index_from_bwt
+from locate import SSA_SAMPLINGS, SampledSuffixArray, values_typecode
+from packed_bwt import np
+from utils import peak_rss
+
+# Out-of-core, parallel construction of the custom FM-Index.
+#
+# Instead of holding the whole suffix array in memory, suffixes are partitioned by key into buckets of at most
+# bucket_size suffixes, which sort in the same order as their keys. The key of a suffix is its first prefix_length
+# characters, unless these are a run of a same character, which is then keyed by the length of the whole run and by
+# whether it is followed by a greater character, in closed form as below. Hence a long run, e.g. of N, spreads over as
+# many keys as its length rather than making a single prefix. Adjacent keys are grouped into buckets, whose positions
+# are distributed to a file per bucket in a single pass over the text. A key counting more than bucket_size suffixes on
+# its own is extended for these suffixes only by the key of the text following it, and its suffixes are distributed
+# again in as many passes over its bucket file as needed. Buckets are then suffix sorted independently by a pool of
+# worker processes sharing the text, each writing its run of bwt characters and sampled suffix array entries to disk,
+# and runs are finally concatenated in bucket order into the bwt and sampled suffix array. Peak memory is hence the
+# text, the bwt and one bucket per worker rather than the whole suffix array.
+#
+# Suffixes within a bucket are sorted by comparing the text in place. A suffix starting with a run of a same character
+# c, e.g. in a stretch of N, is ordered by the length of that run and by the suffix following it: suffixes whose run
+# is followed by a smaller character sort first, by increasing run length, then suffixes whose run is followed by a
+# greater character, by decreasing run length, ties being ordered by the suffixes following the runs. Hence long runs
+# are never compared character by character.
+
+# number of leading characters keying suffixes
+PREFIX_LENGTH = 8
+# maximum number of suffixes per bucket, bounding the memory of each worker
+BUCKET_SIZE = 1 << 20
+# number of text positions, or bucket suffixes, processed at a time while distributing suffixes to buckets
+DISTRIBUTE_CHUNK_SIZE = 1 << 24
+
+# text being indexed, shared with the worker processes forked by the pool
+builder_text = None
+# for each character, the regex finding the end of a run of that character
+run_end_regexes = {}
+
+
+# Returns the end of the run of a same character starting at position
+#
+# @param text
+# @param position
+# @returns position of the first different character, or length of text
+def run_end(text, position):
+    c = text[position]
+    if c not in run_end_regexes:
+        run_end_regexes[c] = re.compile('[^{0}]'.format(re.escape(c)))
+    m = run_end_regexes[c].search(text, position)
+    return m.start() if m else len(text)
+
+
+# Suffix sorts the positions of a bucket, as a worker process, and writes out its runs
+#
+# @param tuple of bucket number, bucket directory, first bwm row of the bucket, suffix array sampling interval and
+# sampling
+# @returns tuple of bucket number, number of suffixes and peak resident memory of the worker
+def sort_bucket(job):
+    bucket, directory, first_row, ival, sampling = job
+    text = builder_text
+    positions = array(values_typecode(len(text)))
+    with open(bucket_filename(directory, 'positions', bucket), 'rb') as f:
+        positions.fromfile(f, os.fstat(f.fileno()).st_size // positions.itemsize)
+
+    # positions are in increasing order, hence positions in a same run follow each other
+    # sort keys: run character, whether the run is followed by a greater character, signed run length, suffix
+    # following the run, and position
+    keys = []
+    end = 0
+    for position in positions:
+        if position >= end:
+            c = text[position]
+            end = run_end(text, position)
+            greater_next = text[end:end + 1] > c
+        if greater_next:
+            keys.append((c, 1, position - end, end, position))
+        else:
+            keys.append((c, 0, end - position, end, position))
+
+    # suffixes following the runs are ranked once, then suffixes are sorted by run and rank of the following suffix,
+    # folded into a single integer as integers compare faster than tuples. Signed run lengths range over [-n, n]
+    ends = sorted(set(key[3] for key in keys), key=lambda position: buffer(text, position))
+    end_ranks = dict((position, rank) for rank, position in enumerate(ends))
+    span = 2 * len(text) + 1
+    keys = sorted((((ord(c) * 2 + greater) * span + signed_length + len(text)) * len(ends) + end_ranks[end], position)
+                  for c, greater, signed_length, end, position in keys)
+
+    # bwt characters, text[-1] being the dollar preceding the suffix at 0, and sampled suffix array entries
+    rows = array('L')
+    values = array(positions.typecode)
+    bw = []
+    for i, (key, position) in enumerate(keys):
+        bw.append(text[position - 1])
+        if (sampling == 'row' and (first_row + i) % ival == 0) or (sampling == 'text' and position % ival == 0):
+            rows.append(first_row + i)
+            values.append(position)
+
+    with open(bucket_filename(directory, 'bwt', bucket), 'wb') as f:
+        f.write(''.join(bw))
+    with open(bucket_filename(directory, 'ssarows', bucket), 'wb') as f:
+        rows.tofile(f)
+    with open(bucket_filename(directory, 'ssavals', bucket), 'wb') as f:
+        values.tofile(f)
+    os.remove(bucket_filename(directory, 'positions', bucket))
+    return bucket, len(keys), peak_rss()
+
+
+# Returns the name of a bucket file
+def bucket_filename(directory, name, bucket):
+    return os.path.join(directory, '{0}.{1:06d}'.format(name, bucket))
+
+
+# Returns the prefix codes of a range of text positions, the prefixes sorting in the same order as their codes
+#
+# @param numpy array of text character ranks, 0 being left for positions past the end of text
+# @param first position
+# @param end position, exclusive
+# @param prefix length
+# @param alphabet size, including the 0 rank
+# @returns numpy int64 array of prefix codes
+def prefix_codes(ranks, start, end, prefix_length, radix):
+    window = np.zeros(end - start + prefix_length - 1, dtype=np.int64)
+    available = ranks[start:end + prefix_length - 1]
+    window[:len(available)] = available
+    codes = np.zeros(end - start, dtype=np.int64)
+    for i in xrange(prefix_length):
+        codes = codes * radix + window[i:i + end - start]
+    return codes
+
+
+# Returns the prefix codes of any text positions, as prefix_codes does for a range of positions
+#
+# @param numpy array of text character ranks
+# @param numpy int64 array of positions, which may be past the end of text
+# @param prefix length
+# @param alphabet size, including the 0 rank
+# @returns numpy int64 array of prefix codes
+def gather_prefix_codes(ranks, positions, prefix_length, radix):
+    n = len(ranks)
+    codes = np.zeros(len(positions), dtype=np.int64)
+    for i in xrange(prefix_length):
+        indexes = positions + i
+        digits = ranks.take(np.minimum(indexes, n - 1)).astype(np.int64)
+        digits[indexes >= n] = 0
+        codes = codes * radix + digits
+    return codes
+
+
+# Returns the keys of text positions, which sort in the same order as their suffixes, and their cursors, i.e. where the
+# text following the part of the suffix covered by the key starts. A key is the prefix code of its position times
+# 2 * n + 1, unless the prefix is a run of a same character. Such a key is then extended to the whole run of length l,
+# adding l if the run is followed by a smaller character and 2 * n + 1 - l if followed by a greater one, in the order of
+# their suffixes as described above, and the cursor is the end of the run.
+#
+# @param text
+# @param numpy array of text character ranks
+# @param numpy int64 array of positions
+# @param numpy int64 array of their prefix codes
+# @param prefix length
+# @param alphabet size, including the 0 rank
+# @returns tuple of numpy int64 arrays of keys and cursors
+def prefix_keys(text, ranks, positions, codes, prefix_length, radix):
+    n = len(ranks)
+    span = 2 * n + 1
+    keys = codes * span
+    cursors = positions + prefix_length
+    # prefixes of a single character are the multiples of the code of the prefix of rank 1 characters
+    unit = (radix ** prefix_length - 1) // (radix - 1)
+    runs = np.flatnonzero((codes % unit == 0) & (codes != 0))
+    if len(runs) == 0:
+        return keys, cursors
+
+    # adjacent positions starting with a same character run share the end of the run, which is searched once
+    run_positions = positions[runs]
+    run_ranks = codes[runs] // unit
+    order = np.argsort(run_positions, kind='mergesort')
+    sorted_positions = run_positions[order]
+    firsts = np.ones(len(runs), dtype=bool)
+    firsts[1:] = (np.diff(sorted_positions) != 1) | (np.diff(run_ranks[order]) != 0)
+    first_ends = np.array([run_end(text, position) for position in sorted_positions[firsts].tolist()], dtype=np.int64)
+    ends = np.empty(len(runs), dtype=np.int64)
+    ends[order] = first_ends[np.cumsum(firsts) - 1]
+
+    lengths = ends - run_positions
+    next_ranks = ranks.take(np.minimum(ends, n - 1)).astype(np.int64)
+    next_ranks[ends >= n] = 0
+    keys[runs] += np.where(next_ranks > run_ranks, span - lengths, lengths)
+    cursors[runs] = ends
+    return keys, cursors
+
+
+# Adds keys to a step function counting the suffixes of each key, which takes as many steps as the count changes
+# rather than one per key, e.g. one for all the keys of a long run
+#
+# @param tuple of numpy int64 arrays of the first key of each step and of the count of its keys, the last count being
+# 0, both empty for no keys
+# @param numpy int64 array of keys
+# @returns the step function counting the keys too
+def add_key_counts(steps, keys):
+    bounds, counts = steps
+    unique_keys, key_counts = np.unique(keys, return_counts=True)
+    # consecutive keys of a same count, e.g. of a long run, make a single step
+    firsts = np.ones(len(unique_keys), dtype=bool)
+    firsts[1:] = (np.diff(unique_keys) != 1) | (np.diff(key_counts) != 0)
+    lasts = np.append(np.flatnonzero(firsts)[1:] - 1, len(unique_keys) - 1)
+    key_counts = key_counts[firsts]
+    coords = np.concatenate((bounds, unique_keys[firsts], unique_keys[lasts] + 1))
+    deltas = np.concatenate((counts[:1], np.diff(counts), key_counts, -key_counts))
+    order = np.argsort(coords, kind='mergesort')
+    coords = coords[order]
+    counts = np.cumsum(deltas[order])
+    lasts = np.append(np.flatnonzero(np.diff(coords)), len(coords) - 1)
+    coords, counts = coords[lasts], counts[lasts]
+    changes = np.ones(len(counts), dtype=bool)
+    changes[0] = counts[0] != 0
+    changes[1:] = np.diff(counts) != 0
+    return coords[changes], counts[changes]
+
+
+# Groups adjacent keys into buckets of at most bucket_size suffixes, but for keys counting more suffixes on their own
+#
+# @param step function counting the suffixes of each key, as returned by add_key_counts
+# @param maximum number of suffixes per bucket
+# @returns list of tuples of the first key, number of suffixes and whether it is a single key counting more than
+# bucket_size suffixes, of every bucket
+def plan_buckets(steps, bucket_size):
+    buckets = []
+    size = 0
+    bounds, counts = steps
+    for key, end, key_count in zip(bounds.tolist(), bounds[1:].tolist(), counts.tolist()):
+        while key_count and key < end:
+            if key_count > bucket_size:
+                buckets.append([key, key_count, True])
+                size = bucket_size
+                key += 1
+                continue
+            if not buckets or size + key_count > bucket_size:
+                buckets.append([key, 0, False])
+                size = 0
+            keys = min(end - key, (bucket_size - size) // key_count)
+            buckets[-1][1] += keys * key_count
+            size += keys * key_count
+            key += keys
+    return [tuple(bucket) for bucket in buckets]
+
+
+# Distributes suffixes to bucket files by key, appending the positions of every bucket to its positions file, and the
+# cursors of buckets of a single key counting more than bucket_size suffixes to their cursors file
+#
+# @param function returning an iterator of tuples of numpy arrays of positions, keys and cursors, positions increasing
+# @param bucket file directory
+# @param maximum number of suffixes per bucket
+# @param iterator of bucket numbers
+# @param numpy dtype of the positions in bucket files
+# @returns list of tuples of bucket number, number of suffixes and whether it is to be distributed again, in key order
+def distribute_keys(key_chunks, directory, bucket_size, bucket_numbers, positions_dtype):
+    steps = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    for positions, keys, cursors in key_chunks():
+        steps = add_key_counts(steps, keys)
+    plan = plan_buckets(steps, bucket_size)
+    buckets = [next(bucket_numbers) for _ in plan]
+
+    # positions are appended to their bucket file chunk by chunk, hence in increasing order
+    first_keys = np.array([first_key for first_key, size, oversized in plan], dtype=np.int64)
+    for positions, keys, cursors in key_chunks():
+        indexes = np.searchsorted(first_keys, keys, side='right') - 1
+        order = np.argsort(indexes, kind='mergesort')
+        indexes = indexes[order]
+        bounds = np.flatnonzero(np.diff(indexes)) + 1
+        starts = [0] + bounds.tolist()
+        for lo, hi in zip(starts, starts[1:] + [len(indexes)]):
+            index = int(indexes[lo])
+            with open(bucket_filename(directory, 'positions', buckets[index]), 'ab') as f:
+                positions[order[lo:hi]].astype(positions_dtype).tofile(f)
+            if plan[index][2]:
+                with open(bucket_filename(directory, 'cursors', buckets[index]), 'ab') as f:
+                    cursors[order[lo:hi]].tofile(f)
+    return [(bucket, size, oversized) for bucket, (first_key, size, oversized) in zip(buckets, plan)]
+
+
+# Distributes the suffixes of a text to bucket files of at most bucket_size suffixes, which sort in bucket order
+#
+# @param text, ending with the dollar
+# @param bucket file directory
+# @param maximum number of suffixes per bucket
+# @param number of leading characters keying suffixes, lowered for large alphabets
+# @returns list of tuples of bucket number, first bwm row and number of suffixes, in bwm order
+def distribute_suffixes(text, directory, bucket_size=BUCKET_SIZE, prefix_length=PREFIX_LENGTH):
+    if bucket_size < 1:
+        raise ValueError('Bucket size must be at least 1')
+    n = len(text)
+
+    # character ranks following the character order, 0 standing past the end of text
+    alphabet = sorted(set(text))
+    table = [chr(0)] * 256
+    for i, c in enumerate(alphabet):
+        table[ord(c)] = chr(i + 1)
+    ranks = np.frombuffer(text.translate(''.join(table)), dtype=np.uint8)
+    radix = len(alphabet) + 1
+    while prefix_length > 1 and radix ** prefix_length * (2 * n + 1) >= 2 ** 63:
+        prefix_length -= 1
+    positions_dtype = np.dtype(values_typecode(n))
+
+    def text_chunks():
+        for start in xrange(0, n, DISTRIBUTE_CHUNK_SIZE):
+            end = min(n, start + DISTRIBUTE_CHUNK_SIZE)
+            positions = np.arange(start, end, dtype=np.int64)
+            codes = prefix_codes(ranks, start, end, prefix_length, radix)
+            yield (positions,) + prefix_keys(text, ranks, positions, codes, prefix_length, radix)
+
+    def cursor_keys(cursors):
+        return prefix_keys(text, ranks, cursors, gather_prefix_codes(ranks, cursors, prefix_length, radix),
+                           prefix_length, radix)
+
+    # the suffixes of a single key are keyed again from its cursors on
+    def bucket_chunks(bucket, size):
+        positions_filename = bucket_filename(directory, 'positions', bucket)
+        cursors_filename = bucket_filename(directory, 'cursors', bucket)
+        if size <= DISTRIBUTE_CHUNK_SIZE:
+            positions = np.fromfile(positions_filename, dtype=positions_dtype)
+            keys, cursors = cursor_keys(np.fromfile(cursors_filename, dtype=np.int64))
+            # keys shared by all the suffixes, e.g. of a tandem repeat, are skipped in memory
+            while np.all(keys == keys[0]):
+                keys, cursors = cursor_keys(cursors)
+            return lambda: iter([(positions, keys, cursors)])
+
+        def chunks():
+            with open(positions_filename, 'rb') as positions_file, open(cursors_filename, 'rb') as cursors_file:
+                while True:
+                    positions = np.fromfile(positions_file, dtype=positions_dtype, count=DISTRIBUTE_CHUNK_SIZE)
+                    if len(positions) == 0:
+                        break
+                    yield (positions,) + cursor_keys(np.fromfile(cursors_file, dtype=np.int64,
+                                                                 count=len(positions)))
+        return chunks
+
+    bucket_numbers = count()
+    buckets = distribute_keys(text_chunks, directory, bucket_size, bucket_numbers, positions_dtype)
+    while any(oversized for bucket, size, oversized in buckets):
+        distributed = []
+        for bucket, size, oversized in buckets:
+            if oversized:
+                distributed.extend(distribute_keys(bucket_chunks(bucket, size), directory, bucket_size, bucket_numbers,
+                                                   positions_dtype))
+                os.remove(bucket_filename(directory, 'positions', bucket))
+                os.remove(bucket_filename(directory, 'cursors', bucket))
+            else:
+                distributed.append((bucket, size, oversized))
+        buckets = distributed
+
+    first_rows = [0]
+    for bucket, size, oversized in buckets:
+        first_rows.append(first_rows[-1] + size)
+    return [(bucket, first_row, size) for (bucket, size, oversized), first_row in zip(buckets, first_rows)]
+
+
+# Creates the custom FM-Index for the input text, sorting buckets of suffixes in parallel and out of core. Requires
+# numpy.
+#
+# @param input text
+# @param spacing between rank checkpoints
+# @param suffix array sampling interval
+# @param suffix array sampling, one of locate.SSA_SAMPLINGS
+# @param length of the k-mers whose bwm intervals are looked up from a table, None for no k-mer table
+# @param number of worker processes
+# @param maximum number of suffixes per bucket
+# @param directory of the temporary bucket files, None for the system default
+# @param function called with a progress message, None for no progress report
+# @param number of leading characters keying suffixes, lowered for large alphabets
+# @returns the fm-index, as returned by bwt_fmindex.make_index
+def make_index(input_text, cpIval=128, ssaIval=32, ssa_sampling='text', kmer_k=None, workers=1,
+               bucket_size=BUCKET_SIZE, tmp_dir=None, progress=None, prefix_length=PREFIX_LENGTH):
+    global builder_text
+
+    if np is None:
+        raise RuntimeError('numpy is required for the blockwise index construction')
+    if ssa_sampling not in SSA_SAMPLINGS:
+        raise ValueError('Unknown suffix array sampling {0}'.format(ssa_sampling))
+
+    def report(message):
+        if progress is not None:
+            progress('{0} ({1} seconds, peak memory {2} MB, worker peak memory {3} MB)'.format(
+                message, round(time.time() - start_time, 2), peak_rss() // (1024 * 1024),
+                max(worker_peak_rss) // (1024 * 1024)))
+
+    start_time = time.time()
+    worker_peak_rss = [0]
+    if input_text[-1] != dollar_initial_char:
+        input_text += dollar_initial_char  # add dollar if not there already
+    n = len(input_text)
+
+    directory = tempfile.mkdtemp(prefix='bwt_blockwise.', dir=tmp_dir)
+    pool = None
+    try:
+        buckets = distribute_suffixes(input_text, directory, bucket_size, prefix_length)
+        report('Distributed {0} suffixes to {1} buckets of at most {2} suffixes'.format(n, len(buckets), bucket_size))
+
+        # the text is shared with workers by forking them after it has been set
+        builder_text = input_text
+        jobs = [(bucket, directory, first_row, ssaIval, ssa_sampling) for bucket, first_row, size in buckets]
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap_unordered(sort_bucket, jobs)
+        else:
+            results = (sort_bucket(job) for job in jobs)
+        for i, (bucket, size, worker_rss) in enumerate(results):
+            worker_peak_rss.append(worker_rss)
+            report('Sorted bucket {0}/{1} of {2} suffixes'.format(i + 1, len(jobs), size))
+        builder_text = None
+
+        # runs are concatenated in bucket order
+        bw = []
+        ssa = SampledSuffixArray.from_data(n, ssaIval, ssa_sampling, array(values_typecode(n)), array('I'),
+                                           array('L'))
+        sampled_rows = array('L')
+        for bucket, first_row, size in buckets:
+            with open(bucket_filename(directory, 'bwt', bucket), 'rb') as f:
+                bw.append(f.read())
+            for name, values in (('ssarows', sampled_rows), ('ssavals', ssa.values)):
+                with open(bucket_filename(directory, name, bucket), 'rb') as f:
+                    values.fromfile(f, os.fstat(f.fileno()).st_size // values.itemsize)
+        bw = ''.join(bw)
+        if ssa_sampling == 'text':
+            ssa.init_bitvector(sampled_rows)
+        del sampled_rows
+        report('Merged {0} bucket runs'.format(len(buckets)))
+    finally:
+        builder_text = None
+        if pool is not None:
+            pool.close()
+            pool.join()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    fm_index = index_from_bwt(bw, ssa, cpIval, kmer_k)
+    report('Packed bwt and rank checkpoints')
+    return fm_index
@@ -1,6 +1,17 @@
+import heapq
 from itertools import islice, izip_longest
+import random
+import string
+from kmer_table import KmerTable
+from locate import SampledSuffixArray
+from packed_bwt import PackedBwt, PackedFmCheckpoints, NUCLEOTIDES, CODE_TABLE, NON_NUCLEOTIDE_REGEX, as_numpy, np
+from sais import suffix_array_sais
 
 dollar_initial_char = '$'
+# complement of each nucleotide, other characters such as N being their own complement
+COMPLEMENT_TABLE = string.maketrans('ACGTacgt', 'TGCAtgca')
+# maximum number of interval extensions explored per query by the mismatch tolerant search
+MISMATCH_SEARCH_BUDGET = 10000
 
 
 # This is a crucial part of the optimized SA which uses Timsort to extract integer keys from the given string.
@@ -112,30 +123,55 @@ def downsample_suffix_array(sa, n=32):
     return ssa
 
 
+# Suffix array construction algorithms available to make_index
+SA_ALGORITHMS = {
+    'doubling': suffix_array,
+    'sais': suffix_array_sais
+}
+
+
 # Creates the custom FM-Index for the input text
 #
 # @param input text
+# @param spacing between rank checkpoints
+# @param suffix array sampling interval
+# @param suffix array construction algorithm, one of SA_ALGORITHMS
+# @param suffix array sampling, one of locate.SSA_SAMPLINGS: 'text' bounds locate steps, 'row' takes less space
+# @param length of the k-mers whose bwm intervals are looked up from a table, None for no k-mer table
 # @returns a tuple containing 4 main data structures making up fm-index:
-# -- bwt
+# -- bwt, packed at 2 bits per character
 # -- downsampled suffix array
-# -- rank checkpoints
+# -- rank checkpoints, interleaved with the packed bwt
 # -- the first column containing number of occurrences of each character
-def make_index(input_text, cpIval=128, ssaIval=32):
+# followed by the k-mer table, if requested
+def make_index(input_text, cpIval=128, ssaIval=32, sa_algorithm='sais', ssa_sampling='text', kmer_k=None):
+    if sa_algorithm not in SA_ALGORITHMS:
+        raise ValueError('Unknown suffix array algorithm {0}'.format(sa_algorithm))
+
     if input_text[-1] != dollar_initial_char:
         input_text += dollar_initial_char  # add dollar if not there already
 
     # create suffix array
-    sa = suffix_array(input_text)
+    sa = SA_ALGORITHMS[sa_algorithm](input_text)
     # create bwt
     bwt = bwt_from_sa(input_text, sa)
     # downsample suffix array
-    ssa = downsample_suffix_array(sa, ssaIval)
-    # create rank checkpoints
-    checkpoints = FmCheckpoints(bwt, cpIval)
+    ssa = SampledSuffixArray(sa, ssaIval, ssa_sampling)
+    return index_from_bwt(bwt, ssa, cpIval, kmer_k)
+
+
+# Completes the custom FM-Index of a text from its bwt and downsampled suffix array, however these have been built
+#
+# @param bwt string
+# @param downsampled suffix array
+# @param spacing between rank checkpoints
+# @param length of the k-mers whose bwm intervals are looked up from a table, None for no k-mer table
+# @returns the fm-index, as returned by make_index
+def index_from_bwt(bwt, ssa, cpIval=128, kmer_k=None):
     # Calculate no occurrences of each character
     tots = dict()
-    for c in bwt:
-        tots[c] = tots.get(c, 0) + 1
+    for c in set(bwt):
+        tots[c] = bwt.count(c)
     # Calculate concise representation of first column
     first_col = {}
     totc = 0
@@ -143,9 +179,24 @@ def make_index(input_text, cpIval=128, ssaIval=32):
         first_col[c] = totc
         totc += count
 
+    # pack bwt and create rank checkpoints
+    bwt = PackedBwt(bwt, cpIval)
+    checkpoints = PackedFmCheckpoints(bwt)
+
+    if kmer_k:
+        kmers = KmerTable(kmer_k, bwt, checkpoints, [count_occurrences(first_col, c) for c in NUCLEOTIDES])
+        return bwt, ssa, checkpoints, first_col, kmers
     return bwt, ssa, checkpoints, first_col
 
 
+# Returns the k-mer table of the fm-index
+#
+# @param the fm-index
+# @returns the k-mer table, None if the fm-index has been created without one
+def kmer_table(bwt_fmindex):
+    return bwt_fmindex[4] if len(bwt_fmindex) > 4 else None
+
+
 # Return number of occurrences of characters < c
 #
 # @param fm-index first column
@@ -160,28 +211,249 @@ def count_occurrences(first_col, character):
     else:
         return first_col[character]
 
-# Returns the range of BWM rows having query as a prefix
+# Returns the range of BWM rows having query as a prefix.
+# If query does not occur exactly, the range of the closest match having up to the given number of mismatches is
+# returned instead.
 #
 # @param the fm-index
 # @param input query text
+# @param number of mismatches allowed
 # @returns the bwm rows where input query text is found in fm-index
 def bwm_range(bwt_fmindex, query, mismatches=1):
-    bwt, ssa, checkpoints, first_col = bwt_fmindex
+    bwt, ssa, checkpoints, first_col = bwt_fmindex[:4]
     l, r = 0, len(bwt) - 1
-    for i in xrange(len(query) - 1, -1, -1):  # from right to left
+    start = len(query) - 1
+
+    # skip the last k characters when their interval is available from the k-mer table
+    kmers = kmer_table(bwt_fmindex)
+    interval = kmers.lookup(query) if kmers is not None else None
+    if interval is not None:
+        l, r = interval[0], interval[1] - 1
+        start = len(query) - kmers.k - 1 if l <= r else -1
+
+    for i in xrange(start, -1, -1):  # from right to left
         l = checkpoints.rank(bwt, query[i], l - 1) + count_occurrences(first_col, query[i])
         r = checkpoints.rank(bwt, query[i], r) + count_occurrences(first_col, query[i]) - 1
         if r < l:
             break
+
+    if r < l and mismatches > 0:
+        ranges = bwm_mismatch_ranges(bwt_fmindex, query, mismatches)
+        if ranges:
+            return ranges[0][:2]
     return l, r + 1
 
+
+# Returns a lower bound of the number of mismatches needed to match each prefix of query.
+# query is scanned from right to left, cutting it into consecutive segments which do not occur in the text. Each
+# such segment needs at least one mismatch, hence the bound for query[0..i] is the number of segments that lie
+# completely within query[0..i].
+#
+# @param the fm-index
+# @param input query text
+# @returns list holding the lower bound for each prefix query[0..i]
+def mismatch_lower_bounds(bwt_fmindex, query):
+    bwt, ssa, checkpoints, first_col = bwt_fmindex[:4]
+    bounds = [0] * len(query)
+    segment_end = len(query) - 1
+    l, r = 0, len(bwt) - 1
+    for i in xrange(len(query) - 1, -1, -1):
+        l = checkpoints.rank(bwt, query[i], l - 1) + count_occurrences(first_col, query[i])
+        r = checkpoints.rank(bwt, query[i], r) + count_occurrences(first_col, query[i]) - 1
+        if r < l:
+            bounds[segment_end] += 1
+            segment_end = i - 1
+            l, r = 0, len(bwt) - 1
+
+    # segments were marked at their end, accumulate them over the prefixes
+    for i in xrange(1, len(query)):
+        bounds[i] += bounds[i - 1]
+    return bounds
+
+
+# Returns the ranges of BWM rows matching query with up to the given number of mismatches.
+# This is a backtracking backward search substituting each query character with any other nucleotide. Partial
+# matches are explored best first, ordered by the mismatches so far plus the lower bound of the mismatches still
+# needed by the rest of the query, hence ranges are found in increasing number of mismatches and branches that
+# cannot succeed are pruned. The search stops after max_work interval extensions, so repetitive queries cannot
+# stall the caller.
+#
+# @param the fm-index
+# @param input query text
+# @param number of mismatches allowed
+# @param maximum number of interval extensions to explore
+# @returns list of (l, r, mismatches) tuples, sorted by number of mismatches
+def bwm_mismatch_ranges(bwt_fmindex, query, mismatches=1, max_work=MISMATCH_SEARCH_BUDGET):
+    bwt, ssa, checkpoints, first_col = bwt_fmindex[:4]
+    bounds = mismatch_lower_bounds(bwt_fmindex, query)
+    ranges = []
+    work = 0
+
+    # partial matches as (lower bound of total mismatches, next query index, l, r, mismatches so far)
+    partial_matches = [(bounds[-1] if query else 0, len(query) - 1, 0, len(bwt) - 1, 0)]
+    while partial_matches:
+        bound, i, l, r, z = heapq.heappop(partial_matches)
+        if bound > mismatches:
+            break
+        if i < 0:
+            ranges.append((l, r + 1, z))
+            continue
+
+        for c in NUCLEOTIDES:
+            nz = z if c == query[i] else z + 1
+            nbound = nz + (bounds[i - 1] if i > 0 else 0)
+            if nbound > mismatches:
+                continue
+            work += 1
+            nl = checkpoints.rank(bwt, c, l - 1) + count_occurrences(first_col, c)
+            nr = checkpoints.rank(bwt, c, r) + count_occurrences(first_col, c) - 1
+            if nl <= nr:
+                heapq.heappush(partial_matches, (nbound, i - 1, nl, nr, nz))
+
+        if work >= max_work:
+            break
+
+    return ranges
+
+# Returns the ranges of BWM rows having each query as a prefix.
+# Queries are searched in lockstep: every iteration advances the intervals of all the queries which are still being
+# searched by one character, using one vectorized rank lookup. Queries whose interval has emptied are dropped.
+# Falls back to bwm_range for queries having non ACGT characters, or when numpy or a packed bwt is not available.
+#
+# @param the fm-index
+# @param list of input query texts
+# @returns list of bwm rows ranges, in the same order as the queries
+def bwm_range_batch(bwt_fmindex, queries):
+    bwt, ssa, checkpoints, first_col = bwt_fmindex[:4]
+    if np is None or not isinstance(bwt, PackedBwt):
+        return [bwm_range(bwt_fmindex, query, mismatches=0) for query in queries]
+
+    ranges = [None] * len(queries)
+    batch = []
+    for i, query in enumerate(queries):
+        if len(query) == 0 or NON_NUCLEOTIDE_REGEX.search(query):
+            ranges[i] = bwm_range(bwt_fmindex, query, mismatches=0)
+        else:
+            batch.append(i)
+    if not batch:
+        return ranges
+
+    # codes of each query, reversed and left aligned, since search goes from right to left
+    lengths = np.array([len(queries[i]) for i in batch], dtype=np.int64)
+    codes = np.zeros((len(batch), lengths.max()), dtype=np.int64)
+    for j, i in enumerate(batch):
+        codes[j, :lengths[j]] = np.frombuffer(queries[i][::-1].translate(CODE_TABLE), dtype=np.uint8)
+    occurrences = np.array([count_occurrences(first_col, c) for c in NUCLEOTIDES], dtype=np.int64)
+
+    l = np.zeros(len(batch), dtype=np.int64)
+    r = np.full(len(batch), len(bwt) - 1, dtype=np.int64)
+    # column each query starts being searched from
+    start = np.zeros(len(batch), dtype=np.int64)
+
+    # start from the interval of the last k characters when a k-mer table is available
+    kmers = kmer_table(bwt_fmindex)
+    if kmers is not None and kmers.k <= codes.shape[1]:
+        has_kmer = np.flatnonzero(lengths >= kmers.k)
+        kmer_codes = (codes[has_kmer, :kmers.k] << (2 * np.arange(kmers.k))).sum(axis=1)
+        intervals = as_numpy(kmers.intervals, np.uint32 if kmers.intervals.itemsize == 4 else np.uint64)
+        l[has_kmer] = intervals[2 * kmer_codes]
+        r[has_kmer] = intervals[2 * kmer_codes + 1].astype(np.int64) - 1
+        start[has_kmer] = kmers.k
+
+    active = np.arange(len(batch))
+    column = 0
+    while len(active) > 0:
+        step = active[start[active] <= column]
+        c = codes[step, column]
+        l[step] = bwt.rank_batch(c, l[step] - 1) + occurrences[c]
+        r[step] = bwt.rank_batch(c, r[step]) + occurrences[c] - 1
+        column += 1
+        active = active[(r[active] >= l[active]) & (lengths[active] > column)]
+
+    for j, i in enumerate(batch):
+        ranges[i] = int(l[j]), int(r[j]) + 1
+    return ranges
+
+
+# Returns the longest suffix of query occurring in the text, i.e. the longest exact match ending at the end of query,
+# together with its range of BWM rows
+#
+# @param the fm-index
+# @param input query text
+# @returns tuple of start of the longest occurring suffix in query and its bwm rows range, the range of all rows for an
+# empty suffix
+def bwm_longest_suffix(bwt_fmindex, query):
+    bwt, ssa, checkpoints, first_col = bwt_fmindex[:4]
+    l, r = 0, len(bwt) - 1
+    for i in xrange(len(query) - 1, -1, -1):  # from right to left
+        nl = checkpoints.rank(bwt, query[i], l - 1) + count_occurrences(first_col, query[i])
+        nr = checkpoints.rank(bwt, query[i], r) + count_occurrences(first_col, query[i]) - 1
+        if nr < nl:
+            return i + 1, l, r + 1
+        l, r = nl, nr
+    return 0, l, r + 1
+
+
+# Returns the longest occurring suffix of each query, searching queries in lockstep as bwm_range_batch does, each
+# query leaving the batch once its next character would empty its interval. The k-mer table is not used, since the
+# longest suffix may be shorter than k.
+#
+# @param the fm-index
+# @param list of input query texts
+# @returns list of tuples as returned by bwm_longest_suffix, in the same order as the queries
+def bwm_longest_suffix_batch(bwt_fmindex, queries):
+    bwt, ssa, checkpoints, first_col = bwt_fmindex[:4]
+    if np is None or not isinstance(bwt, PackedBwt):
+        return [bwm_longest_suffix(bwt_fmindex, query) for query in queries]
+
+    matches = [None] * len(queries)
+    batch = []
+    for i, query in enumerate(queries):
+        if len(query) == 0 or NON_NUCLEOTIDE_REGEX.search(query):
+            matches[i] = bwm_longest_suffix(bwt_fmindex, query)
+        else:
+            batch.append(i)
+    if not batch:
+        return matches
+
+    # codes of each query, reversed and left aligned, since search goes from right to left
+    lengths = np.array([len(queries[i]) for i in batch], dtype=np.int64)
+    codes = np.zeros((len(batch), lengths.max()), dtype=np.int64)
+    for j, i in enumerate(batch):
+        codes[j, :lengths[j]] = np.frombuffer(queries[i][::-1].translate(CODE_TABLE), dtype=np.uint8)
+    occurrences = np.array([count_occurrences(first_col, c) for c in NUCLEOTIDES], dtype=np.int64)
+
+    l = np.zeros(len(batch), dtype=np.int64)
+    r = np.full(len(batch), len(bwt) - 1, dtype=np.int64)
+    # number of characters matched by each query
+    matched = np.zeros(len(batch), dtype=np.int64)
+
+    active = np.arange(len(batch))
+    column = 0
+    while len(active) > 0:
+        c = codes[active, column]
+        nl = bwt.rank_batch(c, l[active] - 1) + occurrences[c]
+        nr = bwt.rank_batch(c, r[active]) + occurrences[c] - 1
+        extended = nr >= nl
+        active = active[extended]
+        l[active] = nl[extended]
+        r[active] = nr[extended]
+        column += 1
+        matched[active] = column
+        active = active[lengths[active] > column]
+
+    for j, i in enumerate(batch):
+        matches[i] = int(lengths[j] - matched[j]), int(l[j]), int(r[j]) + 1
+    return matches
+
+
 # Returns the offset of a BWM row wrt to original text t
 #
 # @param the fm-index
 # @param bwm row
 # @returns the offset of the BWM row in fm-index
 def resolve(bwt_fmindex, row):
-    bwt, ssa, checkpoints, first_col = bwt_fmindex
+    bwt, ssa, checkpoints, first_col = bwt_fmindex[:4]
 
     # move left according to character in given BWT row
     def stepLeft(row):
@@ -192,7 +464,54 @@ def resolve(bwt_fmindex, row):
     while row not in ssa:
         row = stepLeft(row)
         nsteps += 1
-    return ssa[row] + nsteps
+    # stepping left from offset 0 wraps around to the end of the text, which may happen when sampling by row
+    return (ssa[row] + nsteps) % len(bwt)
+
+
+# Returns the bwm rows to locate within the given ranges, capped to max_occurrences rows. Rows are either taken in
+# order, hence favouring the ranges with fewer mismatches, or sampled at random
+#
+# @param list of (l, r, mismatches) tuples
+# @param maximum number of rows to return, None for no limit
+# @param whether rows are sampled at random once there are more than max_occurrences
+# @returns list of (row, mismatches) tuples
+def sample_rows(ranges, max_occurrences=None, random_sample=False):
+    total = sum(r - l for l, r, z in ranges)
+    if max_occurrences is None or total <= max_occurrences:
+        return [(x, z) for l, r, z in ranges for x in xrange(l, r)]
+
+    if random_sample:
+        picks = sorted(random.sample(xrange(total), max_occurrences))
+    else:
+        picks = xrange(max_occurrences)
+
+    rows = []
+    skipped = 0
+    ranges = iter(ranges)
+    l, r, z = next(ranges)
+    for pick in picks:
+        while pick - skipped >= r - l:
+            skipped += r - l
+            l, r, z = next(ranges)
+        rows.append((l + pick - skipped, z))
+    return rows
+
+
+# Returns offsets and number of mismatches for all occurrences of query based on the supplied BWT FM-Index
+#
+# @param query to search for
+# @param the fm-index
+# @param number of mismatches allowed
+# @param maximum number of occurrences to locate, None for no limit
+# @param whether occurrences are sampled at random once there are more than max_occurrences
+# @returns list of (offset, mismatches) tuples for all occurrences of query searching for
+def all_hits(query, bwt_fmindex, mismatches=1, max_occurrences=None, random_sample=False):
+    if mismatches > 0:
+        ranges = bwm_mismatch_ranges(bwt_fmindex, query, mismatches)
+    else:
+        ranges = [bwm_range(bwt_fmindex, query, mismatches=0) + (0,)]
+    ranges = [(l, r, z) for l, r, z in ranges if l < r]
+    return [(resolve(bwt_fmindex, x), z) for x, z in sample_rows(ranges, max_occurrences, random_sample)]
 
 
 # Returns offsets for all occurrences of query based on the supplied BWT FM-Index
@@ -200,10 +519,30 @@ def resolve(bwt_fmindex, row):
 # @param query to search for
 # @param the fm-index
 # @param number of mismatches allowed
+# @param maximum number of occurrences to locate, None for no limit
+# @param whether occurrences are sampled at random once there are more than max_occurrences
 # @returns the offsets for all occurrences of query searching for
-def all_occurrences(query, bwt_fmindex, mismatches=1):
-    l, r = bwm_range(bwt_fmindex, query, mismatches)
-    return [resolve(bwt_fmindex, x) for x in xrange(l, r)]
+def all_occurrences(query, bwt_fmindex, mismatches=1, max_occurrences=None, random_sample=False):
+    return [offset for offset, z in all_hits(query, bwt_fmindex, mismatches, max_occurrences, random_sample)]
+
+
+# Returns the offset and number of mismatches for the first, closest occurrence of query
+#
+# @param query to search for
+# @param the fm-index
+# @param number of mismatches allowed
+# @returns tuple of offset and mismatches for first occurrence of query searching for, (-1, None) if not found
+def first_hit(query, bwt_fmindex, mismatches=1):
+    l, r = bwm_range(bwt_fmindex, query, mismatches=0)
+    if l < r:
+        return resolve(bwt_fmindex, l), 0
+    if mismatches > 0:
+        ranges = bwm_mismatch_ranges(bwt_fmindex, query, mismatches)
+        if ranges:
+            l, r, z = ranges[0]
+            return resolve(bwt_fmindex, l), z
+    return -1, None  # no occurrence
+
 
 # Returns the offset for first occurrence of query based on the supplied BWT FM-Index.
 #
@@ -212,9 +551,94 @@ def all_occurrences(query, bwt_fmindex, mismatches=1):
 # @param number of mismatches allowed
 # @returns the offsets for first occurrence of query searching for
 def first_occurrence(query, bwt_fmindex, mismatches=1):
-    l, r = bwm_range(bwt_fmindex, query, mismatches)
-    if l >= r:
-        return -1  # no occurrence
-    else:
-        # just first occurrence
-        return resolve(bwt_fmindex, l)
+    return first_hit(query, bwt_fmindex, mismatches)[0]
+
+
+# Returns the offset and number of mismatches for the first, closest occurrence of each query. Queries are first
+# searched exactly in lockstep via bwm_range_batch and only those which do not occur exactly are searched again
+# allowing mismatches
+#
+# @param list of queries to search for
+# @param the fm-index
+# @param number of mismatches allowed
+# @returns list of (offset, mismatches) tuples for each query, (-1, None) where the query does not occur
+def first_hit_batch(queries, bwt_fmindex, mismatches=0):
+    hits = []
+    for query, (l, r) in zip(queries, bwm_range_batch(bwt_fmindex, queries)):
+        if l < r:
+            hits.append((resolve(bwt_fmindex, l), 0))
+        else:
+            ranges = bwm_mismatch_ranges(bwt_fmindex, query, mismatches) if mismatches > 0 else []
+            if ranges:
+                l, r, z = ranges[0]
+                hits.append((resolve(bwt_fmindex, l), z))
+            else:
+                hits.append((-1, None))  # no occurrence
+    return hits
+
+
+# Returns the reverse complement of a sequence
+def reverse_complement(text):
+    return text[::-1].translate(COMPLEMENT_TABLE)
+
+
+# Returns the text of a both strands index, i.e. the forward strand followed by its reverse complement. A query
+# occurring on the reverse strand occurs as is in the second half, hence a single backward search over this text
+# finds the occurrences on both strands at once
+#
+# @param forward strand text
+# @returns text to index
+def both_strands_text(input_text):
+    return input_text + reverse_complement(input_text)
+
+
+# Maps the offset of an occurrence in the text of a both strands index to the forward strand
+#
+# @param offset in the both strands text
+# @param query length
+# @param length of the forward strand, None if the index holds the forward strand only
+# @returns tuple of the forward strand offset of the occurrence and whether the query occurs on the reverse strand,
+# i.e. its reverse complement occurs at that offset. None if the occurrence spans both halves of the text
+def forward_strand_hit(offset, length, forward_length=None):
+    if forward_length is None or offset + length <= forward_length:
+        return offset, False
+    if offset >= forward_length:
+        return 2 * forward_length - offset - length, True
+    return None
+
+
+# Returns the offset, number of mismatches and strand for the first, closest occurrence of each query. Queries are
+# searched as by first_hit_batch, occurrences on the reverse strand being found by the same search when the index is
+# built over both_strands_text
+#
+# @param list of queries to search for
+# @param the fm-index
+# @param length of the forward strand for a both strands index, None if the index holds the forward strand only
+# @param number of mismatches allowed
+# @returns list of (offset, mismatches, reverse) tuples for each query, the offset being that of the query or of its
+# reverse complement on the forward strand, (-1, None, None) where the query does not occur
+def first_hit_stranded_batch(queries, bwt_fmindex, forward_length=None, mismatches=0):
+    hits = []
+    for query, (l, r) in zip(queries, bwm_range_batch(bwt_fmindex, queries)):
+        if l < r:
+            ranges = [(l, r, 0)]
+        else:
+            ranges = bwm_mismatch_ranges(bwt_fmindex, query, mismatches) if mismatches > 0 else []
+        hits.append((-1, None, None))  # no occurrence
+        # only the few occurrences spanning both halves of the text are skipped
+        for row, z in ((row, z) for l, r, z in ranges for row in xrange(l, r)):
+            hit = forward_strand_hit(resolve(bwt_fmindex, row), len(query), forward_length)
+            if hit is not None:
+                hits[-1] = hit[0], z, hit[1]
+                break
+    return hits
+
+
+# Returns the offset for first occurrence of each query, searching all queries in lockstep via bwm_range_batch
+#
+# @param list of queries to search for
+# @param the fm-index
+# @param number of mismatches allowed
+# @returns list of offsets for first occurrence of each query, -1 where the query does not occur
+def first_occurrence_batch(queries, bwt_fmindex, mismatches=0):
+    return [offset for offset, z in first_hit_batch(queries, bwt_fmindex, mismatches)]
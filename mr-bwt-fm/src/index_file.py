@@ -0,0 +1,269 @@
+from array import array
+from bisect import bisect_left
+import json
+import mmap
+import struct
+import sys
+from kmer_table import KmerTable
+from locate import SampledSuffixArray
+from packed_bwt import PackedBwt, PackedFmCheckpoints, np
+
+# Binary, memory-mapped FM-Index file format.
+#
+# The file starts with a fixed header: magic, format version and number of sections, followed by a section table
+# holding the name, offset and size in bytes of every section. All numbers are little endian and sections are
+# 8 byte aligned, hence each array section can be used in place straight from the mapped file:
+# -- META     json encoded scalars: text length, checkpoint interval, suffix array sampling, first column etc.
+# -- BWT      packed bwt blocks, each holding ACGT checkpoint counts followed by 16 characters per uint32
+# -- EXCPOS   uint64 bwt rows of non ACGT characters
+# -- EXCCHR   non ACGT characters at the rows in EXCPOS
+# -- EXCCPS   uint64 per character checkpoints over EXCCHR
+# -- SSABITS  uint32 bitvector marking the sampled bwt rows, empty when sampling by row
+# -- SSARCPS  uint64 rank checkpoints of SSABITS
+# -- SSAVALS  uint32, or uint64 for texts longer than 4G, sampled suffix array entries in row order
+# -- KMERS    optional, uint32, or uint64 for texts longer than 4G, (l, r) bwm interval pairs of every k-mer
+#
+# Version 1 files held the sampled suffix array as SSAROWS, uint64 sorted sampled rows, and SSAVALS, uint64 entries
+# in the same order. These are still readable.
+INDEX_FILE_MAGIC = 'BWTFMIDX'
+INDEX_FILE_VERSION = 2
+SUPPORTED_INDEX_FILE_VERSIONS = (1, 2)
+HEADER_FORMAT = '<8sII'
+SECTION_FORMAT = '<8sQQ'
+SECTION_ALIGNMENT = 8
+
+# struct formats of the fixed width array sections
+UINT32 = 'I'
+UINT64 = 'Q'
+
+
+# Sequence of fixed width unsigned integers read in place from a memory-mapped file
+class MappedArray(object):
+    def __init__(self, buf, offset, size, fmt):
+        self.buf = buf
+        self.offset = offset
+        self.fmt = '<' + fmt
+        self.itemsize = struct.calcsize(self.fmt)
+        self.length = size // self.itemsize
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.length)
+            if step != 1:
+                raise ValueError('Only contiguous slices are supported')
+            count = max(0, stop - start)
+            return struct.unpack_from('<{0}{1}'.format(count, self.fmt[1:]), self.buf,
+                                      self.offset + start * self.itemsize)
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('MappedArray index out of range')
+        return struct.unpack_from(self.fmt, self.buf, self.offset + i * self.itemsize)[0]
+
+    # Returns a read-only numpy view over the mapped data, used by the vectorized batch queries
+    def to_numpy(self):
+        return np.frombuffer(self.buf, dtype=np.dtype(self.fmt), count=self.length, offset=self.offset)
+
+
+# Byte string read in place from a memory-mapped file
+class MappedBytes(object):
+    def __init__(self, buf, offset, size):
+        self.buf = buf
+        self.offset = offset
+        self.length = size
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.length)
+            if step != 1:
+                raise ValueError('Only contiguous slices are supported')
+            return self.buf[self.offset + start:self.offset + max(start, stop)]
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('MappedBytes index out of range')
+        return self.buf[self.offset + i]
+
+
+# Downsampled suffix array of version 1 index files, backed by sorted sampled rows, exposing the same lookups as the
+# ssa dict
+class MappedSampledSuffixArray(object):
+    def __init__(self, rows, values):
+        self.rows = rows
+        self.values = values
+
+    def __len__(self):
+        return len(self.rows)
+
+    # Returns the index of row in the sampled rows, -1 if row is not sampled
+    def find(self, row):
+        i = bisect_left(self.rows, row)
+        if i < len(self.rows) and self.rows[i] == row:
+            return i
+        return -1
+
+    def __contains__(self, row):
+        return self.find(row) >= 0
+
+    def __getitem__(self, row):
+        i = self.find(row)
+        if i < 0:
+            raise KeyError(row)
+        return self.values[i]
+
+
+# Serializes the values to little endian bytes of the given fixed width format
+#
+# @param integer values
+# @param struct format of each value
+# @returns the serialized values
+def pack_values(values, fmt):
+    if fmt == UINT32:
+        packed = array('I', values)
+    else:
+        packed = array('L', values)
+    if packed.itemsize != struct.calcsize(fmt):
+        return struct.pack('<{0}{1}'.format(len(values), fmt), *values)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return packed.tostring()
+
+
+# Checks whether the given file is an FM-Index file in this format
+#
+# @param filename
+# @returns True if file starts with the index magic, False otherwise
+def is_index_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(INDEX_FILE_MAGIC)) == INDEX_FILE_MAGIC
+
+
+# Writes the FM-Index to file
+#
+# @param filename to write to
+# @param index data as returned by bwt_fmindex.make_index
+def save_index(filename, idx):
+    bwt, ssa, checkpoints, first_col = idx[:4]
+    kmers = idx[4] if len(idx) > 4 else None
+    if not isinstance(bwt, PackedBwt):
+        bwt = PackedBwt(bwt, checkpoints.cpIval)
+    if not isinstance(ssa, SampledSuffixArray):
+        ssa = SampledSuffixArray.from_dict(ssa, len(bwt))
+
+    ssa_values_format = UINT32 if ssa.values.itemsize == 4 else UINT64
+    meta = {
+        'length': len(bwt),
+        'cpIval': bwt.cpIval,
+        'exception_alphabet': bwt.exception_alphabet,
+        'ssa_ival': ssa.ival,
+        'ssa_sampling': ssa.sampling,
+        'ssa_values_format': ssa_values_format,
+        'first_col': first_col
+    }
+    if kmers is not None:
+        meta['kmer_k'] = kmers.k
+        meta['kmer_format'] = UINT32 if kmers.intervals.itemsize == 4 else UINT64
+
+    sections = [
+        ('META', json.dumps(meta, sort_keys=True)),
+        ('BWT', pack_values(bwt.words, UINT32)),
+        ('EXCPOS', pack_values(bwt.exception_positions, UINT64)),
+        ('EXCCHR', str(bwt.exception_chars[:])),
+        ('EXCCPS', pack_values(bwt.exception_cps, UINT64)),
+        ('SSABITS', pack_values(ssa.bits, UINT32)),
+        ('SSARCPS', pack_values(ssa.rank_cps, UINT64)),
+        ('SSAVALS', pack_values(ssa.values, ssa_values_format))
+    ]
+    if kmers is not None:
+        sections.append(('KMERS', pack_values(kmers.intervals, meta['kmer_format'])))
+    write_sections(filename, sections)
+
+
+# Writes the header, section table and sections
+#
+# @param filename to write to
+# @param list of (name, data) tuples
+# @param file magic, e.g. that of reference.py files which share this layout
+# @param file format version
+def write_sections(filename, sections, magic=INDEX_FILE_MAGIC, version=INDEX_FILE_VERSION):
+    def align(offset):
+        return (offset + SECTION_ALIGNMENT - 1) // SECTION_ALIGNMENT * SECTION_ALIGNMENT
+
+    offset = align(struct.calcsize(HEADER_FORMAT) + len(sections) * struct.calcsize(SECTION_FORMAT))
+    table = []
+    for name, data in sections:
+        table.append((name, offset, len(data)))
+        offset = align(offset + len(data))
+
+    with open(filename, 'wb') as f:
+        f.write(struct.pack(HEADER_FORMAT, magic, version, len(sections)))
+        for name, offset, size in table:
+            f.write(struct.pack(SECTION_FORMAT, name, offset, size))
+        for (name, offset, size), (_, data) in zip(table, sections):
+            f.write('\0' * (offset - f.tell()))
+            f.write(data)
+
+
+# Maps the index file to memory and reads its section table
+#
+# @param filename to read from
+# @param expected file magic
+# @param supported file format versions
+# @returns tuple of mapped buffer, file format version and dict of section name to (offset, size)
+def map_sections(filename, expected_magic=INDEX_FILE_MAGIC, supported_versions=SUPPORTED_INDEX_FILE_VERSIONS):
+    with open(filename, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, nsections = struct.unpack_from(HEADER_FORMAT, buf, 0)
+    if magic != expected_magic:
+        raise ValueError('{0} is not a {1} file'.format(filename, expected_magic))
+    if version not in supported_versions:
+        raise ValueError('{0} has unsupported file version {1}'.format(filename, version))
+
+    sections = {}
+    for i in xrange(nsections):
+        name, offset, size = struct.unpack_from(
+            SECTION_FORMAT, buf, struct.calcsize(HEADER_FORMAT) + i * struct.calcsize(SECTION_FORMAT))
+        sections[name.rstrip('\0')] = offset, size
+    return buf, version, sections
+
+
+# Opens the FM-Index file via mmap. Data is read in place, hence loading takes constant time and concurrent
+# processes share the same pages in the OS page cache
+#
+# @param filename to read from
+# @returns a tuple of (bwt, ssa, checkpoints, first_col), followed by the k-mer table if the file holds one, as
+# returned by bwt_fmindex.make_index
+def load_index(filename):
+    buf, version, sections = map_sections(filename)
+
+    def mapped_array(name, fmt):
+        offset, size = sections[name]
+        return MappedArray(buf, offset, size, fmt)
+
+    meta_offset, meta_size = sections['META']
+    meta = json.loads(buf[meta_offset:meta_offset + meta_size])
+    first_col = dict((str(c), count) for c, count in meta['first_col'].iteritems())
+
+    excchr_offset, excchr_size = sections['EXCCHR']
+    bwt = PackedBwt.from_data(meta['length'], meta['cpIval'], mapped_array('BWT', UINT32),
+                              mapped_array('EXCPOS', UINT64), MappedBytes(buf, excchr_offset, excchr_size),
+                              str(meta['exception_alphabet']), mapped_array('EXCCPS', UINT64))
+    checkpoints = PackedFmCheckpoints(bwt)
+    if version == 1:
+        ssa = MappedSampledSuffixArray(mapped_array('SSAROWS', UINT64), mapped_array('SSAVALS', UINT64))
+    else:
+        ssa = SampledSuffixArray.from_data(meta['length'], meta['ssa_ival'], str(meta['ssa_sampling']),
+                                           mapped_array('SSAVALS', str(meta['ssa_values_format'])),
+                                           mapped_array('SSABITS', UINT32), mapped_array('SSARCPS', UINT64))
+
+    if 'KMERS' in sections:
+        kmers = KmerTable.from_data(meta['kmer_k'], mapped_array('KMERS', str(meta['kmer_format'])))
+        return bwt, ssa, checkpoints, first_col, kmers
+    return bwt, ssa, checkpoints, first_col
@@ -0,0 +1,83 @@
+from array import array
+from packed_bwt import NUCLEOTIDES, CODE_TABLE, NON_NUCLEOTIDE_REGEX, np
+
+
+# Returns the array typecode able to hold bwm rows of a bwt of given length
+def rows_typecode(length):
+    return 'I' if length < 2 ** 32 else 'L'
+
+
+# Lookup table holding the BWM interval of every k-mer over ACGT, so a backward search can start from the interval of
+# the last k characters of a query instead of narrowing it down from the whole BWM one character at a time.
+#
+# k-mers are numbered by their 2 bit codes, first character being the most significant, and their intervals are kept
+# in a flat array as consecutive (l, r) pairs, r being exclusive. A k-mer which does not occur has l >= r.
+class KmerTable(object):
+    # Builds the table by extending all the (j - 1)-mers intervals to the left with each nucleotide, for j up to k
+    #
+    # @param length of k-mers
+    # @param the bwt
+    # @param rank checkpoints
+    # @param number of occurrences of characters < c, for each nucleotide c
+    def __init__(self, k, bwt, checkpoints, occurrences):
+        self.k = k
+
+        if np is not None and hasattr(bwt, 'rank_batch'):
+            l = np.zeros(1, dtype=np.int64)
+            r = np.full(1, len(bwt) - 1, dtype=np.int64)
+            for j in xrange(k):
+                next_l, next_r = [], []
+                for code in xrange(len(NUCLEOTIDES)):
+                    codes = np.full(len(l), code, dtype=np.int64)
+                    next_l.append(bwt.rank_batch(codes, l - 1) + occurrences[code])
+                    next_r.append(bwt.rank_batch(codes, r) + occurrences[code] - 1)
+                # prepending a character makes it the most significant, hence its k-mers come as a whole block
+                l = np.concatenate(next_l)
+                r = np.concatenate(next_r)
+            self.intervals = array(rows_typecode(len(bwt)))
+            intervals = np.empty(2 * len(l), dtype=np.dtype(self.intervals.typecode))
+            intervals[0::2] = l
+            intervals[1::2] = r + 1
+            self.intervals.fromstring(intervals.tostring())
+        else:
+            l, r = [0], [len(bwt) - 1]
+            for j in xrange(k):
+                next_l, next_r = [], []
+                for code, c in enumerate(NUCLEOTIDES):
+                    next_l.extend(checkpoints.rank(bwt, c, x - 1) + occurrences[code] for x in l)
+                    next_r.extend(checkpoints.rank(bwt, c, x) + occurrences[code] - 1 for x in r)
+                l, r = next_l, next_r
+            self.intervals = array(rows_typecode(len(bwt)))
+            for x, y in zip(l, r):
+                self.intervals.append(x)
+                self.intervals.append(y + 1)
+
+    # Recreates a k-mer table from its already built intervals, e.g. a section of a memory-mapped index file
+    @classmethod
+    def from_data(cls, k, intervals):
+        table = cls.__new__(cls)
+        table.k = k
+        table.intervals = intervals
+        return table
+
+    # Returns the code of the given k-mer
+    def kmer_code(self, kmer):
+        code = 0
+        for c in kmer.translate(CODE_TABLE):
+            code = (code << 2) | ord(c)
+        return code
+
+    # Returns the interval of the last k characters of query
+    #
+    # @param input query text
+    # @returns tuple of l and r, r being exclusive, or None if query is shorter than k or its last k characters
+    # are not all ACGT
+    def lookup(self, query):
+        if len(query) < self.k:
+            return None
+        kmer = query[len(query) - self.k:]
+        if NON_NUCLEOTIDE_REGEX.search(kmer):
+            return None
+        code = self.kmer_code(kmer)
+        return self.intervals[2 * code], self.intervals[2 * code + 1]
+
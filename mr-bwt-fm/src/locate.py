@@ -0,0 +1,109 @@
+from array import array
+from packed_bwt import popcount
+
+# Sampled suffix array and helpers used to locate the text offsets of BWM rows.
+#
+# Two sampling strategies are supported, trading space for locate time:
+# -- 'text' samples the rows whose suffix array entry is a multiple of the interval. At most interval - 1 LF steps
+#    are needed to locate any row, however sampled rows are scattered, hence they are marked in a bitvector and the
+#    sampled values are looked up by ranking the bitvector.
+# -- 'row' samples every interval-th row. No bitvector is needed, however the number of LF steps to reach a sampled
+#    row is not bounded.
+SSA_SAMPLINGS = ('text', 'row')
+# bits per bitvector word
+BITS_PER_WORD = 32
+# words per bitvector rank checkpoint
+WORDS_PER_RANK_CP = 8
+
+
+# Returns the array typecode able to hold suffix array values of a text of given length
+def values_typecode(length):
+    return 'I' if length < 2 ** 32 else 'L'
+
+
+# Downsampled suffix array exposing the same lookups as a dict keyed by bwm row, i.e. `row in ssa` and `ssa[row]`
+class SampledSuffixArray(object):
+    def __init__(self, sa, ival=32, sampling='text'):
+        if sampling not in SSA_SAMPLINGS:
+            raise ValueError('Unknown suffix array sampling {0}'.format(sampling))
+
+        self.length = len(sa)
+        self.ival = ival
+        self.sampling = sampling
+        self.values = array(values_typecode(self.length))
+        self.bits = array('I')
+        self.rank_cps = array('L')
+
+        if sampling == 'row':
+            for row in xrange(0, self.length, ival):
+                self.values.append(sa[row])
+        else:
+            self.init_bitvector(row for row in xrange(self.length) if sa[row] % ival == 0)
+            for row in xrange(self.length):
+                if sa[row] % ival == 0:
+                    self.values.append(sa[row])
+
+    # Recreates a text sampled suffix array from a dict of row to suffix array entry, as returned by
+    # bwt_fmindex.downsample_suffix_array
+    @classmethod
+    def from_dict(cls, ssa, length, ival=32):
+        sampled_sa = cls.from_data(length, ival, 'text', array(values_typecode(length)), array('I'), array('L'))
+        rows = sorted(ssa.iterkeys())
+        sampled_sa.init_bitvector(rows)
+        sampled_sa.values.extend(ssa[row] for row in rows)
+        return sampled_sa
+
+    # Recreates a sampled suffix array from its already built data structures, e.g. sections of a memory-mapped
+    # index file
+    @classmethod
+    def from_data(cls, length, ival, sampling, values, bits, rank_cps):
+        sampled_sa = cls.__new__(cls)
+        sampled_sa.length = length
+        sampled_sa.ival = ival
+        sampled_sa.sampling = sampling
+        sampled_sa.values = values
+        sampled_sa.bits = bits
+        sampled_sa.rank_cps = rank_cps
+        return sampled_sa
+
+    # Builds the bitvector marking the sampled rows, together with its rank checkpoints
+    #
+    # @param sampled rows in increasing order
+    def init_bitvector(self, rows):
+        nwords = (self.length + BITS_PER_WORD - 1) // BITS_PER_WORD
+        self.bits = array('I', [0]) * nwords
+        for row in rows:
+            self.bits[row // BITS_PER_WORD] |= 1 << (row % BITS_PER_WORD)
+
+        self.rank_cps = array('L')
+        total = 0
+        for i in xrange(nwords):
+            if (i % WORDS_PER_RANK_CP) == 0:
+                self.rank_cps.append(total)
+            total += popcount(self.bits[i])
+
+    def __len__(self):
+        return len(self.values)
+
+    # Returns the number of sampled rows before row
+    def sampled_rank(self, row):
+        word = row // BITS_PER_WORD
+        cp = word // WORDS_PER_RANK_CP
+        nsampled = self.rank_cps[cp]
+        for i in xrange(cp * WORDS_PER_RANK_CP, word):
+            nsampled += popcount(self.bits[i])
+        return nsampled + popcount(self.bits[word] & ((1 << (row % BITS_PER_WORD)) - 1))
+
+    def __contains__(self, row):
+        if not 0 <= row < self.length:
+            return False
+        if self.sampling == 'row':
+            return row % self.ival == 0
+        return (self.bits[row // BITS_PER_WORD] >> (row % BITS_PER_WORD)) & 1 == 1
+
+    def __getitem__(self, row):
+        if row not in self:
+            raise KeyError(row)
+        if self.sampling == 'row':
+            return self.values[row // self.ival]
+        return self.values[self.sampled_rank(row)]
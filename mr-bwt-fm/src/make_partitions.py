@@ -0,0 +1,20 @@
+#!/usr/bin/python
+from mrcommon import partitions
+import reference
+from utils import ENV_PREFIX
+
+# Writes the partition file of the hadoop TotalOrderPartitioner for the MR-BWT-FM job, see mrcommon.partitions. Split
+# keys spread over the reference genome coordinates follow the contig lengths of its packed or fasta reference.
+
+
+# Reads the length of each contig of the reference genome
+#
+# @param packed reference or fasta filename, e.g. hg38_ref
+# @returns list of lengths, in reference order
+def read_contig_lengths(filename):
+    return reference.open_reference(filename).contig_lengths()
+
+
+if __name__ == '__main__':
+    partitions.main(ENV_PREFIX, read_contig_lengths, '--reference', '/data/index/hg38_ref',
+                    'packed reference or fasta reference genome, used for its contig lengths')
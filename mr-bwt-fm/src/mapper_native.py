@@ -1,43 +1,134 @@
 #!/usr/bin/python
+import multiprocessing
 import pickle
 import time
 import sys
 import bwt_fmindex
-from utils import query_bps_count_index, logger
-
-
-# Loads the binary serialized index file
+from itertools import chain, islice
+import index_file
+from mrcommon.pileup import Pileup
+from pileup import FlushingPileup
+import reference
+import seeding
+from mrcommon.records import RecordWriter, bin_size, record_format
+from utils import logger, env_flag, ENV_PREFIX, env_int, MR_READS_SEPARATOR
+
+# number of reads searched together in lockstep by the fm-index
+READS_CHUNK_SIZE = 4096
+# number of chunks handed out to each worker process at a time
+CHUNKS_PER_WORKER = 2
+
+# fm-index, reference genome and pileup block size used by align_chunk. These are set before worker processes are
+# forked, hence workers share the same read-only index and reference mappings and count in blocks matching those of
+# the main pileup
+aligner_index = None
+aligner_reference = None
+# length of the forward strand when the fm-index has been built over both strands, None otherwise
+aligner_forward_length = None
+aligner_block_size = None
+# whether reads which do not occur exactly are aligned by seeding.align_batch, rather than searched again allowing
+# mismatches
+aligner_seeding = False
+
+
+# Loads the binary index file. Index files in the memory-mapped format are mapped in place, while older
+# pickled index files are deserialized
 #
 # @param index filename
 # @returns the binary index
 def load_serialized_file(filename):
+    if index_file.is_index_file(filename):
+        return index_file.load_index(filename)
     f = open(filename)
     idx = pickle.load(f)
     return idx
 
 
-# Loads reference genome file
+# Loads reference genome file, i.e. the packed reference written by build_index.py --reference-output, or a fasta file
 #
 # @param reference genome filename
-# @returns the reference genome text
+# @returns the reference.Reference
 def read_reference_genome(filename):
-    text_file = open(filename, 'r')
-    genome = text_file.read()
-    text_file.close()
-    return genome
+    return reference.open_reference(filename)
 
 
-# Reads the input data
+# Reads the input data, each line holding a read or a batch of reads separated by MR_READS_SEPARATOR
 #
 # @param input reads
 # @returns one read at a time
 def read_input(data_input):
-    for line in data_input:
-        # Go through each line
-        yield line.rstrip()
+    # Go through each line, splitting batches in bulk
+    return chain.from_iterable(line.rstrip().split(MR_READS_SEPARATOR) for line in data_input)
+
+
+# Groups the input reads in chunks
+#
+# @param input reads
+# @param number of reads per chunk
+# @returns one list of reads at a time
+def read_input_chunks(data_input, chunk_size=READS_CHUNK_SIZE):
+    reads = read_input(data_input)
+    while True:
+        chunk = list(islice(reads, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+
+# Aligns a chunk of reads and counts the aligned bases per reference position
+#
+# @param list of reads
+# @param pileup to add counts to, None to count in a new pileup
+# @returns tuple of
+# -- dict of pileup block id to ACGTDN counts, empty if counts were added to the given pileup
+# -- dict of pileup insertions to ACGTDN counts, empty if counts were added to the given pileup
+# -- dict of number of aligned reads per number of mismatches
+# -- number of reads aligned by seed and extend
+def align_chunk(reads, pileup=None):
+    chunk_pileup = Pileup(block_size=aligner_block_size) if pileup is None else pileup
+    mismatches_counts = dict()
+    unaligned_reads = []
+
+    # reads are searched on both strands at once when the index has been built over both strands
+    first_hits = bwt_fmindex.first_hit_stranded_batch(reads, bwt_fmindex=aligner_index,
+                                                      forward_length=aligner_forward_length,
+                                                      mismatches=0 if aligner_seeding else 2)
+    for read, (first_occurrence, mismatches, reverse) in zip(reads, first_hits):
+        # hits across the boundary of two contigs are left out
+        if first_occurrence != -1 and aligner_reference.within_contig(first_occurrence, len(read)):
+            mismatches_counts[mismatches] = mismatches_counts.get(mismatches, 0) + 1
+            # reads aligned to the reverse strand are counted by their forward strand bases
+            chunk_pileup.add_run(first_occurrence, bwt_fmindex.reverse_complement(read) if reverse else read)
+        elif aligner_seeding:
+            unaligned_reads.append(read)
+
+    # reads with mismatches or indels are aligned by seed and extend, their deletions and insertions being counted
+    seeded = 0
+    if unaligned_reads:
+        alignments = seeding.align_batch(aligner_index, aligner_reference, unaligned_reads, aligner_forward_length)
+        for read, alignment in zip(unaligned_reads, alignments):
+            if alignment is not None:
+                ref_offset, cigartuples, score, reverse = alignment
+                chunk_pileup.add_alignment(ref_offset, cigartuples,
+                                           bwt_fmindex.reverse_complement(read) if reverse else read)
+                seeded += 1
+
+    if pileup is None:
+        return chunk_pileup.blocks, chunk_pileup.insertions, mismatches_counts, seeded
+    return {}, {}, mismatches_counts, seeded
+
+
+# Returns the number of worker processes aligning reads, as set by the MRBWTFM_WORKERS environment variable.
+# 0 uses one worker per cpu
+def worker_count():
+    workers = env_int('MRBWTFM_WORKERS', 1)
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+    return workers
 
 
 def main(main_separator='\t', tuple_separator=';'):
+    global aligner_index, aligner_reference, aligner_forward_length, aligner_block_size, aligner_seeding
 
     start_time = time.time()
     logger.info('Mapper Start Time: {0}'.format(start_time))
@@ -47,54 +138,80 @@ def main(main_separator='\t', tuple_separator=';'):
     if bwt_fmindex is None:
         logger.error('Error while loading reference FM-Index')
         raise RuntimeError('Error while loading reference FM-Index')
+    aligner_index = bwt_fm_idx
 
-    # load ref genome
-    ref_gen = read_reference_genome('/data/index/hg38.fa')
+    # load ref genome, i.e. the contig sequences the index has been built over
+    ref_gen = read_reference_genome('/data/index/hg38_ref')
     if bwt_fmindex is None:
         logger.error('Error while loading reference genome')
         raise RuntimeError('Error while loading reference genome')
+    if len(bwt_fm_idx[0]) == 2 * len(ref_gen) + 1:
+        # built by build_index.py --both-strands
+        aligner_forward_length = len(ref_gen)
+    elif len(bwt_fm_idx[0]) != len(ref_gen) + 1:
+        logger.error('Reference FM-Index has not been built over the reference genome contigs')
+        raise RuntimeError('Reference FM-Index has not been built over the reference genome contigs, rebuild it with '
+                           'build_index.py')
+    aligner_reference = ref_gen
+    aligner_seeding = env_flag('MRBWTFM_SEEDING')
 
     # load reads
-    input_reads = read_input(sys.stdin)
-
-    # this map should contain all distinct matched ref_index together with the count of matched nucleotides
-    index_alignments_map = dict()
-
-    for read in input_reads:
-        first_occurrence = bwt_fmindex.first_occurrence(read, bwt_fmindex=bwt_fm_idx, mismatches=2)
-        if first_occurrence != -1:
-            ref_index = first_occurrence
-            read_counter = 0
-            for i in range(len(read)):
-                ref_bp = ref_gen[ref_index]
-                query_bp = read[read_counter]
-
-                if ref_index in index_alignments_map:
-                    current_tuple = index_alignments_map[ref_index]
-                    bps_counts = current_tuple[1]
-
-                    bp_list_index = query_bps_count_index(query_bp)
-                    bps_counts[bp_list_index] += 1
-                    index_alignments_map[ref_index] = current_tuple[0], bps_counts
-                else:
-                    # initialize bps counts to 0.
-                    # IT'A MUST USING A LIST SINCE ORDER IS IMPORTANT
-                    bps_counts = [0] * 6
-                    bp_list_index = query_bps_count_index(query_bp)
-                    bps_counts[bp_list_index] += 1
-                    index_alignments_map[ref_index] = ref_bp, bps_counts
-
-                ref_index += 1
-                read_counter += 1
-
-    for ref_index in index_alignments_map.keys():
-        # output format ref_index, ref_char;csv_list of combined counts of ACGTDN
-        ref_char_name_and_read_counts_tuple = index_alignments_map[ref_index]
-        counts_csv = ','.join(str(i) for i in ref_char_name_and_read_counts_tuple[1])
-
-        print '%d%s%s%s%s' % (
-            ref_index, main_separator, ref_char_name_and_read_counts_tuple[0], tuple_separator, counts_csv)
-
+    input_reads_chunks = read_input_chunks(sys.stdin)
+
+    # counts of all aligned bases per reference position, written out once all reads have been aligned.
+    # In streaming mode counts are kept in a bounded window of reference blocks instead, and written out as soon as
+    # blocks are evicted from the window, so output starts early and memory stays flat
+    # When records are binned, each pileup block is written out as the bin records it overlaps, hence blocks are bin
+    # sized
+    binned = bin_size(ENV_PREFIX) > 0
+    aligner_block_size = bin_size(ENV_PREFIX) if binned else env_int('MRBWTFM_BLOCK_SIZE', 256)
+    writer = RecordWriter(sys.stdout, record_format(ENV_PREFIX), main_separator=main_separator,
+                          tuple_separator=tuple_separator)
+    if env_flag('MRBWTFM_STREAMING'):
+        max_rss_mb = env_int('MRBWTFM_MAX_RSS_MB', 0)
+        pileup = FlushingPileup(ref_gen, writer, block_size=aligner_block_size,
+                                max_blocks=env_int('MRBWTFM_MAX_BLOCKS', 16384),
+                                max_rss=max_rss_mb * 1024 * 1024 if max_rss_mb > 0 else None, binned=binned)
+    else:
+        pileup = FlushingPileup(ref_gen, writer, block_size=aligner_block_size, binned=binned)
+
+    # number of aligned reads per number of mismatches, and number of reads aligned by seed and extend
+    mismatches_counts = dict()
+    seeded = 0
+
+    # chunks are aligned by a pool of worker processes, forked after loading the index and reference genome so
+    # these are shared, while this process merges the partial counts returned by the workers
+    workers = worker_count()
+    pool = None
+    if workers > 1:
+        logger.info('Aligning with {0} worker processes'.format(workers))
+        pool = multiprocessing.Pool(workers)
+
+    while True:
+        chunks = list(islice(input_reads_chunks, workers * CHUNKS_PER_WORKER if pool else 1))
+        if not chunks:
+            break
+        results = pool.map(align_chunk, chunks) if pool else [align_chunk(chunks[0], pileup)]
+
+        for blocks, insertions, chunk_mismatches_counts, chunk_seeded in results:
+            for mismatches, count in chunk_mismatches_counts.iteritems():
+                mismatches_counts[mismatches] = mismatches_counts.get(mismatches, 0) + count
+            seeded += chunk_seeded
+            pileup.add_blocks(blocks)
+            pileup.add_insertions(insertions)
+
+        pileup.check_memory()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    pileup.flush()
+
+    for mismatches, count in sorted(mismatches_counts.iteritems()):
+        logger.info('Aligned reads with {0} mismatches: {1}'.format(mismatches, count))
+    if aligner_seeding:
+        logger.info('Aligned reads by seed and extend: {0}'.format(seeded))
     logger.info('Total Mapper Time: {0} seconds'.format(round(time.time() - start_time, 2)))
 
 
@@ -0,0 +1,237 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import re
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is only needed by the vectorized batch queries
+    np = None
+
+# 2 bit codes of the nucleotides held in the packed BWT
+NUCLEOTIDES = 'ACGT'
+NUCLEOTIDE_CODES = {c: i for i, c in enumerate(NUCLEOTIDES)}
+# number of characters packed in one uint32 word
+CHARS_PER_WORD = 16
+# spacing between the checkpoints of the exceptions' per character counts
+EXCEPTION_CP_IVAL = 64
+
+# for every 2 bit code, a word having that code in all 16 slots
+CODE_PATTERNS = [0x00000000, 0x55555555, 0xAAAAAAAA, 0xFFFFFFFF]
+# low bit of every 2 bit slot
+LOW_BITS_MASK = 0x55555555
+# translation table mapping characters to their 2 bit code. Non ACGT characters are mapped to 0 (A)
+CODE_TABLE = ''.join(chr(NUCLEOTIDE_CODES.get(chr(i), 0)) for i in xrange(256))
+NON_NUCLEOTIDE_REGEX = re.compile('[^ACGT]')
+
+# number of set bits for every 16 bit value
+POPCOUNT_16 = bytearray(bin(i).count('1') for i in xrange(1 << 16))
+
+
+# Returns the number of set bits in a 32 bit word
+def popcount(word):
+    return POPCOUNT_16[word & 0xFFFF] + POPCOUNT_16[word >> 16]
+
+
+# Returns a numpy view over an integer sequence without copying it, when the sequence exposes a buffer.
+#
+# @param sequence of integers, either an array or a memory-mapped sequence providing to_numpy()
+# @param numpy dtype of the items
+# @returns numpy array
+def as_numpy(seq, dtype):
+    if hasattr(seq, 'to_numpy'):
+        return seq.to_numpy()
+    if len(seq) == 0:
+        return np.zeros(0, dtype=dtype)
+    if isinstance(seq, array) and seq.itemsize == np.dtype(dtype).itemsize:
+        return np.frombuffer(seq, dtype=dtype)
+    return np.array(seq, dtype=dtype)
+
+
+# Returns a word having the low bit of a 2 bit slot set wherever the slot holds the given code
+def code_matches(word, code):
+    x = word ^ CODE_PATTERNS[code]
+    return ~(x | (x >> 1)) & LOW_BITS_MASK
+
+
+# BWT packed at 2 bits per character together with its rank checkpoints.
+#
+# Every cpIval characters are stored in a block of uint32 words. A block starts with the number of A, C, G, T
+# preceding it, followed by the block characters packed 16 per word, hence a rank query touches a single block and
+# counts in-block occurrences with a popcount per word.
+# Characters other than ACGT (e.g. '$', 'N') are packed as A and kept in a sorted exception list.
+class PackedBwt(object):
+    def __init__(self, bw, cpIval=128):
+        if cpIval % CHARS_PER_WORD != 0:
+            raise ValueError('Checkpoint interval has to be a multiple of {0}'.format(CHARS_PER_WORD))
+
+        self.length = len(bw)
+        # spacing between checkpoints
+        self.cpIval = cpIval
+        # words per block: ACGT counts followed by packed characters
+        self.stride = len(NUCLEOTIDES) + cpIval // CHARS_PER_WORD
+        self.words = array('I')
+
+        codes = bw.translate(CODE_TABLE)
+        tally = [0] * len(NUCLEOTIDES)
+        for block_start in xrange(0, self.length, cpIval):
+            self.words.extend(tally)
+            block_codes = codes[block_start:block_start + cpIval]
+            for word_start in xrange(0, cpIval, CHARS_PER_WORD):
+                word = 0
+                for code in reversed(block_codes[word_start:word_start + CHARS_PER_WORD]):
+                    word = (word << 2) | ord(code)
+                self.words.append(word)
+            for code in xrange(len(NUCLEOTIDES)):
+                tally[code] += block_codes.count(chr(code))
+
+        # exceptions: sorted positions of non ACGT characters and the characters at those positions
+        self.exception_positions = array('L')
+        exception_chars = []
+        for m in NON_NUCLEOTIDE_REGEX.finditer(bw):
+            self.exception_positions.append(m.start())
+            exception_chars.append(m.group())
+        self.exception_chars = ''.join(exception_chars)
+
+        # per character checkpoints over the exceptions, so ranks of non ACGT characters are looked up the same way
+        self.exception_alphabet = ''.join(sorted(set(self.exception_chars)))
+        self.exception_cps = array('L')
+        exception_tally = dict((c, 0) for c in self.exception_alphabet)
+        for i in xrange(0, len(self.exception_chars) + 1):
+            if (i % EXCEPTION_CP_IVAL) == 0:
+                self.exception_cps.extend(exception_tally[c] for c in self.exception_alphabet)
+            if i < len(self.exception_chars):
+                exception_tally[self.exception_chars[i]] += 1
+
+    # Recreates a packed BWT from its already built data structures, e.g. sections of a memory-mapped index file.
+    # Any sequence types supporting indexing and slicing may be used in place of arrays and strings.
+    @classmethod
+    def from_data(cls, length, cpIval, words, exception_positions, exception_chars, exception_alphabet,
+                  exception_cps):
+        packed_bw = cls.__new__(cls)
+        packed_bw.length = length
+        packed_bw.cpIval = cpIval
+        packed_bw.stride = len(NUCLEOTIDES) + cpIval // CHARS_PER_WORD
+        packed_bw.words = words
+        packed_bw.exception_positions = exception_positions
+        packed_bw.exception_chars = exception_chars
+        packed_bw.exception_alphabet = exception_alphabet
+        packed_bw.exception_cps = exception_cps
+        return packed_bw
+
+    def __len__(self):
+        return self.length
+
+    # Returns the character at the given BWT row
+    def __getitem__(self, row):
+        if row < 0:
+            row += self.length
+        if not 0 <= row < self.length:
+            raise IndexError('BWT row out of range')
+
+        i = bisect_left(self.exception_positions, row)
+        if i < len(self.exception_positions) and self.exception_positions[i] == row:
+            return self.exception_chars[i]
+
+        offset = row % self.cpIval
+        word = self.words[(row // self.cpIval) * self.stride + len(NUCLEOTIDES) + offset // CHARS_PER_WORD]
+        return NUCLEOTIDES[(word >> (2 * (offset % CHARS_PER_WORD))) & 3]
+
+    # Returns the number of exceptions up to and including row
+    def exceptions_rank(self, row):
+        return bisect_right(self.exception_positions, row)
+
+    # Returns the number of c chars there are in bw up to and including row
+    def rank(self, c, row):
+        if row < 0:
+            return 0
+        if row >= self.length:
+            row = self.length - 1
+
+        code = NUCLEOTIDE_CODES.get(c)
+        if code is None:
+            return self.exception_char_rank(c, row)
+
+        block = row // self.cpIval
+        offset = block * self.stride
+        nchars = row - block * self.cpIval + 1
+        nocc = self.words[offset + code]
+
+        offset += len(NUCLEOTIDES)
+        while nchars >= CHARS_PER_WORD:
+            nocc += popcount(code_matches(self.words[offset], code))
+            offset += 1
+            nchars -= CHARS_PER_WORD
+        if nchars > 0:
+            nocc += popcount(code_matches(self.words[offset], code) & ((1 << (2 * nchars)) - 1))
+
+        if code == 0 and len(self.exception_positions) > 0:
+            # exceptions are packed as A
+            nocc -= self.exceptions_rank(row)
+        return nocc
+
+    # Vectorized rank over many rows at once, each row having its own nucleotide.
+    # Requires numpy.
+    #
+    # @param numpy array of 2 bit nucleotide codes
+    # @param numpy int64 array of rows
+    # @returns numpy int64 array with the number of code chars there are in bw up to and including each row
+    def rank_batch(self, codes, rows):
+        if np is None:
+            raise RuntimeError('numpy is required for batch rank queries')
+        if not hasattr(self, 'np_words'):
+            self.np_words = as_numpy(self.words, np.uint32)
+            # searched as is rather than cast to int64, which would copy the memory-mapped positions into every process
+            self.np_exception_positions = as_numpy(self.exception_positions, np.uint64)
+            self.np_code_patterns = np.array(CODE_PATTERNS, dtype=np.uint32)
+            self.np_popcount_16 = np.frombuffer(POPCOUNT_16, dtype=np.uint8).astype(np.int64)
+
+        valid = rows >= 0
+        rows = np.clip(rows, 0, self.length - 1)
+        block = rows // self.cpIval
+        offset = block * self.stride
+        nchars = rows - block * self.cpIval + 1
+        nocc = self.np_words[offset + codes].astype(np.int64)
+
+        patterns = self.np_code_patterns[codes]
+        offset += len(NUCLEOTIDES)
+        for w in xrange(self.cpIval // CHARS_PER_WORD):
+            remaining = np.clip(nchars - w * CHARS_PER_WORD, 0, CHARS_PER_WORD)
+            if not remaining.any():
+                break
+            x = self.np_words[offset + w] ^ patterns
+            matches = ~(x | (x >> 1)) & LOW_BITS_MASK
+            mask = ((np.uint64(1) << (2 * remaining).astype(np.uint64)) - np.uint64(1)).astype(np.uint32)
+            matches &= mask
+            nocc += self.np_popcount_16[matches & 0xFFFF] + self.np_popcount_16[matches >> 16]
+
+        if len(self.np_exception_positions) > 0:
+            # exceptions are packed as A
+            is_a = codes == 0
+            # rows are clipped to be non negative, and searched as uint64 since numpy compares int64 to uint64 as floats
+            nocc[is_a] -= np.searchsorted(self.np_exception_positions, rows[is_a].astype(np.uint64), side='right')
+
+        nocc[~valid] = 0
+        return nocc
+
+    # Returns the number of c chars, c not being ACGT, there are in bw up to and including row
+    def exception_char_rank(self, c, row):
+        char_index = self.exception_alphabet.find(c)
+        if char_index < 0:
+            return 0
+        nexceptions = self.exceptions_rank(row)
+        cp = nexceptions // EXCEPTION_CP_IVAL
+        nocc = self.exception_cps[cp * len(self.exception_alphabet) + char_index]
+        return nocc + self.exception_chars[cp * EXCEPTION_CP_IVAL:nexceptions].count(c)
+
+
+# Rank checkpoints over a PackedBwt, exposing the same rank interface as bwt_fmindex.FmCheckpoints.
+# The checkpoints are interleaved with the packed characters, hence this only delegates to the packed BWT.
+class PackedFmCheckpoints(object):
+    def __init__(self, packed_bw):
+        self.packed_bw = packed_bw
+        self.cpIval = packed_bw.cpIval
+
+    # Returns the number of chars there are in bw up to and including row
+    def rank(self, bw, c, row):
+        return self.packed_bw.rank(c, row)
@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 
+import argparse
+from functools import partial
 import os
-import sys
-from os.path import isfile
+from mrcommon import fastq
+from utils import MR_READS_SEPARATOR
 
 
 # Extracts reads from fastq files by returning 2nd row of every 4 lines
@@ -10,40 +12,65 @@ from os.path import isfile
 # @param input fastq file
 # @returns the reads from the fastq file
 def extractReadsFromFASTQ(filename):
-    f = open(filename)
+    fastq_file = fastq.open_fastq(filename)
+    for lines in fastq.read_batches(fastq_file):
+        for read in extract_reads(lines):
+            yield read
+    # surfaces decompression errors once all reads are read
+    fastq_file.close()
 
-    initial_line = 1
-    counter = 0
 
-    for line in f:
-        if len(line) > 0:
-            # fastq files have 4 rows per read. read is found on 2nd row of every 4 lines
-            if counter == initial_line or counter == initial_line + 4:
-                initial_line = counter
-                yield line
+# Extracts the reads of a batch of fastq lines. fastq files have 4 rows per read, the read being found on the 2nd row
+#
+# @param list of fastq lines, 4 per read
+# @returns list of reads, one per line
+def extract_reads(lines):
+    return [read if read.endswith('\n') else read + '\n' for read in lines[1::4]]
 
-            counter += 1
 
-    f.close()
+# Converts a batch of fastq lines into the text of its reads, one per line, or reads_per_line reads per line separated
+# by MR_READS_SEPARATOR
+def convert_batch(lines, reads_per_line=1):
+    reads = extract_reads(lines)
+    if reads_per_line > 1:
+        reads = [read.rstrip('\n') for read in reads]
+        return ''.join(MR_READS_SEPARATOR.join(reads[i:i + reads_per_line]) + '\n'
+                       for i in xrange(0, len(reads), reads_per_line))
+    return ''.join(reads)
 
 
 def main():
-    if len(sys.argv) < 2:
-        print 'Usage: parse_fq_file.py <input_file.fastq>'
-        os.abort()
+    parser = argparse.ArgumentParser(description='Extracts the reads of a plain or gzip compressed fastq file, one per '
+                                                 'line')
+    parser.add_argument('input_file', help="fastq file, '-' standing for stdin")
+    parser.add_argument('-o', '--output', default='output.fq.reads',
+                        help="output file, '-' standing for stdout e.g. to pipe it to 'hdfs dfs -put - <file>' "
+                             "(default: %(default)s)")
+    parser.add_argument('--chunks', type=int, default=1,
+                        help='number of output files of about the same size, suffixed by their number (default: '
+                             '%(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes extracting reads, 0 for one per core (default: %(default)s)')
+    parser.add_argument('--reads-per-line', type=int, default=1,
+                        help='number of reads per output line, e.g. 10000 so that mappers read large batches of '
+                             'reads at a time (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='number of reads processed at a time (default: %(default)s)')
+    args = parser.parse_args()
 
-    input_fastq_filename = str(sys.argv[1])
-
-    if not isfile(input_fastq_filename):
-        print '{0} is not a valid input file'.format(input_fastq_filename)
+    if not fastq.is_valid_input(args.input_file):
+        print '{0} is not a valid input file'.format(args.input_file)
         os.abort()
 
-    reads = extractReadsFromFASTQ(input_fastq_filename)
-    output_reads_file = open('output.fq.reads', 'w')
-    for r in reads:
-        output_reads_file.write(r)
+    if args.output == '-' and args.chunks > 1:
+        print 'Output cannot be split in chunks when written to stdout'
+        os.abort()
 
-    output_reads_file.close()
+    # batches hold whole output lines
+    reads_per_line = max(args.reads_per_line, 1)
+    batch_size = max(args.batch_size // reads_per_line, 1) * reads_per_line
+    fastq.convert(args.input_file, args.output, partial(convert_batch, reads_per_line=reads_per_line),
+                  chunks=args.chunks, workers=fastq.worker_count(args.workers), batch_size=batch_size)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from mrcommon import pileup
+from mrcommon.pileup import COUNTS_PER_POSITION, new_counts
+from utils import current_rss
+
+# Pileup of ACGTDN counts per global offset of the concatenated contigs, accumulated as by the mr-bwa mapper, see
+# mrcommon.pileup, and written out keyed by chromosome and position within it.
+#
+# When max_blocks is given at most max_blocks blocks are held; when a new block is needed the least recently used one
+# is evicted and its counts written out straight away. All blocks are also written out whenever the process resident
+# memory goes above max_rss bytes. A reference position may hence be written out more than once, which is fine since
+# combiners and reducers sum the counts of each reference position.
+# When binned, each block is written out as bin records rather than one record per reference position, bins starting
+# at multiples of block_size within each chromosome as in mr-bwa, whatever the global offset of the chromosome.
+# Insertions are kept apart until all blocks are written out.
+class FlushingPileup(pileup.Pileup):
+    def __init__(self, ref_gen, writer, block_size=256, max_blocks=None, max_rss=None, binned=False):
+        super(FlushingPileup, self).__init__(block_size)
+        # reference.Reference, used for the ref_char, chromosome and position within it of each global offset
+        self.ref_gen = ref_gen
+        # records.RecordWriter writing out the counts of each position
+        self.writer = writer
+        self.max_blocks = max_blocks
+        self.max_rss = max_rss
+        self.binned = binned
+        # block id to counts, least recently used first
+        self.blocks = OrderedDict()
+
+    # Returns the counts of the given block, creating it if needed
+    def block(self, block_id):
+        counts = self.blocks.pop(block_id, None)
+        if counts is None:
+            if self.max_blocks is not None and len(self.blocks) >= self.max_blocks:
+                self.flush_block(*self.blocks.popitem(last=False))
+            counts = new_counts(self.block_size)
+        self.blocks[block_id] = counts
+        return counts
+
+    # Adds the insertions of another pileup, e.g. the partial counts of a worker process
+    #
+    # @param dict of (reference position, insertion ordinal) to counts
+    def add_insertions(self, insertions):
+        for key, insertion_counts in insertions.iteritems():
+            counts = self.insertions.get(key)
+            if counts is None:
+                self.insertions[key] = insertion_counts
+            else:
+                for i in xrange(COUNTS_PER_POSITION):
+                    counts[i] += insertion_counts[i]
+
+    # Adds the blocks of another pileup, e.g. the partial counts of a worker process
+    #
+    # @param dict of block id to counts
+    def add_blocks(self, blocks):
+        for block_id, block_counts in blocks.iteritems():
+            if block_id not in self.blocks:
+                if self.max_blocks is not None and len(self.blocks) >= self.max_blocks:
+                    self.flush_block(*self.blocks.popitem(last=False))
+                self.blocks[block_id] = block_counts
+            else:
+                counts = self.block(block_id)
+                for i in xrange(len(block_counts)):
+                    if block_counts[i]:
+                        counts[i] += block_counts[i]
+
+    # Writes out all blocks if the process resident memory has gone above the high-water mark
+    def check_memory(self):
+        if self.max_rss is not None and self.blocks:
+            rss = current_rss()
+            if rss is not None and rss > self.max_rss:
+                self.flush()
+
+    # Writes out the counts of a block, one record per reference position having any count or bin records. Blocks are
+    # laid out over the global offsets of the concatenated contigs, hence a block spanning the boundary of two contigs
+    # is written out as one part per contig, each keyed by its chromosome and position within it. Bins are aligned to
+    # block_size within the contig, hence a part is written out as the bins it overlaps, counts of the positions out of
+    # the part being 0 and ref chars past the contig end '\0', which combiners and reducers sum with the bins written
+    # out for the neighbouring blocks
+    #
+    # @param block id
+    # @param block counts
+    def flush_block(self, block_id, counts):
+        block_start = block_id * self.block_size
+        block_end = min(block_start + self.block_size, len(self.ref_gen))
+        start = block_start
+        while start < block_end:
+            chromosome, position = self.ref_gen.locate(start)
+            end = min(block_end, self.ref_gen.contig_end(chromosome))
+            reference_name = self.ref_gen.names[chromosome]
+            if self.binned:
+                contig_end = self.ref_gen.contig_end(chromosome)
+                bin_start = start - position % self.block_size
+                while bin_start < end:
+                    bin_end = bin_start + self.block_size
+                    lo, hi = max(bin_start, start), min(bin_end, end)
+                    part_counts = counts[(lo - block_start) * COUNTS_PER_POSITION:
+                                         (hi - block_start) * COUNTS_PER_POSITION]
+                    if any(part_counts):
+                        bin_counts = new_counts(self.block_size)
+                        bin_counts[(lo - bin_start) * COUNTS_PER_POSITION:(hi - bin_start) * COUNTS_PER_POSITION] = \
+                            part_counts
+                        ref_chars = self.ref_gen[bin_start:min(bin_end, contig_end)]
+                        self.writer.write_bin(self.writer.key(position + bin_start - start, chromosome),
+                                              ref_chars + '\0' * (self.block_size - len(ref_chars)), bin_counts,
+                                              reference_name)
+                    bin_start = bin_end
+            else:
+                # ref_chars of the segment are decoded at once rather than looked up per position
+                ref_chars = None
+                for ref_index in xrange(start, end):
+                    offset = ref_index - block_start
+                    position_counts = counts[offset * COUNTS_PER_POSITION:(offset + 1) * COUNTS_PER_POSITION]
+                    if any(position_counts):
+                        if ref_chars is None:
+                            ref_chars = self.ref_gen[start:end]
+                        self.writer.write(self.writer.key(position + ref_index - start, chromosome),
+                                          ref_chars[ref_index - start], position_counts, reference_name)
+            start = end
+
+    # Writes out the counts of all blocks, followed by those of all insertions, and empties the pileup. Insertions are
+    # not binned, their reference char being unknown
+    def flush(self):
+        while self.blocks:
+            self.flush_block(*self.blocks.popitem(last=False))
+        for (ref_index, insertion), counts in sorted(self.insertions.iteritems()):
+            chromosome, position = self.ref_gen.locate(ref_index)
+            self.writer.write(self.writer.key(position, chromosome, insertion), None, counts,
+                              self.ref_gen.names[chromosome])
+        self.insertions = dict()
@@ -0,0 +1,272 @@
+from bisect import bisect_right
+import json
+import re
+from index_file import MappedArray, MappedBytes, UINT64, map_sections, pack_values, write_sections
+from packed_bwt import CODE_TABLE, NUCLEOTIDES, np
+
+# Packed reference genome file format, laid out in sections as the FM-Index file format of index_file:
+# -- META     json encoded contig names, in fasta order, and sequence length
+# -- OFFSETS  uint64 start offset of each contig in the sequence, followed by the length of the sequence
+# -- PACKED   contig sequences concatenated without fasta headers and line breaks, packed at 2 bits per base, 4 bases
+#             per byte starting from the low bits. Non ACGT characters are packed as A
+# -- EXCSTART uint64 start offsets of the runs of a same non ACGT character, e.g. N
+# -- EXCEND   uint64 end offsets of these runs
+# -- EXCCHR   upper case character of each run
+# -- MSKSTART uint64 start offsets of the lower case runs, i.e. the repeats soft-masked by the fasta file
+# -- MSKEND   uint64 end offsets of the lower case runs
+#
+# The FM-Index is built over the sequence in upper case, hence the positions it returns are global offsets into the
+# sequence, which are mapped to a contig and a position within it by a binary search over OFFSETS.
+#
+# Version 1 files held the sequence as SEQUENCE, one byte per base. These are still readable.
+REFERENCE_FILE_MAGIC = 'BWTFMREF'
+REFERENCE_FILE_VERSION = 2
+SUPPORTED_REFERENCE_FILE_VERSIONS = (1, 2)
+
+# number of bases packed in one byte
+BASES_PER_BYTE = 4
+# for every packed byte, the 4 bases it holds
+DECODE_TABLE = [''.join(NUCLEOTIDES[(i >> 2 * j) & 3] for j in xrange(BASES_PER_BYTE)) for i in xrange(256)]
+EXCEPTION_RUN_REGEX = re.compile(r'([^ACGT])\1*')
+MASK_RUN_REGEX = re.compile('[a-z]+')
+
+
+# Sequence packed at 2 bits per base, together with the runs of non ACGT and lower case characters it is decoded
+# with. Slices are decoded a packed byte at a time, or by numpy table lookups when installed, hence decoding the span
+# of a read or a block touches a few bytes of the mapped file only.
+class PackedSequence(object):
+    # @param sequence length
+    # @param packed bases, a string or MappedBytes
+    # @param start and end offsets of the non ACGT runs
+    # @param character of each non ACGT run
+    # @param start and end offsets of the lower case runs
+    def __init__(self, length, packed, exception_starts, exception_ends, exception_chars, mask_starts, mask_ends):
+        self.length = length
+        self.packed = packed
+        self.exception_starts = exception_starts
+        self.exception_ends = exception_ends
+        self.exception_chars = exception_chars
+        self.mask_starts = mask_starts
+        self.mask_ends = mask_ends
+        if np is not None:
+            self.np_decode_table = np.frombuffer(''.join(DECODE_TABLE), dtype=np.uint8).reshape(256, BASES_PER_BYTE)
+
+    # Packs a sequence
+    #
+    # @param sequence string, in upper and lower case
+    # @returns the PackedSequence, held in memory
+    @classmethod
+    def from_sequence(cls, sequence):
+        upper = sequence.upper()
+        exception_runs = [(m.start(), m.end(), m.group(1)) for m in EXCEPTION_RUN_REGEX.finditer(upper)]
+        mask_runs = [(m.start(), m.end()) for m in MASK_RUN_REGEX.finditer(sequence)]
+        return cls(len(sequence), pack_bases(upper), [start for start, end, c in exception_runs],
+                   [end for start, end, c in exception_runs], ''.join(c for start, end, c in exception_runs),
+                   [start for start, end in mask_runs], [end for start, end in mask_runs])
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.length)
+            if step != 1:
+                raise ValueError('Only contiguous slices are supported')
+            return self.decode(start, max(start, stop))
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('PackedSequence index out of range')
+        return self.decode(i, i + 1)
+
+    # Decodes the bases from start up to, excluding, stop
+    def decode(self, start, stop):
+        if start >= stop:
+            return ''
+        packed = self.packed[start // BASES_PER_BYTE:(stop + BASES_PER_BYTE - 1) // BASES_PER_BYTE]
+        skip = start % BASES_PER_BYTE
+        if np is not None and stop - start > BASES_PER_BYTE:
+            bases = bytearray(self.np_decode_table[np.frombuffer(packed, dtype=np.uint8)].tostring())
+        else:
+            bases = bytearray(''.join(DECODE_TABLE[byte] for byte in bytearray(packed)))
+        bases = bases[skip:skip + stop - start]
+
+        k = bisect_right(self.exception_ends, start)
+        while k < len(self.exception_starts) and self.exception_starts[k] < stop:
+            run_start = max(self.exception_starts[k], start) - start
+            run_end = min(self.exception_ends[k], stop) - start
+            bases[run_start:run_end] = self.exception_chars[k] * (run_end - run_start)
+            k += 1
+
+        k = bisect_right(self.mask_ends, start)
+        while k < len(self.mask_starts) and self.mask_starts[k] < stop:
+            run_start = max(self.mask_starts[k], start) - start
+            run_end = min(self.mask_ends[k], stop) - start
+            bases[run_start:run_end] = str(bases[run_start:run_end]).lower()
+            k += 1
+        return str(bases)
+
+
+# Packs upper case bases at 2 bits per base, 4 per byte starting from the low bits
+#
+# @param sequence string in upper case
+# @returns packed bytes
+def pack_bases(sequence):
+    codes = sequence.translate(CODE_TABLE)
+    codes += '\0' * (-len(codes) % BASES_PER_BYTE)
+    if np is not None:
+        codes = np.frombuffer(codes, dtype=np.uint8)
+        return (codes[0::4] | (codes[1::4] << 2) | (codes[2::4] << 4) | (codes[3::4] << 6)).tostring()
+    codes = bytearray(codes)
+    return str(bytearray(codes[i] | (codes[i + 1] << 2) | (codes[i + 2] << 4) | (codes[i + 3] << 6)
+                         for i in xrange(0, len(codes), BASES_PER_BYTE)))
+
+
+# Reference genome made of contigs, e.g. chromosomes, addressed by global offsets over their concatenated sequences
+class Reference(object):
+    # @param list of contig names, None for a sequence without fasta header
+    # @param list of contig start offsets, followed by the total length
+    # @param concatenated contig sequences, a string, MappedBytes or PackedSequence
+    def __init__(self, names, offsets, sequence):
+        self.names = names
+        self.offsets = offsets
+        self.sequence = sequence
+
+    def __len__(self):
+        return len(self.sequence)
+
+    # Returns the reference char at a global offset, or the reference chars of a slice of global offsets
+    def __getitem__(self, i):
+        return self.sequence[i]
+
+    # Returns the length of each contig, in contig order
+    def contig_lengths(self):
+        return [end - start for start, end in zip(self.offsets, self.offsets[1:])]
+
+    # Maps a global offset to its contig
+    #
+    # @param global offset
+    # @returns tuple of contig ordinal and position within the contig
+    def locate(self, offset):
+        if not 0 <= offset < len(self):
+            raise IndexError('Reference offset {0} out of range'.format(offset))
+        contig = bisect_right(self.offsets, offset) - 1
+        return contig, offset - self.offsets[contig]
+
+    # Returns the global offset right after the end of a contig
+    def contig_end(self, contig):
+        return self.offsets[contig + 1]
+
+    # Checks whether a sequence aligned at a global offset lies within a single contig, as sequences matched across
+    # the boundary of two concatenated contigs are not actual hits
+    #
+    # @param global offset
+    # @param sequence length
+    def within_contig(self, offset, length):
+        contig = self.locate(offset)[0]
+        return offset + length <= self.contig_end(contig)
+
+
+# Reads the contigs of a fasta file, a file without fasta header being read as a single contig
+#
+# @param fasta file
+# @returns tuples of contig name, i.e. the first word of its header, and sequence without line breaks
+def read_fasta(fasta_file):
+    name = None
+    lines = []
+    for line in fasta_file:
+        if line.startswith('>'):
+            if name is not None or lines:
+                yield name, ''.join(lines)
+            header = line[1:].split()
+            name = header[0] if header else ''
+            lines = []
+        else:
+            lines.append(line.rstrip())
+    if name is not None or lines:
+        yield name, ''.join(lines)
+
+
+# Reads the reference genome from a fasta file
+#
+# @param fasta filename
+# @returns the Reference, held in memory
+def read_fasta_reference(filename):
+    names = []
+    offsets = [0]
+    sequences = []
+    with open(filename) as fasta_file:
+        for name, sequence in read_fasta(fasta_file):
+            names.append(name)
+            offsets.append(offsets[-1] + len(sequence))
+            sequences.append(sequence)
+    return Reference(names, offsets, ''.join(sequences))
+
+
+# Checks whether the given file is a packed reference file
+#
+# @param filename
+# @returns True if file starts with the reference magic, False otherwise
+def is_reference_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(REFERENCE_FILE_MAGIC)) == REFERENCE_FILE_MAGIC
+
+
+# Writes the reference genome to a packed reference file
+#
+# @param filename to write to
+# @param the Reference
+def save_reference(filename, reference):
+    sequence = reference.sequence
+    if not isinstance(sequence, PackedSequence):
+        sequence = PackedSequence.from_sequence(str(sequence[0:len(sequence)]))
+    sections = [
+        ('META', json.dumps({'names': reference.names, 'length': len(sequence)})),
+        ('OFFSETS', pack_values(reference.offsets, UINT64)),
+        ('PACKED', str(sequence.packed[0:len(sequence.packed)])),
+        ('EXCSTART', pack_values(sequence.exception_starts, UINT64)),
+        ('EXCEND', pack_values(sequence.exception_ends, UINT64)),
+        ('EXCCHR', str(sequence.exception_chars[0:len(sequence.exception_chars)])),
+        ('MSKSTART', pack_values(sequence.mask_starts, UINT64)),
+        ('MSKEND', pack_values(sequence.mask_ends, UINT64))
+    ]
+    write_sections(filename, sections, REFERENCE_FILE_MAGIC, REFERENCE_FILE_VERSION)
+
+
+# Opens a packed reference file via mmap. The sequence is read in place, hence concurrent processes share the same
+# pages in the OS page cache
+#
+# @param filename to read from
+# @returns the Reference
+def load_reference(filename):
+    buf, version, sections = map_sections(filename, REFERENCE_FILE_MAGIC, SUPPORTED_REFERENCE_FILE_VERSIONS)
+
+    def mapped_bytes(name):
+        offset, size = sections[name]
+        return MappedBytes(buf, offset, size)
+
+    def mapped_array(name):
+        offset, size = sections[name]
+        return MappedArray(buf, offset, size, UINT64)
+
+    meta_offset, meta_size = sections['META']
+    meta = json.loads(buf[meta_offset:meta_offset + meta_size])
+    names = [str(name) if name is not None else None for name in meta['names']]
+    offsets = list(mapped_array('OFFSETS')[:])
+    if version == 1:
+        return Reference(names, offsets, mapped_bytes('SEQUENCE'))
+
+    sequence = PackedSequence(meta['length'], mapped_bytes('PACKED'), mapped_array('EXCSTART'),
+                              mapped_array('EXCEND'), mapped_bytes('EXCCHR'), mapped_array('MSKSTART'),
+                              mapped_array('MSKEND'))
+    return Reference(names, offsets, sequence)
+
+
+# Opens the reference genome, either a packed reference file or a fasta file
+#
+# @param filename to read from
+# @returns the Reference
+def open_reference(filename):
+    if is_reference_file(filename):
+        return load_reference(filename)
+    return read_fasta_reference(filename)
@@ -0,0 +1,192 @@
+from array import array
+
+# SA-IS suffix array construction (Nong, Zhang & Chan, 2009).
+# Unlike the prefix doubling in bwt_fmindex.suffix_array, this runs in linear time and works over compact
+# integer arrays instead of Python lists, so peak memory stays at a few bytes per input character.
+
+# empty slot marker used while inducing
+EMPTY = -1
+
+
+# Creates a signed integer array of given size wide enough to hold any index into it
+#
+# @param size of array
+# @param initial value of every slot
+# @returns the integer array
+def int_array(size, fill=0):
+    typecode = 'i' if size < 2 ** 31 - 1 else 'l'
+    return array(typecode, [fill]) * size
+
+
+# Maps the input text to a byte array of character ranks 1..k, followed by a 0 sentinel.
+# Ranks follow the character order, hence the resulting suffix order is the same as the one of the input text.
+#
+# @param input text
+# @returns tuple of ranked text and alphabet size (including sentinel)
+def text_to_ranks(input_text):
+    alphabet = sorted(set(input_text))
+    table = [chr(0)] * 256
+    for i, c in enumerate(alphabet):
+        table[ord(c)] = chr(i + 1)
+    ranked = array('B', input_text.translate(''.join(table)))
+    ranked.append(0)
+    return ranked, len(alphabet) + 1
+
+
+# Returns the start index of each bucket
+def bucket_heads(counts):
+    heads = int_array(len(counts))
+    total = 0
+    for c in xrange(len(counts)):
+        heads[c] = total
+        total += counts[c]
+    return heads
+
+
+# Returns the end index (exclusive) of each bucket
+def bucket_tails(counts):
+    tails = int_array(len(counts))
+    total = 0
+    for c in xrange(len(counts)):
+        total += counts[c]
+        tails[c] = total
+    return tails
+
+
+# Classifies every suffix as S-type (1) or L-type (0)
+def classify_suffixes(s):
+    n = len(s)
+    types = bytearray(n)
+    types[n - 1] = 1
+    for i in xrange(n - 2, -1, -1):
+        if s[i] < s[i + 1] or (s[i] == s[i + 1] and types[i + 1]):
+            types[i] = 1
+    return types
+
+
+# Induces the order of L-type and then S-type suffixes from the LMS suffixes already placed in sa
+def induce_sort(s, sa, types, counts):
+    n = len(s)
+    heads = bucket_heads(counts)
+    for i in xrange(n):
+        j = sa[i] - 1
+        if j >= 0 and not types[j]:
+            c = s[j]
+            sa[heads[c]] = j
+            heads[c] += 1
+
+    tails = bucket_tails(counts)
+    for i in xrange(n - 1, -1, -1):
+        j = sa[i] - 1
+        if j >= 0 and types[j]:
+            c = s[j]
+            tails[c] -= 1
+            sa[tails[c]] = j
+
+
+# Computes the suffix array of s, an integer sequence whose last element is a unique 0 sentinel
+#
+# @param integer sequence
+# @param alphabet size
+# @returns suffix array of s, including the sentinel suffix at position 0
+def sais(s, k):
+    n = len(s)
+    sa = int_array(n, EMPTY)
+    if n == 1:
+        sa[0] = 0
+        return sa
+
+    types = classify_suffixes(s)
+
+    def is_lms(i):
+        return i > 0 and types[i] and not types[i - 1]
+
+    counts = int_array(k)
+    for c in s:
+        counts[c] += 1
+
+    # step 1: sort LMS substrings by placing LMS suffixes at the end of their buckets and inducing
+    tails = bucket_tails(counts)
+    for i in xrange(1, n):
+        if is_lms(i):
+            c = s[i]
+            tails[c] -= 1
+            sa[tails[c]] = i
+    induce_sort(s, sa, types, counts)
+
+    # compact the sorted LMS substrings into the first n1 slots
+    n1 = 0
+    for i in xrange(n):
+        if is_lms(sa[i]):
+            sa[n1] = sa[i]
+            n1 += 1
+    for i in xrange(n1, n):
+        sa[i] = EMPTY
+
+    # name LMS substrings, equal substrings getting equal names
+    name = 0
+    prev = -1
+    for i in xrange(n1):
+        pos = sa[i]
+        diff = prev == -1
+        d = 0
+        while not diff:
+            if s[pos + d] != s[prev + d] or types[pos + d] != types[prev + d]:
+                diff = True
+            elif d > 0 and (is_lms(pos + d) or is_lms(prev + d)):
+                break
+            d += 1
+        if diff:
+            name += 1
+            prev = pos
+        sa[n1 + pos // 2] = name - 1
+
+    j = n - 1
+    for i in xrange(n - 1, n1 - 1, -1):
+        if sa[i] >= 0:
+            sa[j] = sa[i]
+            j -= 1
+
+    # step 2: sort the reduced problem, recursing only if names are not unique yet
+    s1 = sa[n - n1:]
+    if name < n1:
+        sa1 = sais(s1, name)
+    else:
+        sa1 = int_array(n1)
+        for i in xrange(n1):
+            sa1[s1[i]] = i
+
+    # step 3: induce the full suffix array from the sorted LMS suffixes
+    j = 0
+    for i in xrange(1, n):
+        if is_lms(i):
+            s1[j] = i
+            j += 1
+    for i in xrange(n1):
+        sa1[i] = s1[sa1[i]]
+    del s1
+
+    for i in xrange(n):
+        sa[i] = EMPTY
+    tails = bucket_tails(counts)
+    for i in xrange(n1 - 1, -1, -1):
+        j = sa1[i]
+        c = s[j]
+        tails[c] -= 1
+        sa[tails[c]] = j
+    del sa1
+    induce_sort(s, sa, types, counts)
+
+    return sa
+
+
+# Creates the suffix array for the input text using SA-IS.
+# The result is identical to bwt_fmindex.suffix_array but returned as a compact integer array.
+#
+# @param input text to create suffix array for
+# @returns suffix array
+def suffix_array_sais(input_text):
+    ranked, k = text_to_ranks(input_text)
+    sa = sais(ranked, k)
+    # drop the sentinel suffix which always sorts first
+    return sa[1:]
@@ -0,0 +1,332 @@
+from itertools import groupby
+from bwt_fmindex import bwm_longest_suffix_batch, forward_strand_hit, resolve, reverse_complement
+from mrcommon.pileup import CIGAR_DELETION, CIGAR_INSERTION, CIGAR_MATCH, CIGAR_SOFT_CLIP
+
+# Seed and extend alignment of reads over the custom FM-Index, for reads which do not occur exactly.
+#
+# -- seeding: the super-maximal exact matches (SMEMs) of a read, i.e. its exact matches which are not contained in any
+#    other match, are found by backward searches only. The longest occurring suffix of every prefix of the read starts
+#    no further left as the prefix grows, hence the match of a prefix is an SMEM when the match of the next longer
+#    prefix starts further right, or when the prefix is the whole read. Prefixes of all the reads of a batch are
+#    searched in lockstep by bwt_fmindex.bwm_longest_suffix_batch, matches being broken at non ACGT read bases.
+# -- chaining: up to max_occurrences occurrences of every SMEM at least min_seed_length long are located as seeds.
+#    Seeds on the same strand, increasing along both the read and the reference, whose diagonals, i.e. reference
+#    offset minus read offset, are at most band_width apart are chained, and the chain covering most read bases wins.
+# -- extension: the read is aligned around the diagonals of the best chain by a banded alignment with affine gap
+#    penalties, either end of the read being soft clipped at a clip_penalty cost, as bwa mem extends its seeds.
+#
+# Alignments are returned as reference offset, CIGAR operations numbered as pysam cigartuples and score, hence they are
+# counted by mrcommon.pileup.Pileup.add_alignment as mr-bwa counts the alignments of bwa mem, whose default scoring is
+# used.
+
+# minimum length of the SMEMs used as seeds
+MIN_SEED_LENGTH = 19
+# maximum number of occurrences located per SMEM, occurrences of repetitive SMEMs being taken in bwm order
+MAX_SEED_OCCURRENCES = 20
+# maximum distance between the diagonals of chained seeds, and band around them explored by the extension
+BAND_WIDTH = 16
+MATCH_SCORE = 1
+MISMATCH_PENALTY = 4
+# penalty of a base aligned to a non ACGT base
+AMBIGUOUS_PENALTY = 1
+# a gap of length k costs GAP_OPEN_PENALTY + k * GAP_EXTEND_PENALTY
+GAP_OPEN_PENALTY = 6
+GAP_EXTEND_PENALTY = 1
+# penalty of soft clipping either end of the read
+CLIP_PENALTY = 5
+# minimum score of a returned alignment, excluding clip penalties
+MIN_SCORE = 30
+# number of reads whose SMEMs are searched together in lockstep
+SEED_BATCH_SIZE = 256
+
+# maps non ACGT bases to N, scored as ambiguous
+AMBIGUOUS_TABLE = ''.join(chr(i) if chr(i) in 'ACGT' else 'N' for i in xrange(256))
+ALIGNMENT_BASES = 'ACGTN'
+# score of every pair of query and reference bases, by query base then reference base
+SCORES = dict((a, dict((b, -AMBIGUOUS_PENALTY if 'N' in (a, b) else MATCH_SCORE if a == b else -MISMATCH_PENALTY)
+                       for b in ALIGNMENT_BASES)) for a in ALIGNMENT_BASES)
+# score of cells out of the band or of the reference window
+NEGATIVE_INFINITY = -(1 << 30)
+
+# traceback of a banded alignment cell: source of its score, in the 2 low bits, and whether its gap scores extend a
+# gap rather than open one
+TRACE_START, TRACE_MATCH, TRACE_DELETION, TRACE_INSERTION = range(4)
+TRACE_SOURCE_MASK = 3
+TRACE_DELETION_EXTENDED = 4
+TRACE_INSERTION_EXTENDED = 8
+# traceback states
+STATE_H, STATE_DELETION, STATE_INSERTION = range(3)
+
+
+# Returns the SMEMs of each read
+#
+# @param the fm-index
+# @param list of reads
+# @param minimum SMEM length
+# @returns list for each read of lists of (read start, read end, l, r) tuples, SMEMs being ordered by read end, read
+# end and r being exclusive
+def smems_batch(bwt_fmindex, reads, min_length=MIN_SEED_LENGTH):
+    # every read prefix at least min_length long is searched from the last non ACGT base before its end, as shorter
+    # prefixes cannot end with a long enough SMEM
+    queries = []
+    query_ends = []
+    for read in reads:
+        ends = []
+        query_start = 0
+        for end in xrange(1, len(read) + 1):
+            if AMBIGUOUS_TABLE[ord(read[end - 1])] == 'N':
+                query_start = end
+            elif end - query_start >= min_length:
+                queries.append(read[query_start:end])
+                ends.append((query_start, end))
+        query_ends.append(ends)
+    matches = iter(bwm_longest_suffix_batch(bwt_fmindex, queries))
+
+    smems = []
+    for read, ends in zip(reads, query_ends):
+        # (read start, read end, l, r) of the longest match ending at each searched prefix end
+        read_matches = [(query_start + start, end, l, r) for (query_start, end), (start, l, r) in zip(ends, matches)]
+        read_smems = []
+        for i, (start, end, l, r) in enumerate(read_matches):
+            # a match is contained in the match of the next prefix when both start at the same read base
+            if i + 1 < len(read_matches) and read_matches[i + 1][1] == end + 1 and read_matches[i + 1][0] == start:
+                continue
+            if end - start >= min_length:
+                read_smems.append((start, end, l, r))
+        smems.append(read_smems)
+    return smems
+
+
+# Locates the occurrences of the SMEMs of a read as seeds on the forward strand
+#
+# @param the fm-index
+# @param the reference.Reference the index is built over
+# @param read length
+# @param SMEMs of the read, as returned by smems_batch
+# @param length of the forward strand for a both strands index, None if the index holds the forward strand only
+# @param maximum number of occurrences located per SMEM
+# @returns list of (reverse, reference offset, read offset, length) tuples, the read offset of a seed on the reverse
+# strand being that within the reverse complement of the read
+def locate_seeds(bwt_fmindex, reference, read_length, smems, forward_length=None,
+                 max_occurrences=MAX_SEED_OCCURRENCES):
+    seeds = []
+    for start, end, l, r in smems:
+        for row in xrange(l, min(r, l + max_occurrences)):
+            hit = forward_strand_hit(resolve(bwt_fmindex, row), end - start, forward_length)
+            # seeds across both strands or across the boundary of two contigs are left out
+            if hit is None or not reference.within_contig(hit[0], end - start):
+                continue
+            offset, reverse = hit
+            seeds.append((reverse, offset, read_length - end if reverse else start, end - start))
+    return seeds
+
+
+# Returns the best chain of seeds, i.e. the chain of colinear seeds covering most read bases
+#
+# @param list of seeds, as returned by locate_seeds
+# @param read length
+# @param maximum distance between the diagonals of chained seeds
+# @returns tuple of strand, lowest and highest diagonal of the chain and its first seed, None if there are no seeds
+def best_chain(seeds, read_length, band_width=BAND_WIDTH):
+    if not seeds:
+        return None
+    seeds = sorted(seeds)
+    # number of read bases covered by the best chain ending at each seed, and the seed before it
+    scores = []
+    previous = []
+    first = 0
+    for i, (reverse, offset, start, length) in enumerate(seeds):
+        while seeds[first][0] != reverse or seeds[first][1] < offset - read_length - band_width:
+            first += 1
+        score, best = length, None
+        for j in xrange(first, i):
+            chained_reverse, chained_offset, chained_start, chained_length = seeds[j]
+            if chained_start < start and chained_offset < offset and \
+                    abs((offset - start) - (chained_offset - chained_start)) <= band_width:
+                overlap = max(0, chained_start + chained_length - start)
+                if scores[j] + length - overlap > score:
+                    score, best = scores[j] + length - overlap, j
+        scores.append(score)
+        previous.append(best)
+
+    i = max(xrange(len(seeds)), key=lambda k: (scores[k], -k))
+    chain = []
+    while i is not None:
+        chain.append(seeds[i])
+        i = previous[i]
+    diagonals = [offset - start for reverse, offset, start, length in chain]
+    return chain[0][0], min(diagonals), max(diagonals), chain[-1]
+
+
+# Aligns the query to the reference within a band of diagonals, with affine gap penalties. The alignment may start and
+# end anywhere in the reference, while leaving out a prefix or suffix of the query costs clip_penalty each.
+#
+# @param query
+# @param reference window, in upper case
+# @param lowest diagonal, i.e. reference index minus query index, of the band
+# @param highest diagonal of the band
+# @param penalty of soft clipping either end of the query
+# @returns tuple of the reference index of the first aligned base, cigartuples including soft clips and score
+# excluding clip penalties, None if the band does not cross the reference window
+def banded_align(query, ref, lo, hi, clip_penalty=CLIP_PENALTY):
+    query = query.translate(AMBIGUOUS_TABLE)
+    ref = ref.translate(AMBIGUOUS_TABLE)
+    n, m = len(query), len(ref)
+    width = hi - lo + 1
+    gap_open = GAP_OPEN_PENALTY + GAP_EXTEND_PENALTY
+    gap_extend = GAP_EXTEND_PENALTY
+
+    # cell k of row i stands for reference index j = i + lo + k, i.e. j query bases and i reference bases consumed
+    h = [0 if 0 <= lo + k <= m else NEGATIVE_INFINITY for k in xrange(width)]
+    f = [NEGATIVE_INFINITY] * width
+    traces = [bytearray(width)]
+    best_score, best_cell = NEGATIVE_INFINITY, None
+    for k in xrange(width):
+        if h[k] - clip_penalty > best_score:
+            best_score, best_cell = h[k] - clip_penalty, (0, k)
+
+    for i in xrange(1, n + 1):
+        scores = SCORES[query[i - 1]]
+        previous_h, previous_f = h, f
+        h = [NEGATIVE_INFINITY] * width
+        f = [NEGATIVE_INFINITY] * width
+        trace = bytearray(width)
+        e = NEGATIVE_INFINITY
+        # score of query bases left out before the alignment
+        start_score = -clip_penalty
+        end_penalty = 0 if i == n else clip_penalty
+        for k in xrange(max(0, -i - lo), min(width, m - i - lo + 1)):
+            j = i + lo + k
+            t = 0
+
+            # deletion, from the cell to the left in this row
+            if k > 0:
+                opened, extended = h[k - 1] - gap_open, e - gap_extend
+                if extended >= opened:
+                    e = extended
+                    t |= TRACE_DELETION_EXTENDED
+                else:
+                    e = opened
+            else:
+                e = NEGATIVE_INFINITY
+
+            # insertion, from the cell above in the previous row
+            if k + 1 < width:
+                opened, extended = previous_h[k + 1] - gap_open, previous_f[k + 1] - gap_extend
+                if extended >= opened:
+                    f[k] = extended
+                    t |= TRACE_INSERTION_EXTENDED
+                else:
+                    f[k] = opened
+
+            score, source = start_score, TRACE_START
+            if j > 0:
+                match = previous_h[k] + scores[ref[j - 1]]
+                if match > score:
+                    score, source = match, TRACE_MATCH
+            if e > score:
+                score, source = e, TRACE_DELETION
+            if f[k] > score:
+                score, source = f[k], TRACE_INSERTION
+            h[k] = score
+            trace[k] = t | source
+            if score - end_penalty > best_score:
+                best_score, best_cell = score - end_penalty, (i, k)
+        traces.append(trace)
+
+    if best_cell is None:
+        return None
+
+    # trace back from the best cell
+    i, k = best_cell
+    end = i
+    ref_end = i + lo + k
+    operations = []
+    state = STATE_H
+    while True:
+        t = traces[i][k]
+        if state == STATE_H:
+            source = t & TRACE_SOURCE_MASK
+            if source == TRACE_START:
+                break
+            elif source == TRACE_MATCH:
+                operations.append(CIGAR_MATCH)
+                i -= 1
+            elif source == TRACE_DELETION:
+                state = STATE_DELETION
+            else:
+                state = STATE_INSERTION
+        elif state == STATE_DELETION:
+            operations.append(CIGAR_DELETION)
+            state = STATE_DELETION if t & TRACE_DELETION_EXTENDED else STATE_H
+            k -= 1
+        else:
+            operations.append(CIGAR_INSERTION)
+            state = STATE_INSERTION if t & TRACE_INSERTION_EXTENDED else STATE_H
+            i -= 1
+            k += 1
+    ref_start = i + lo + k
+
+    cigartuples = [(CIGAR_SOFT_CLIP, i)] if i > 0 else []
+    cigartuples.extend((operation, len(list(run))) for operation, run in groupby(reversed(operations)))
+    if end < n:
+        cigartuples.append((CIGAR_SOFT_CLIP, n - end))
+    score = best_score + (clip_penalty if i > 0 else 0) + (clip_penalty if end < n else 0)
+    if ref_start == ref_end:
+        return None
+    return ref_start, cigartuples, score
+
+
+# Aligns a read by seed and extend
+#
+# @param the fm-index
+# @param the reference.Reference the index is built over
+# @param read
+# @param SMEMs of the read, as returned by smems_batch
+# @param length of the forward strand for a both strands index, None if the index holds the forward strand only
+# @param maximum number of occurrences located per SMEM
+# @param maximum distance between the diagonals of chained seeds, and band around them explored by the extension
+# @param minimum alignment score
+# @returns tuple of reference offset of the first aligned base, cigartuples, score and whether the read is aligned to
+# the reverse strand, its reverse complement being aligned. None if the read is not aligned
+def align_read(bwt_fmindex, reference, read, smems, forward_length=None, max_occurrences=MAX_SEED_OCCURRENCES,
+               band_width=BAND_WIDTH, min_score=MIN_SCORE):
+    chain = best_chain(locate_seeds(bwt_fmindex, reference, len(read), smems, forward_length, max_occurrences),
+                       len(read), band_width)
+    if chain is None:
+        return None
+    reverse, lowest_diagonal, highest_diagonal, (_, seed_offset, _, _) = chain
+    query = reverse_complement(read) if reverse else read
+
+    # the reference window spans the band around the chain, within the contig of its seeds
+    contig = reference.locate(seed_offset)[0]
+    window_start = max(reference.offsets[contig], lowest_diagonal - band_width)
+    window_end = min(reference.contig_end(contig), highest_diagonal + len(read) + band_width)
+    alignment = banded_align(query, reference[window_start:window_end].upper(),
+                             lowest_diagonal - band_width - window_start, highest_diagonal + band_width - window_start)
+    if alignment is None or alignment[2] < min_score:
+        return None
+    ref_start, cigartuples, score = alignment
+    return window_start + ref_start, cigartuples, score, reverse
+
+
+# Aligns reads by seed and extend, searching the SMEMs of SEED_BATCH_SIZE reads at a time in lockstep
+#
+# @param the fm-index
+# @param the reference.Reference the index is built over
+# @param list of reads
+# @param length of the forward strand for a both strands index, None if the index holds the forward strand only
+# @param minimum SMEM length
+# @param maximum number of occurrences located per SMEM
+# @param maximum distance between the diagonals of chained seeds, and band around them explored by the extension
+# @param minimum alignment score
+# @returns list of alignments as returned by align_read, in the same order as the reads
+def align_batch(bwt_fmindex, reference, reads, forward_length=None, min_seed_length=MIN_SEED_LENGTH,
+                max_occurrences=MAX_SEED_OCCURRENCES, band_width=BAND_WIDTH, min_score=MIN_SCORE):
+    alignments = []
+    for batch_start in xrange(0, len(reads), SEED_BATCH_SIZE):
+        batch = reads[batch_start:batch_start + SEED_BATCH_SIZE]
+        for read, smems in zip(batch, smems_batch(bwt_fmindex, batch, min_seed_length)):
+            alignments.append(align_read(bwt_fmindex, reference, read, smems, forward_length, max_occurrences,
+                                         band_width, min_score))
+    return alignments
@@ -1,4 +1,6 @@
 import logging
+import os
+import resource
 
 # setup console logging
 
@@ -27,4 +29,42 @@ def query_bps_count_index(query_bp):
         'D': 4,
         'N': 5
     }
-    return switcher.get(query_bp)
\ No newline at end of file
+    return switcher.get(query_bp)
+
+# separates the reads of an input line holding a batch of reads, as written by parse_fq_file.py --reads-per-line
+MR_READS_SEPARATOR = '\t'
+
+# prefix of the environment variables configuring the job, e.g. set via hadoop streaming -cmdenv
+ENV_PREFIX = 'MRBWTFM_'
+
+
+# returns the integer value of an environment variable, e.g. set via hadoop streaming -cmdenv, or default if not set
+def env_int(name, default):
+    value = os.environ.get(name)
+    if value is None or value.strip() == '':
+        return default
+    return int(value)
+
+
+# returns True if an environment variable is set to a true value such as 1, true or yes
+def env_flag(name, default=False):
+    value = os.environ.get(name)
+    if value is None or value.strip() == '':
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# returns the current resident set size of this process in bytes, or None if it cannot be determined
+def current_rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+# returns the peak resident set size in bytes of this process, or of its terminated and waited for child processes
+def peak_rss(children=False):
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux
+    return usage.ru_maxrss * 1024
@@ -0,0 +1,59 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+
+import bwt_blockwise
+import bwt_fmindex
+from packed_bwt import np
+
+
+# Runs with: python -m unittest discover -s tests, from the mr-bwt-fm directory
+@unittest.skipIf(np is None, 'numpy is required for the blockwise index construction')
+class BlockwiseTest(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(23)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def random_text(self, length, alphabet='ACGT'):
+        return ''.join(self.random.choice(alphabet) for _ in xrange(length))
+
+    def bucket_sizes(self, text, bucket_size, prefix_length=bwt_blockwise.PREFIX_LENGTH):
+        buckets = bwt_blockwise.distribute_suffixes(text, self.directory, bucket_size, prefix_length)
+        sizes = [size for bucket, first_row, size in buckets]
+        self.assertEqual(sum(sizes), len(text))
+        self.assertEqual([first_row for bucket, first_row, size in buckets],
+                         [sum(sizes[:i]) for i in xrange(len(sizes))])
+        return sizes
+
+    # all the suffixes in a long run of N share their prefix, yet must not make a single bucket
+    def test_long_n_run(self):
+        text = self.random_text(3000) + 'N' * 200000 + self.random_text(3000) + bwt_fmindex.dollar_initial_char
+        self.assertLessEqual(max(self.bucket_sizes(text, 4096)), 4096)
+
+    # many runs of a same length are keyed again by the text following them
+    def test_many_runs(self):
+        text = ''.join('A' * 12 + self.random_text(20) for _ in xrange(2000)) + bwt_fmindex.dollar_initial_char
+        self.assertLessEqual(max(self.bucket_sizes(text, 500)), 500)
+
+    def test_same_index(self):
+        for bucket_size, prefix_length in ((1, 1), (7, 3), (64, 8)):
+            text = self.random_text(300) + 'N' * 500 + self.random_text(300, 'AN') + 'A' * 40 + \
+                self.random_text(300, 'ACGTN')
+            expected = bwt_fmindex.make_index(text, ssaIval=4)
+            index = bwt_blockwise.make_index(text, ssaIval=4, bucket_size=bucket_size, tmp_dir=self.directory,
+                                             prefix_length=prefix_length, workers=2)
+            self.assertEqual(index[0].words, expected[0].words)
+            self.assertEqual(index[1].values, expected[1].values)
+            self.assertEqual(index[3], expected[3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,4 @@
+# Modules shared by the MR-BWA and MR-BWT-FM jobs: pileup of aligned reads, intermediate records, total order partition
+# files and fastq preprocessing. Settings read from the environment are named after the prefix of each job, i.e.
+# MRBWA_ or MRBWTFM_, which callers pass in. The mr-bwa/src/mrcommon and mr-bwt-fm/src/mrcommon links ship this package
+# with each job.
@@ -0,0 +1,164 @@
+from itertools import islice
+import gzip
+import multiprocessing
+import os
+import signal
+from subprocess import Popen, PIPE
+import sys
+
+# Reading and preprocessing of fastq files into the line based input of MapReduce jobs.
+#
+# Input fastq files may be plain or gzip compressed, including the BGZF files of the 1000 Genomes project which are
+# series of gzip members. Compressed input is decompressed by an external pigz or gzip process when installed, which
+# runs in parallel with parsing and whose exit status is checked once its output is read, otherwise by the gzip module,
+# so that truncated input fails instead of being silently cut short. Reads are processed in batches converted by a
+# function of the calling preprocessor, either in process or by a pool of worker processes, and batches are written out
+# in order to a single output, possibly stdout, or dealt round robin to a number of chunk files of balanced size.
+
+GZIP_MAGIC = '\x1f\x8b'
+# size of the buffers used for reading input and writing output
+BUFFER_SIZE = 4 * 1024 * 1024
+# decompressors tried in turn for gzip compressed input, pigz decompressing in a separate thread
+DECOMPRESSORS = (['pigz', '-dc'], ['gzip', '-dc'])
+
+
+# Output of a decompressor process, read as a file of lines. The process exit status is checked when closed, since a
+# truncated or corrupt gzip file only shows as a shorter output followed by a non-zero exit status
+class DecompressorOutput(object):
+    def __init__(self, process, decompressor, filename):
+        self.process = process
+        self.decompressor = decompressor
+        self.filename = filename
+
+    def __iter__(self):
+        return iter(self.process.stdout)
+
+    def read(self, size=-1):
+        return self.process.stdout.read(size)
+
+    def readline(self, size=-1):
+        return self.process.stdout.readline(size)
+
+    # Closes the output and waits for the decompressor to exit
+    #
+    # @raises IOError if the decompressor failed. Closing before the end of the output makes the decompressor exit on
+    #         SIGPIPE, which is no failure
+    def close(self):
+        if self.process.stdout.closed:
+            return
+        self.process.stdout.close()
+        status = self.process.wait()
+        if status not in (0, -signal.SIGPIPE):
+            raise IOError('{0} exited with status {1} while decompressing {2}'.format(self.decompressor, status,
+                                                                                     self.filename))
+
+
+# Restores the default SIGPIPE action, which python ignores and its child processes would otherwise inherit
+def restore_sigpipe():
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+# Opens a fastq file for reading, decompressing it if gzip compressed
+#
+# @param fastq file name, '-' standing for stdin
+# @returns file object of the uncompressed fastq lines, whose close raises IOError if the decompressor failed
+def open_fastq(filename):
+    if filename == '-':
+        return sys.stdin
+
+    with open(filename, 'rb') as f:
+        compressed = f.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+    if not compressed:
+        return open(filename, 'rb', BUFFER_SIZE)
+
+    for decompressor in DECOMPRESSORS:
+        try:
+            process = Popen(decompressor + [filename], stdout=PIPE, bufsize=BUFFER_SIZE, preexec_fn=restore_sigpipe)
+            return DecompressorOutput(process, decompressor[0], filename)
+        except OSError:
+            # decompressor not installed
+            continue
+    return gzip.open(filename, 'rb')
+
+
+# Reads a fastq file in batches of whole reads
+#
+# @param file object of fastq lines
+# @param number of reads per batch
+# @returns generator of lists of 4 x number of reads fastq lines, the last batch holding the remaining reads. An
+#          incomplete read at the end of a truncated file is dropped
+def read_batches(fastq_file, batch_size=10000):
+    while True:
+        lines = list(islice(fastq_file, 4 * batch_size))
+        if len(lines) % 4:
+            sys.stderr.write('Dropped incomplete read of {0} lines at end of input\n'.format(len(lines) % 4))
+            del lines[-(len(lines) % 4):]
+        if not lines:
+            break
+        yield lines
+
+
+# Returns the output file names of a preprocessor
+#
+# @param output file name, '-' standing for stdout
+# @param number of chunk files to split the output into, 1 for a single output file
+# @returns list of file names, suffixed by the chunk number if the output is split in chunks
+def output_filenames(output_filename, chunks=1):
+    if chunks <= 1:
+        return [output_filename]
+    return ['{0}.{1:05d}'.format(output_filename, i) for i in xrange(chunks)]
+
+
+# Converts a fastq file into MapReduce input
+#
+# @param input fastq file name, '-' standing for stdin
+# @param output file name, '-' standing for stdout
+# @param function converting a batch of fastq lines into output text, which must be picklable if workers > 1
+# @param number of chunk files to split the output into, each batch of reads going to the next chunk in turn
+# @param number of worker processes converting batches, 1 converting them in this process
+# @param number of reads per batch
+# @returns number of batches written out
+def convert(input_filename, output_filename, convert_batch, chunks=1, workers=1, batch_size=10000):
+    fastq_file = open_fastq(input_filename)
+    filenames = output_filenames(output_filename, chunks)
+    output_files = [sys.stdout if filename == '-' else open(filename, 'wb', BUFFER_SIZE) for filename in filenames]
+
+    pool = None
+    batches = read_batches(fastq_file, batch_size)
+    if workers > 1:
+        # batches are converted in parallel but returned in order
+        pool = multiprocessing.Pool(workers)
+        converted_batches = pool.imap(convert_batch, batches)
+    else:
+        converted_batches = (convert_batch(lines) for lines in batches)
+
+    count = 0
+    try:
+        for text in converted_batches:
+            output_files[count % len(output_files)].write(text)
+            count += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for output_file in output_files:
+            if output_file is sys.stdout:
+                output_file.flush()
+            else:
+                output_file.close()
+        if fastq_file is not sys.stdin:
+            fastq_file.close()
+
+    return count
+
+
+# Returns the number of worker processes to use, 0 standing for one per core
+def worker_count(workers):
+    if workers <= 0:
+        return multiprocessing.cpu_count()
+    return workers
+
+
+# Checks that an input fastq file exists, '-' standing for stdin
+def is_valid_input(filename):
+    return filename == '-' or os.path.isfile(filename)
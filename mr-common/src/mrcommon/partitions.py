@@ -0,0 +1,190 @@
+import argparse
+import os
+from os.path import isfile
+import struct
+from mrcommon.records import BIN_SIZE_ENV, RECORD_FORMATS, bin_size, genome_key, parse_genome_key, read_records, \
+    record_format, typed_bytes, TYPE_BYTES
+
+# Writes the partition file of the hadoop TotalOrderPartitioner, i.e. the numReduceTasks - 1 genome keys splitting the
+# mapper output keys in ranges of about the same number of records. Since genome keys sort in genome order, the part
+# file of each reducer holds a range of the genome and part files are concatenated in genome order.
+#
+# Split keys are either spread evenly over the reference genome coordinates, or taken as quantiles of a sample of
+# mapper output, e.g. the output of mapper_pybwa.py or mapper_native.py for a few thousand reads, which follows the
+# actual coverage. Each job reads the contig lengths of its own reference genome, and runs main from its
+# make_partitions.py. When records are binned, split keys fall on bin starts, see split_key.
+
+# SequenceFile header, as written by org.apache.hadoop.io.SequenceFile.Writer version 6
+SEQUENCE_FILE_MAGIC = 'SEQ\x06'
+# key classes of the partition file, which must be the map output key class
+KEY_CLASSES = {
+    'text': 'org.apache.hadoop.io.Text',
+    'typedbytes': 'org.apache.hadoop.typedbytes.TypedBytesWritable',
+}
+VALUE_CLASS = 'org.apache.hadoop.io.NullWritable'
+INT_FORMAT = struct.Struct('>i')
+
+
+# Returns a number serialized as by org.apache.hadoop.io.WritableUtils.writeVLong
+def vlong(value):
+    if -112 <= value <= 127:
+        return struct.pack('>b', value)
+
+    length = -112
+    if value < 0:
+        value ^= -1
+        length = -120
+    nbytes = 0
+    tmp = value
+    while tmp != 0:
+        tmp >>= 8
+        nbytes += 1
+    return struct.pack('>b', length - nbytes) + ''.join(
+        chr((value >> (8 * i)) & 0xff) for i in xrange(nbytes - 1, -1, -1))
+
+
+# Returns a string serialized as by org.apache.hadoop.io.Text.write
+def text_writable(value):
+    return vlong(len(value)) + value
+
+
+# Writes an uncompressed SequenceFile of keys and NullWritable values
+#
+# @param filename to write to
+# @param serialized keys
+# @param key class name
+def write_sequence_file(filename, keys, key_class):
+    sync = os.urandom(16)
+    with open(filename, 'wb') as f:
+        f.write(SEQUENCE_FILE_MAGIC)
+        f.write(text_writable(key_class))
+        f.write(text_writable(VALUE_CLASS))
+        # not compressed, not block compressed, no metadata
+        f.write('\x00\x00')
+        f.write(INT_FORMAT.pack(0))
+        f.write(sync)
+        for key in keys:
+            # record length, key length, key and empty NullWritable value
+            f.write(INT_FORMAT.pack(len(key)) + INT_FORMAT.pack(len(key)) + key)
+
+
+# Writes the partition file for the given genome keys
+#
+# @param filename to write to
+# @param sorted split genome keys
+# @param record format of the mapper output
+def write_partition_file(filename, keys, records_format='text'):
+    if records_format == 'typedbytes':
+        # TypedBytesWritable serializes as BytesWritable, i.e. the length of the typed bytes object and the object
+        serialized_keys = [INT_FORMAT.pack(len(typed_bytes(TYPE_BYTES, key))) + typed_bytes(TYPE_BYTES, key)
+                           for key in keys]
+    else:
+        serialized_keys = [text_writable(key) for key in keys]
+    write_sequence_file(filename, serialized_keys, KEY_CLASSES[records_format])
+
+
+# Returns the split key of a reference position, rounded down to the start of its bin, with insertion ordinal 0.
+# Hence the records of a whole bin, i.e. the bin record keyed by its start and the insertion records keyed by the
+# positions it holds, go to the same reducer, whose part file stays in genome order once bins are expanded back
+#
+# @param chromosome ordinal
+# @param reference position
+# @param number of reference positions per bin, 0 if records are not binned
+# @param record format
+def split_key(chromosome, position, records_bin_size=0, records_format='text'):
+    if records_bin_size > 0:
+        position -= position % records_bin_size
+    return genome_key(position, chromosome, record_format=records_format)
+
+
+# Checks that split keys are strictly increasing, as required by the TotalOrderPartitioner, which also requires exactly
+# one key less than reducers, hence keys rounded down to the same bin cannot be merged
+def check_split_keys(split_keys):
+    for key, next_key in zip(split_keys, split_keys[1:]):
+        if key >= next_key:
+            raise ValueError('Split keys fall in the same bin, use fewer reducers or a smaller bin size')
+
+
+# Returns split keys spread evenly over the reference genome coordinates, i.e. over the contigs laid end to end
+#
+# @param lengths of the reference contigs, in reference order
+# @param number of reducers
+# @param record format
+# @param number of reference positions per bin, 0 if records are not binned
+def coordinate_split_keys(contig_lengths, reducers, records_format='text', records_bin_size=0):
+    genome_length = sum(contig_lengths)
+    split_keys = []
+    chromosome = contig_start = 0
+    for i in xrange(1, reducers):
+        offset = genome_length * i // reducers
+        while offset >= contig_start + contig_lengths[chromosome]:
+            contig_start += contig_lengths[chromosome]
+            chromosome += 1
+        split_keys.append(split_key(chromosome, offset - contig_start, records_bin_size, records_format))
+    check_split_keys(split_keys)
+    return split_keys
+
+
+# Returns split keys taken as quantiles of sampled mapper output keys. Insertion ordinals are dropped, so that the
+# insertions following a reference position go to the same reducer as the position
+#
+# @param sampled mapper output, in text format
+# @param number of reducers
+# @param record format
+# @param number of reference positions per bin, 0 if records are not binned
+def sampled_split_keys(sample, reducers, records_format='text', records_bin_size=0):
+    keys = sorted(parse_genome_key(key) for key, value in read_records(sample))
+    if len(keys) < reducers:
+        raise ValueError('Sample of {0} keys is too small for {1} reducers'.format(len(keys), reducers))
+
+    split_keys = []
+    for i in xrange(1, reducers):
+        chromosome, position, insertion = keys[len(keys) * i // reducers]
+        split_keys.append(split_key(chromosome, position, records_bin_size, records_format))
+    check_split_keys(split_keys)
+    return split_keys
+
+
+# Creates the total order partition file for a given number of reducers, as parsed from the command line
+#
+# @param prefix of the job environment variables, e.g. MRBWA_
+# @param function returning the list of contig lengths, in reference order, read from the reference file
+# @param command line option of the reference file
+# @param default reference filename
+# @param help of the reference option
+def main(env_prefix, read_contig_lengths, reference_option, reference_default, reference_help):
+    parser = argparse.ArgumentParser(description='Creates the total order partition file for a given number of '
+                                                 'reducers')
+    parser.add_argument('reducers', type=int)
+    parser.add_argument('output_file')
+    parser.add_argument(reference_option, dest='reference', default=reference_default,
+                        help=reference_help + ' (default: %(default)s)')
+    parser.add_argument('--sample', help='sample of mapper output in text format, whose key quantiles are used '
+                                         'instead of the reference genome coordinates')
+    parser.add_argument('--record-format', default=record_format(env_prefix), choices=RECORD_FORMATS,
+                        help='record format of the MapReduce job (default: %(default)s)')
+    parser.add_argument('--bin-size', type=int, default=bin_size(env_prefix),
+                        help='number of reference positions per bin record of the MapReduce job, split keys being '
+                             'aligned to bin starts, 0 if records are not binned (default: %(default)s, as set by '
+                             'the {0}{1} environment variable)'.format(env_prefix, BIN_SIZE_ENV))
+    args = parser.parse_args()
+
+    if args.reducers < 1:
+        print 'Number of reducers must be at least 1'
+        os.abort()
+
+    if args.sample is not None:
+        if not isfile(args.sample):
+            print 'Sample file does not exist'
+            os.abort()
+        with open(args.sample) as sample:
+            split_keys = sampled_split_keys(sample, args.reducers, args.record_format, args.bin_size)
+    else:
+        if not isfile(args.reference):
+            print 'Reference genome file does not exist'
+            os.abort()
+        split_keys = coordinate_split_keys(read_contig_lengths(args.reference), args.reducers, args.record_format,
+                                           args.bin_size)
+
+    write_partition_file(args.output_file, split_keys, args.record_format)
+    print 'Written {0} split keys for {1} reducers'.format(len(split_keys), args.reducers)
@@ -0,0 +1,204 @@
+from array import array
+
+# ACGTDN counts per reference position, as accumulated by the mappers of both jobs.
+#
+# Counts are kept in fixed size blocks of consecutive reference positions, each block being a flat array of
+# block_size x ACGTDN counts keyed by the offset of each position from the block start, hence counting a base is a
+# single array increment. Aligned reads are added by walking their CIGAR operations, as numbered by pysam cigartuples,
+# whether written out by bwa mem or derived by the seed and extend aligner of mr-bwt-fm. Insertions, keyed by the
+# reference position they follow and their insertion ordinal, are rare and kept apart.
+
+# bases counted per reference position, D standing for deletion and N for no-call
+BASES = 'ACGTDN'
+COUNTS_PER_POSITION = len(BASES)
+# translation table mapping each base to its index in the ACGTDN counts. Any other base counts as N
+BASE_INDEX_TABLE = ''.join(chr(BASES.index(chr(i).upper())) if chr(i).upper() in BASES else chr(BASES.index('N'))
+                           for i in xrange(256))
+
+# CIGAR operations, as numbered in pysam cigartuples
+CIGAR_MATCH, CIGAR_INSERTION, CIGAR_DELETION, CIGAR_REF_SKIP, CIGAR_SOFT_CLIP, CIGAR_HARD_CLIP, CIGAR_PAD, \
+    CIGAR_EQUAL, CIGAR_DIFF = range(9)
+# operations aligning query bases to reference positions
+CIGAR_ALIGNED = (CIGAR_MATCH, CIGAR_EQUAL, CIGAR_DIFF)
+# operations of reference positions missing from the query, counted as deletions
+CIGAR_DELETED = (CIGAR_DELETION, CIGAR_REF_SKIP)
+# operations of query bases missing from the reference
+CIGAR_UNALIGNED = (CIGAR_INSERTION, CIGAR_SOFT_CLIP)
+
+
+# Returns the query indexes taken as inserted bases, as originally derived from the CIGAR operations by mapper_pybwa:
+# each insertion starts at the length of the match operation right before it, or at 0 for a leading insertion, while
+# insertions following any other operation are left out
+#
+# @param cigartuples of an aligned read
+# @returns list of query indexes, in CIGAR order
+def insertion_query_indexes(cigartuples):
+    query_indexes = []
+    for counter, (operation, length) in enumerate(cigartuples):
+        if operation == CIGAR_INSERTION:
+            if counter == 0:
+                query_indexes.extend(xrange(length))
+            elif cigartuples[counter - 1][0] == CIGAR_MATCH:
+                start_index = cigartuples[counter - 1][1]
+                query_indexes.extend(xrange(start_index, start_index + length))
+    return query_indexes
+
+
+# Returns zeroed ACGTDN counts of the given number of consecutive reference positions
+def new_counts(positions):
+    return array('I', [0]) * (positions * COUNTS_PER_POSITION)
+
+
+# Pileup of ACGTDN counts per reference position of one reference sequence, or of the concatenated contigs indexed by
+# mr-bwt-fm, together with the reference base of each position when given by the alignments.
+class Pileup(object):
+    def __init__(self, block_size=256):
+        self.block_size = block_size
+        # block id to counts
+        self.blocks = dict()
+        # block id to reference bases, 0 standing for an unknown base, for the blocks whose reference bases are known
+        self.ref_bases = dict()
+        # (reference position, insertion ordinal) to counts
+        self.insertions = dict()
+
+    # Returns the counts of the given block, creating it if needed
+    def block(self, block_id):
+        counts = self.blocks.get(block_id)
+        if counts is None:
+            counts = self.blocks[block_id] = new_counts(self.block_size)
+        return counts
+
+    # Adds a run of bases aligned to consecutive reference positions starting at ref_index
+    #
+    # @param reference position the first base is aligned to
+    # @param aligned bases, 'D' standing for a deletion
+    # @param reference bases at the aligned positions, or None if not known
+    def add_run(self, ref_index, bases, ref_bases=None):
+        base_indexes = bytearray(bases.translate(BASE_INDEX_TABLE))
+        i = 0
+        while i < len(base_indexes):
+            position = ref_index + i
+            block_id = position // self.block_size
+            counts = self.block(block_id)
+            block_offset = position % self.block_size
+            # bases falling within this block
+            n = min(len(base_indexes) - i, self.block_size - block_offset)
+            offset = block_offset * COUNTS_PER_POSITION
+            for base_index in base_indexes[i:i + n]:
+                counts[offset + base_index] += 1
+                offset += COUNTS_PER_POSITION
+            if ref_bases is not None:
+                block_ref_bases = self.ref_bases.get(block_id)
+                if block_ref_bases is None:
+                    block_ref_bases = self.ref_bases[block_id] = bytearray(self.block_size)
+                for j in xrange(n):
+                    if not block_ref_bases[block_offset + j]:
+                        block_ref_bases[block_offset + j] = ord(ref_bases[i + j].upper())
+            i += n
+
+    # Adds an aligned read by walking its CIGAR operations, aligned and deleted bases being added as runs.
+    #
+    # An unaligned query base, i.e. inserted or soft clipped, is counted as an insertion after the reference position of
+    # the aligned pair before it, in the order returned by pysam get_aligned_pairs wrapping around to the last pair
+    # for the first base, when it is the first of its run in insertion_query_indexes and that pair has a reference
+    # position. Its insertion ordinal is its index in insertion_query_indexes counting from 1. Hence at most the first
+    # base of each unaligned operation is counted.
+    #
+    # @param reference position of the first aligned base
+    # @param cigartuples of the read, as numbered by pysam
+    # @param query sequence, excluding hard clipped bases
+    # @param reference bases at the aligned and deleted positions, as returned by pysam get_reference_sequence, or None
+    # if not known
+    def add_alignment(self, reference_start, cigartuples, query_sequence, ref_sequence=None):
+        # inserted query index to its insertion ordinal
+        insertion_ordinals = dict()
+        if any(operation == CIGAR_INSERTION for operation, length in cigartuples):
+            for i, query_index in enumerate(insertion_query_indexes(cigartuples)):
+                insertion_ordinals.setdefault(query_index, i + 1)
+
+        # reference position of the last aligned pair, i.e. before the first one
+        reference_end = reference_start + sum(length for operation, length in cigartuples
+                                              if operation in CIGAR_ALIGNED or operation in CIGAR_DELETED)
+        last_ref_index = None
+        for operation, length in reversed(cigartuples):
+            if length and operation not in (CIGAR_HARD_CLIP, CIGAR_PAD):
+                if operation not in CIGAR_UNALIGNED:
+                    last_ref_index = reference_end - 1
+                break
+
+        ref_index = reference_start
+        query_index = ref_offset = 0
+        for operation, length in cigartuples:
+            if not length:
+                continue
+
+            if operation in CIGAR_ALIGNED:
+                self.add_run(ref_index, query_sequence[query_index:query_index + length],
+                             ref_sequence[ref_offset:ref_offset + length] if ref_sequence is not None else None)
+                ref_index += length
+                query_index += length
+                ref_offset += length
+                last_ref_index = ref_index - 1
+            elif operation == CIGAR_DELETION:
+                self.add_run(ref_index, 'D' * length,
+                             ref_sequence[ref_offset:ref_offset + length] if ref_sequence is not None else None)
+                ref_index += length
+                ref_offset += length
+                last_ref_index = ref_index - 1
+            elif operation == CIGAR_REF_SKIP:
+                # skipped reference bases are not part of the reference sequence
+                self.add_run(ref_index, 'D' * length)
+                ref_index += length
+                last_ref_index = ref_index - 1
+            elif operation in CIGAR_UNALIGNED:
+                if last_ref_index is not None and query_index in insertion_ordinals and \
+                        query_index - 1 not in insertion_ordinals:
+                    self.add_insertion(last_ref_index, insertion_ordinals[query_index], query_sequence[query_index])
+                query_index += length
+                last_ref_index = None
+
+    # Adds a single inserted base
+    #
+    # @param reference position the insertion follows
+    # @param insertion ordinal, counting from 1
+    # @param inserted base
+    def add_insertion(self, ref_index, insertion, base):
+        key = ref_index, insertion
+        counts = self.insertions.get(key)
+        if counts is None:
+            counts = self.insertions[key] = [0] * COUNTS_PER_POSITION
+        counts[ord(BASE_INDEX_TABLE[ord(base)])] += 1
+
+    # Returns the counts of all blocks, to be written out as bin records
+    #
+    # @returns tuples of block start, reference bases with '\0' standing for an unknown base, and block_size x ACGTDN
+    # counts
+    def bins(self):
+        for block_id, counts in self.blocks.iteritems():
+            ref_bases = self.ref_bases.get(block_id)
+            yield block_id * self.block_size, str(ref_bases) if ref_bases is not None else '\0' * self.block_size, \
+                counts
+
+    # Returns the counts of all insertions, whose reference base is unknown
+    #
+    # @returns tuples of reference position the insertion follows, insertion ordinal, None and list of ACGTDN counts
+    def insertion_items(self):
+        for (ref_index, insertion), counts in self.insertions.iteritems():
+            yield ref_index, insertion, None, counts
+
+    # Returns the counts of all positions having any count, followed by the counts of all insertions
+    #
+    # @returns tuples of reference position, insertion ordinal being 0 but for insertions, reference base or None if
+    # not known, and list of ACGTDN counts
+    def items(self):
+        for block_id, counts in self.blocks.iteritems():
+            block_start = block_id * self.block_size
+            ref_bases = self.ref_bases.get(block_id)
+            for offset in xrange(self.block_size):
+                position_counts = counts[offset * COUNTS_PER_POSITION:(offset + 1) * COUNTS_PER_POSITION]
+                if any(position_counts):
+                    ref_base = chr(ref_bases[offset]) if ref_bases is not None and ref_bases[offset] else None
+                    yield block_start + offset, 0, ref_base, position_counts.tolist()
+
+        for item in self.insertion_items():
+            yield item
@@ -0,0 +1,381 @@
+from array import array
+import base64
+import os
+import struct
+import sys
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is only needed to sum bin counts faster
+    np = None
+
+# Intermediate records exchanged by mappers, combiners and reducers, i.e. the ACGTDN counts of a reference position.
+#
+# Records are keyed by genome keys, i.e. chromosome ordinal, reference position and insertion ordinal, 0 for reference
+# positions, encoded so that keys sort in genome order both as text and as raw bytes. Hence a total order partitioner,
+# whose partition file is written by make_partitions.py, can spread keys across many reducers whose part files are
+# concatenated in genome order.
+#
+# Two record formats are supported, selected by the RECORD_FORMAT environment variable following the prefix of each
+# job, i.e. MRBWA_RECORD_FORMAT or MRBWTFM_RECORD_FORMAT, e.g. set for all tasks via hadoop streaming -cmdenv:
+# -- 'text' lines of key, ref_char;ref_chromosone_name;csv_list of combined counts of ACGTDN, the key being zero
+#    padded 'chromosome:position' followed by '.insertion' for insertions. This is the default
+# -- 'typedbytes' binary records as read and written by hadoop streaming when run with
+#    -D stream.map.output=typedbytes -D stream.reduce.input=typedbytes -D stream.reduce.output=typedbytes
+#    The key is a fixed size raw bytes object holding the big endian chromosome, position and insertion, and the
+#    value is a raw bytes object holding the ref_char, the counts packed in the narrowest of 1, 2 or 4 byte unsigned
+#    integers and any reference name, so combiners and reducers unpack counts in one call instead of splitting and
+#    parsing text.
+#    The reducer still writes out text, as typed strings which the text output format writes out as tsv lines
+#
+# Either way records may also be binned, as set by the BIN_SIZE environment variable, e.g. MRBWA_BIN_SIZE, whereby
+# each record holds the counts of a whole window of bin size consecutive reference positions, keyed by the genome key
+# of its first position, a multiple of the bin size within its chromosome, so that the bins of all mappers line up and
+# partition split keys fall on bin starts. The value is the zlib compressed ref_chars and ACGTDN counts of the window,
+# and any reference name, base64 encoded in text records. Combiners sum bins element-wise and reducers expand them back
+# to one tsv line per reference position. Insertions are rare and still written out as single position records.
+RECORD_FORMATS = ('text', 'typedbytes')
+# environment variables setting the record format and bin size, following the prefix of each job, e.g. MRBWA_
+RECORD_FORMAT_ENV = 'RECORD_FORMAT'
+BIN_SIZE_ENV = 'BIN_SIZE'
+
+# binary genome key, i.e. chromosome, position and insertion
+GENOME_KEY_FORMAT = struct.Struct('>HQI')
+# text genome key, i.e. chromosome and position, followed by INSERTION_KEY_FORMAT for insertions, whose ordinal is
+# padded as wide as its 32 bits binary counterpart
+TEXT_GENOME_KEY_FORMAT = '%05d:%010d'
+INSERTION_KEY_FORMAT = '.%010d'
+
+# typed bytes type codes, as defined by org.apache.hadoop.typedbytes.Type
+TYPE_BYTES = 0
+TYPE_INT = 3
+TYPE_LONG = 4
+TYPE_DOUBLE = 6
+TYPE_STRING = 7
+
+# struct formats of typed bytes fixed size values, big endian
+TYPE_FORMATS = {
+    TYPE_INT: struct.Struct('>i'),
+    TYPE_LONG: struct.Struct('>q'),
+    TYPE_DOUBLE: struct.Struct('>d'),
+}
+LENGTH_FORMAT = struct.Struct('>i')
+TYPE_CODE_FORMAT = struct.Struct('>B')
+
+# packed counts typecodes, narrowest first, together with the largest count each can hold
+COUNTS_TYPECODES = (('B', 0xff), ('H', 0xffff), ('I', 0xffffffff))
+COUNTS_FORMATS = dict((typecode, struct.Struct('>' + typecode * 6)) for typecode, max_count in COUNTS_TYPECODES)
+# header of a packed counts value, i.e. ref_char and counts typecode
+VALUE_HEADER_SIZE = 2
+# length of the reference name of a bin value
+NAME_LENGTH_FORMAT = struct.Struct('>H')
+
+
+# Returns the record format set by the RECORD_FORMAT environment variable of a job, 'text' if not set
+#
+# @param prefix of the job environment variables, e.g. MRBWA_
+def record_format(env_prefix):
+    value = os.environ.get(env_prefix + RECORD_FORMAT_ENV, '').strip().lower() or 'text'
+    if value not in RECORD_FORMATS:
+        raise ValueError('Unknown record format {0}'.format(value))
+    return value
+
+
+# Returns the number of reference positions per bin set by the BIN_SIZE environment variable of a job, 0 if records
+# are not binned
+#
+# @param prefix of the job environment variables, e.g. MRBWA_
+def bin_size(env_prefix):
+    value = os.environ.get(env_prefix + BIN_SIZE_ENV, '').strip()
+    return int(value) if value else 0
+
+
+# Returns the counts of a record packed with the narrowest typecode able to hold them, preceded by the typecode
+#
+# @param list of ACGTDN counts
+# @returns packed counts
+def pack_counts(counts):
+    max_count = max(counts)
+    for typecode, typecode_max_count in COUNTS_TYPECODES:
+        if max_count <= typecode_max_count:
+            return typecode + COUNTS_FORMATS[typecode].pack(*counts)
+    raise ValueError('Count {0} too large to pack'.format(max_count))
+
+
+# Returns the value of a binary record
+#
+# @param reference char, None if not known
+# @param list of ACGTDN counts
+# @param reference name, None if not output
+def pack_value(ref_char, counts, reference_name=None):
+    return (ref_char or '\0') + pack_counts(counts) + (reference_name or '')
+
+
+# Reads back the value of a binary record
+#
+# @param packed value
+# @returns tuple of reference char or None if not known, list of ACGTDN counts and reference name or None
+def unpack_value(value):
+    counts_format = COUNTS_FORMATS[value[1]]
+    counts = list(counts_format.unpack_from(value, VALUE_HEADER_SIZE))
+    ref_char = value[0] if value[0] != '\0' else None
+    return ref_char, counts, value[VALUE_HEADER_SIZE + counts_format.size:] or None
+
+
+# Returns the genome key of a record
+#
+# @param reference position
+# @param chromosome ordinal, i.e. index of the reference sequence
+# @param insertion ordinal, 0 for reference positions
+# @param record format
+def genome_key(position, chromosome=0, insertion=0, record_format='text'):
+    if record_format == 'typedbytes':
+        return GENOME_KEY_FORMAT.pack(chromosome, position, insertion)
+    key = TEXT_GENOME_KEY_FORMAT % (chromosome, position)
+    if insertion:
+        key += INSERTION_KEY_FORMAT % insertion
+    return key
+
+
+# Reads back a genome key
+#
+# @param key returned by read_records
+# @param record format
+# @returns tuple of chromosome ordinal, reference position and insertion ordinal
+def parse_genome_key(key, record_format='text'):
+    if record_format == 'typedbytes':
+        return GENOME_KEY_FORMAT.unpack(key)
+    chromosome, position = key.split(':', 1)
+    position, _, insertion = position.partition('.')
+    return int(chromosome), int(position), int(insertion) if insertion else 0
+
+
+# Returns a reference position formatted for the reducer output, insertions being formatted as 'ref_index.nnnnnnnnnn'
+# with the ordinal padded as INSERTION_KEY_FORMAT, so that positions parsed as decimals stay distinct and in order
+def format_position(position, insertion=0):
+    if insertion:
+        return '%d' % position + INSERTION_KEY_FORMAT % insertion
+    return '%d' % position
+
+
+# Returns the value of a bin record, i.e. the compressed typecode of the packed counts, reference name, ref_chars and
+# packed counts
+#
+# @param ref_chars of the bin positions, '\0' standing for an unknown char
+# @param bin_size x ACGTDN counts
+# @param reference name, None if not output
+def pack_bin(ref_chars, counts, reference_name=None):
+    max_count = max(counts) if len(counts) else 0
+    for typecode, typecode_max_count in COUNTS_TYPECODES:
+        if max_count <= typecode_max_count:
+            break
+    else:
+        raise ValueError('Count {0} too large to pack'.format(max_count))
+
+    if np is not None and isinstance(counts, np.ndarray):
+        packed = array(typecode, counts.astype(np.dtype(typecode)).tostring())
+    else:
+        packed = array(typecode, counts)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    reference_name = reference_name or ''
+    return zlib.compress(typecode + NAME_LENGTH_FORMAT.pack(len(reference_name)) + reference_name + str(ref_chars) +
+                         packed.tostring(), 1)
+
+
+# Reads back the value of a bin record
+#
+# @param bin value
+# @returns tuple of ref_chars, counts, a numpy uint32 array if numpy is available or an array otherwise, and
+# reference name or None
+def unpack_bin(value):
+    data = zlib.decompress(value)
+    typecode = data[0]
+    name_length = NAME_LENGTH_FORMAT.unpack_from(data, 1)[0]
+    header_size = 1 + NAME_LENGTH_FORMAT.size + name_length
+    reference_name = data[1 + NAME_LENGTH_FORMAT.size:header_size] or None
+    itemsize = array(typecode).itemsize
+    nchars = (len(data) - header_size) // (1 + 6 * itemsize)
+    ref_chars = data[header_size:header_size + nchars]
+    packed = array(typecode, data[header_size + nchars:])
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    if np is not None:
+        return ref_chars, np.frombuffer(packed.tostring(), dtype=np.dtype(typecode)).astype(np.uint32), reference_name
+    return ref_chars, array('I', packed), reference_name
+
+
+# Returns the counts of a bin, one item per position having any count
+#
+# @param bin start
+# @param ref_chars returned by unpack_bin
+# @param counts returned by unpack_bin
+# @returns tuples of reference position, ref_char or None if not known and list of ACGTDN counts
+def bin_positions(bin_start, ref_chars, counts):
+    for offset in xrange(len(ref_chars)):
+        position_counts = counts[offset * 6:(offset + 1) * 6]
+        if any(position_counts):
+            ref_char = ref_chars[offset] if ref_chars[offset] != '\0' else None
+            yield bin_start + offset, ref_char, [int(count) for count in position_counts]
+
+
+# Returns a typed bytes object
+#
+# @param type code
+# @param value, a number for fixed size types or a string for bytes and string types
+def typed_bytes(type_code, value):
+    if type_code in TYPE_FORMATS:
+        return TYPE_CODE_FORMAT.pack(type_code) + TYPE_FORMATS[type_code].pack(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return TYPE_CODE_FORMAT.pack(type_code) + LENGTH_FORMAT.pack(len(value)) + value
+
+
+# Reads a typed bytes object
+#
+# @param binary input stream
+# @returns the object value, a number for fixed size types or a string for bytes and string types, or None at the end
+# of the stream
+def read_typed_bytes(data_input):
+    type_code = data_input.read(1)
+    if not type_code:
+        return None
+    type_code = ord(type_code)
+    if type_code in TYPE_FORMATS:
+        return TYPE_FORMATS[type_code].unpack(data_input.read(TYPE_FORMATS[type_code].size))[0]
+    if type_code == TYPE_BYTES or type_code == TYPE_STRING or 50 <= type_code <= 200:
+        # type codes 50 to 200 are application specific and serialized as bytes
+        length = LENGTH_FORMAT.unpack(data_input.read(LENGTH_FORMAT.size))[0]
+        return data_input.read(length)
+    raise ValueError('Unsupported typed bytes type code {0}'.format(type_code))
+
+
+# Reads the records written by mappers or combiners
+#
+# @param input stream
+# @param record format
+# @returns lists of key and value, one record at a time. Keys are parsed by parse_genome_key and values by
+# parse_value or parse_bin_value
+def read_records(data_input, record_format='text', main_separator='\t'):
+    if record_format == 'typedbytes':
+        while True:
+            key = read_typed_bytes(data_input)
+            if key is None:
+                break
+            yield [key, read_typed_bytes(data_input)]
+    else:
+        for line in data_input:
+            # Strip out the separator character
+            yield line.rstrip().split(main_separator, 1)
+
+
+# Parses the value of a bin record returned by read_records
+#
+# @param record value
+# @param record format
+# @returns tuple of ref_chars, counts and reference name, as returned by unpack_bin
+def parse_bin_value(value, record_format='text'):
+    if record_format == 'typedbytes':
+        return unpack_bin(value)
+    return unpack_bin(base64.b64decode(value))
+
+
+# Sums the counts of bin records having the same key element-wise
+#
+# @param bin values returned by read_records
+# @param record format
+# @returns tuple of ref_chars, counts and reference name, as returned by unpack_bin
+def sum_bins(values, record_format='text'):
+    total_ref_chars = total_counts = reference_name = None
+    for value in values:
+        ref_chars, counts, reference_name = parse_bin_value(value, record_format)
+        if total_counts is None:
+            total_ref_chars, total_counts = bytearray(ref_chars), counts
+            continue
+        if np is not None:
+            total_counts = total_counts + counts
+        else:
+            for i, count in enumerate(counts):
+                if count:
+                    total_counts[i] += count
+        # ref_chars may not be known by all records
+        if '\0' in total_ref_chars:
+            for i, ref_char in enumerate(ref_chars):
+                if not total_ref_chars[i]:
+                    total_ref_chars[i] = ref_char
+    return str(total_ref_chars), total_counts, reference_name
+
+
+# Parses the value of a record returned by read_records
+#
+# @param record value
+# @param record format
+# @returns tuple of reference char, list of ACGTDN counts and reference name or None if not part of the record
+def parse_value(value, record_format='text', tuple_separator=';', list_separator=','):
+    if record_format == 'typedbytes':
+        return unpack_value(value)
+    # this represents ref_char;[ref_chromosone_name;]csv_list of combined counts of ACGTDN
+    fields = str(value).split(tuple_separator)
+    counts = [int(count) for count in fields[-1].split(list_separator)]
+    return fields[0], counts, fields[1] if len(fields) > 2 else None
+
+
+# Writes out records to be read by combiners or reducers
+class RecordWriter(object):
+    # @param output stream, e.g. sys.stdout
+    # @param record format
+    def __init__(self, data_output=sys.stdout, record_format='text', main_separator='\t', tuple_separator=';',
+                 list_separator=','):
+        self.data_output = data_output
+        self.record_format = record_format
+        self.main_separator = main_separator
+        self.tuple_separator = tuple_separator
+        self.list_separator = list_separator
+
+    # Returns the genome key of a record in the format written out, see genome_key
+    def key(self, position, chromosome=0, insertion=0):
+        return genome_key(position, chromosome, insertion, self.record_format)
+
+    # Writes out the counts of a reference position
+    #
+    # @param genome key, as returned by key or read_records
+    # @param reference char, None if not known
+    # @param list of ACGTDN counts
+    # @param reference name, None if not output
+    def write(self, key, ref_char, counts, reference_name=None):
+        if self.record_format == 'typedbytes':
+            self.data_output.write(typed_bytes(TYPE_BYTES, key) +
+                                   typed_bytes(TYPE_BYTES, pack_value(ref_char, counts, reference_name)))
+        else:
+            # output format key, ref_char;[ref_chromosone_name;]csv_list of combined counts of ACGTDN
+            fields = [str(ref_char)]
+            if reference_name is not None:
+                fields.append(reference_name)
+            fields.append(self.list_separator.join(str(count) for count in counts))
+            self.data_output.write('%s%s%s\n' % (key, self.main_separator, self.tuple_separator.join(fields)))
+
+    # Writes out the counts of a whole bin
+    #
+    # @param genome key of the first bin position, as returned by key or read_records
+    # @param ref_chars of the bin positions, '\0' standing for an unknown char
+    # @param bin_size x ACGTDN counts
+    # @param reference name, None if not output
+    def write_bin(self, key, ref_chars, counts, reference_name=None):
+        value = pack_bin(ref_chars, counts, reference_name)
+        if self.record_format == 'typedbytes':
+            self.data_output.write(typed_bytes(TYPE_BYTES, key) + typed_bytes(TYPE_BYTES, value))
+        else:
+            self.data_output.write('%s%s%s\n' % (key, self.main_separator, base64.b64encode(value)))
+
+    # Writes out a final output line, i.e. reference position and tab separated fields
+    #
+    # @param reference position, as formatted by format_position
+    # @param list of fields, already formatted as text
+    def write_line(self, ref_index, fields):
+        value = self.main_separator.join(fields)
+        if self.record_format == 'typedbytes':
+            self.data_output.write(typed_bytes(TYPE_STRING, ref_index) + typed_bytes(TYPE_STRING, value))
+        else:
+            self.data_output.write('%s%s%s\n' % (ref_index, self.main_separator, value))
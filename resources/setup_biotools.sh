@@ -30,4 +30,4 @@ make
 sudo cp $HOME/hd_biotools.sh /etc/profile.d/
 
 # install python packages
-sudo pip install biopython sh pysam
+sudo pip install biopython sh pysam numpy